@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+
+import sys
+from slackdisk import benchmark
+
+sys.exit(benchmark.main())
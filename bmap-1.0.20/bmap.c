@@ -27,11 +27,12 @@
 #include "mft.h"
 
 #include "bmap.h"
+#include "slacker.h"
 
 /*
  * flags for major operating modes
  */
-enum operating_modes {BMAP_MAP,BMAP_CARVE,BMAP_SLACK,BMAP_PUTSLACK,BMAP_WIPESLACK,BMAP_CHECKSLACK,BMAP_SLACKBYTES,BMAP_WIPE,BMAP_FRAGMENT,BMAP_CHECKFRAG};
+enum operating_modes {BMAP_MAP,BMAP_CARVE,BMAP_SLACK,BMAP_PUTSLACK,BMAP_WIPESLACK,BMAP_CHECKSLACK,BMAP_SLACKBYTES,BMAP_WIPE,BMAP_FRAGMENT,BMAP_CHECKFRAG,BMAP_BATCH};
 enum doc_modes {BMAP_VERSION,BMAP_HELP,BMAP_MAN,BMAP_SGML};
 
 static int flag_mode=BMAP_MAP;	/* what operation are we going to perform */
@@ -77,6 +78,7 @@ static struct mft_option options[]={
 			{"wipe","wipe the file from the raw device",0,MO_INT_CAST(BMAP_WIPE)},
 			{"frag","display fragmentation information for the file",0,MO_INT_CAST(BMAP_FRAGMENT)},
 			{"checkfrag","test for fragmentation (returns 0 if file is fragmented)",0,MO_INT_CAST(BMAP_CHECKFRAG)},
+			{"batch","wipe and fill the slack of every file in a manifest read from stdin",0,MO_INT_CAST(BMAP_BATCH)},
 			{NULL,NULL,0,MO_CAST(NULL)}}
 		},
 	{"outfile","write output to ...",MOT_FILENAME,{NULL}},
@@ -100,6 +102,155 @@ static struct mft_option options[]={
 	{0,0,0,{0}}
 };
 
+/*
+ * batch mode reads a manifest of "<length> <filename>\n" headers, each
+ * followed by <length> bytes of payload. every payload is stuffed at
+ * the start of its file's slack and the rest of the slack is wiped, in
+ * one seek and write per file. raw devices stay open for the batch.
+ */
+#define BATCH_MAX_DEVS 16
+
+struct batch_dev {
+	dev_t dev;
+	int raw_fd;
+};
+
+static int
+batch_read_line(int in_fd,char *line,int size)
+{
+int x=0;
+char c;
+
+	while(x<size-1)
+	{
+		if(read(in_fd,&c,1)!=1)
+			break;
+		if(c=='\n')
+		{
+			line[x]=0;
+			return x;
+		}
+		line[x++]=c;
+	}
+	line[x]=0;
+	return x ? x : -1;
+}
+
+static void
+batch_skip(int in_fd,long len,unsigned char *buffer,int buffer_len)
+{
+int read_count;
+
+	while(len>0)
+	{
+		read_count=read(in_fd,buffer,len<buffer_len ? len : buffer_len);
+		if(read_count<=0)
+			break;
+		len-=read_count;
+	}
+}
+
+static int
+batch_raw_fd(struct batch_dev *devs,int *dev_count,const char *filename,dev_t dev)
+{
+int x;
+
+	for(x=0;x<*dev_count;x++)
+	{
+		if(devs[x].dev==dev)
+			return devs[x].raw_fd;
+	}
+	if(*dev_count==BATCH_MAX_DEVS)
+		return -1;
+	devs[*dev_count].dev=dev;
+	devs[*dev_count].raw_fd=bmap_raw_open(filename,O_WRONLY);
+	if(devs[*dev_count].raw_fd==-1)
+		return -1;
+	return devs[(*dev_count)++].raw_fd;
+}
+
+static int
+bmap_batch(int in_fd,int out_fd)
+{
+char line[4096+32];
+char *filename;
+long len;
+long slack_block;
+long slack_bytes;
+long block_size;
+int target_fd;
+int raw_fd;
+struct stat statval;
+off_t offset;
+unsigned char *block_buffer=NULL;
+unsigned char skip_buffer[4096];
+struct batch_dev devs[BATCH_MAX_DEVS];
+int dev_count=0;
+int written=0;
+int failed=0;
+long long bytes=0;
+int x;
+
+	mft_log_entry();
+
+	while(batch_read_line(in_fd,line,sizeof(line))!=-1)
+	{
+		len=strtol(line,&filename,10);
+		if(*filename!=' ' || len<0)
+		{
+			mft_logf(MLOG_FATAL,"bad manifest header: %s",line);
+			break;
+		}
+		filename++;
+
+		target_fd=open(filename,O_RDONLY,0);
+		if(target_fd==-1 || fstat(target_fd,&statval)==-1
+		   || bmap_get_slack_block(target_fd,&slack_block,&slack_bytes,&block_size)==-1
+		   || (raw_fd=batch_raw_fd(devs,&dev_count,filename,statval.st_dev))==-1
+		   || !(block_buffer=(unsigned char *)realloc(block_buffer,block_size)))
+		{
+			dprintf(out_fd,"failed %s: %s\n",filename,strerror(errno));
+			batch_skip(in_fd,len,skip_buffer,sizeof(skip_buffer));
+			if(target_fd!=-1)
+				close(target_fd);
+			failed++;
+			continue;
+		}
+		close(target_fd);
+
+		if(len>slack_bytes)
+		{
+			dprintf(out_fd,"failed %s: %ld bytes don't fit in %ld bytes of slack\n",filename,len,slack_bytes);
+			batch_skip(in_fd,len,skip_buffer,sizeof(skip_buffer));
+			failed++;
+			continue;
+		}
+
+		offset=((long long)slack_block)*block_size+(statval.st_size%block_size);
+		if(spank_stuff(in_fd,raw_fd,offset,slack_bytes,len,block_buffer)==-1)
+		{
+			dprintf(out_fd,"failed %s: write error\n",filename);
+			failed++;
+			continue;
+		}
+		dprintf(out_fd,"ok %s\n",filename);
+		written++;
+		bytes+=len;
+	}
+
+	for(x=0;x<dev_count;x++)
+	{
+		fsync(devs[x].raw_fd);
+		close(devs[x].raw_fd);
+	}
+	if(block_buffer) free(block_buffer);
+
+	dprintf(out_fd,"batch: %d written, %d failed, %lld bytes\n",written,failed,bytes);
+
+	mft_log_exit();
+	return failed ? 1 : 0;
+}
+
 static struct mft_info bmap_info={
 	"bmap",
 	"use block-list knowledge to perform special operations on files",
@@ -241,6 +392,21 @@ union option_arg option_arg;
 
 	mft_logf(MLOG_PROGRESS,"target filename: %s",filename);
 
+	/* the batch target is the manifest itself (/dev/stdin to pipe it) */
+	if(flag_mode==BMAP_BATCH)
+	{
+		if((target_fd=open(filename,O_RDONLY,0))==-1)
+		{
+			mft_logf(MLOG_FATAL,"Unable to open manifest: %s",filename);
+			mft_log_exit();
+			exit(5);
+		}
+		retval=bmap_batch(target_fd,1);
+		close(target_fd);
+		mft_log_exit();
+		exit(retval);
+	}
+
 	if((target_fd=lstat(filename,&target_statval))==-1)
 	{
 		mft_logf(MLOG_FATAL,"Unable to stat file: %s\n",filename);
@@ -29,4 +29,6 @@ extern struct slacker_ops frob_SYM;
 extern struct slacker_ops pour_SYM;
 extern struct slacker_ops wipe_SYM;
 
+extern int spank_stuff(int in_fd,int raw_fd,off_t offset,long bytes,long len,unsigned char *block_buffer);
+
 #endif
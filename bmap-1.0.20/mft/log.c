@@ -291,10 +291,7 @@ void
 mft_log_perror(int log_level,int eno,const char *message)
 {
 	if(eno<0) eno=-eno;
-	if(eno>sys_nerr)
-		return;
-	
-	mft_logf(log_level,"%s: %s",message,sys_errlist[eno]);
+	mft_logf(log_level,"%s: %s",message,strerror(eno));
 	return;
 }
 
@@ -263,6 +263,62 @@ int len;
 	return bytes;
 }
 
+/*
+ * wipe the slack and put len bytes from in_fd at its start, all in a
+ * single write. used by bmap's batch mode.
+ */
+int
+spank_stuff(int in_fd,int raw_fd,off_t offset,long bytes,long len,unsigned char *block_buffer)
+{
+int io_count;
+int retval;
+
+	mft_log_entry();
+
+	if(len>bytes)
+	{
+		mft_logf(MLOG_ERROR,"%ld bytes don't fit in %ld bytes of slack",len,bytes);
+		mft_log_exit();
+		return -1;
+	}
+
+	memset(block_buffer,0,bytes);
+	io_count=0;
+	while(io_count<len)
+	{
+		retval=read(in_fd,block_buffer+io_count,len-io_count);
+		if(retval==-1)
+		{
+			mft_logf(MLOG_ERROR,"read error on input");
+			mft_log_exit();
+			return -1;
+		} else if(retval==0) {
+			mft_logf(MLOG_ERROR,"EOF on input");
+			mft_log_exit();
+			return -1;
+		}
+		io_count+=retval;
+	}
+
+	if(lseek(raw_fd,offset,SEEK_SET)!=offset)
+	{
+		mft_logf(MLOG_ERROR,"seek error");
+		mft_log_exit();
+		return -1;
+	}
+
+	retval=write(raw_fd,block_buffer,bytes);
+	if(retval<bytes)
+	{
+		mft_logf(MLOG_ERROR,"short write to slack");
+		mft_log_exit();
+		return -1;
+	}
+
+	mft_log_exit();
+	return len;
+}
+
 static void cleanup_capacity()
 {
 	mft_log_entry();
@@ -1,5 +1,6 @@
 #!/usr/bin/env python3
 
+import sys
 import slackdisk
 
-slackdisk.init()
\ No newline at end of file
+sys.exit(slackdisk.init())
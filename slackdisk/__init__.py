@@ -1,11 +1,23 @@
 #!/usr/bin/env python3
 
-from . import console
+import os
+import sys
+from . import client, protocol
 
-__all__ = ["console", "bmap", "filetree", "shell", "encoder", "encrypter"]
+__all__ = ["console", "bmap", "backend", "libbmap", "indexer", "indexcache", "filetree", "shell", "encoder", "encrypter", "fragment", "chunker", "blobstore", "compression", "allocator", "ext4image", "stats", "scheduler", "watcher", "treeformat", "protocol", "client", "daemon"]
 
-def init():
+def init(argv=None):
+    """Runs the daemon (serve), a client of the running daemon, or the console"""
+    argv = sys.argv[1:] if argv is None else argv
+    # the console and the daemon load cmd2 and the crypto libraries, clients don't need them
+    if argv[:1] == ['serve']:
+        from . import daemon
+        return daemon.main(argv[1:])
+    path = os.environ.get('SLACKDISK_SOCKET', protocol.DEFAULT_SOCKET)
+    if client.running(path):
+        return client.main(path, argv)
+    from . import console
     console.new()
 
 if __name__ == "__main__":
-    init()
\ No newline at end of file
+    init()
@@ -0,0 +1,6 @@
+#!/usr/bin/env python3
+
+import sys
+from . import init
+
+sys.exit(init())
@@ -0,0 +1,119 @@
+#!/usr/bin/env python3
+
+from bisect import bisect_left, insort
+
+class Allocator():
+    """Free slack map of the host files, named by (device, inode), grouped by device and
+    in power of two size classes. Payloads are covered with as few fragments as possible:
+    the largest free host files are taken until the rest fits in one, which is then the
+    smallest host file it fits in (best fit). Taking can be limited to one device, so
+    consecutive payloads can be striped over several."""
+    def __init__(self, capacities):
+        # device -> size class -> sorted [(capacity, host)]
+        self.__classes = {}
+        self.__capacity = dict(capacities)
+        self.__used = set()
+        for host in self.__capacity:
+            self.__add(host)
+
+    def use(self, hosts):
+        """Marks host files as holding live fragments"""
+        for host in hosts:
+            if host in self.__capacity and host not in self.__used:
+                self.__remove(host)
+                self.__used.add(host)
+
+    def release(self, hosts):
+        """Gives host files back to the free slack map"""
+        for host in hosts:
+            if host in self.__used:
+                self.__used.discard(host)
+                self.__add(host)
+
+    def isUsed(self, host):
+        return host in self.__used
+
+    def free(self):
+        """Returns (free host files, free payload bytes)"""
+        hosts = sum(len(entries) for classes in self.__classes.values() for entries in classes.values())
+        return hosts, sum(self.__capacity.values()) - sum(self.__capacity[host] for host in self.__used)
+
+    def devices(self):
+        """Devices with free host files, in order"""
+        return sorted(self.__classes)
+
+    def largest(self, device=None):
+        """Capacity of the largest free host file (of a device), 0 when there is none"""
+        entry = self.__largest(device)
+        return entry[0] if entry is not None else 0
+
+    def take(self, device=None):
+        """Takes the largest free host file (of a device), returning its (device, inode) (None when there is none)"""
+        entry = self.__largest(device)
+        if entry is None:
+            return None
+        self.use([entry[1]])
+        return entry[1]
+
+    def bestFit(self, size, device=None):
+        """Takes the smallest free host file (of a device) holding size bytes, returning its (device, inode)
+        (None when there is none)"""
+        best = None
+        for classes in self.__candidates(device):
+            for size_class in sorted(c for c in classes if c >= size.bit_length()):
+                entries = classes[size_class]
+                i = bisect_left(entries, (size,))
+                if i < len(entries):
+                    if best is None or entries[i] < best:
+                        best = entries[i]
+                    break
+        if best is None:
+            return None
+        self.use([best[1]])
+        return best[1]
+
+    def allocate(self, size, device=None):
+        """Takes host files (of a device) for size bytes of payload, returning [((device, inode), offset, length)].
+        Returns None, taking nothing, when the free slack is not enough."""
+        placed = []
+        rel = 0
+        while size - rel > self.largest(device):
+            host = self.take(device)
+            if host is None:
+                self.release(host for host, offset, length in placed)
+                return None
+            placed.append((host, rel, self.__capacity[host]))
+            rel = rel + self.__capacity[host]
+        if rel < size:
+            host = self.bestFit(size - rel, device)
+            placed.append((host, rel, size - rel))
+        return placed
+
+# Private methods
+
+    def __candidates(self, device):
+        if device is None:
+            return list(self.__classes.values())
+        return [self.__classes[device]] if device in self.__classes else []
+
+    def __largest(self, device):
+        """(capacity, host) of the largest free host file, None when there is none"""
+        found = [classes[max(classes)][-1] for classes in self.__candidates(device)]
+        return max(found) if found else None
+
+    def __add(self, host):
+        capacity = self.__capacity[host]
+        classes = self.__classes.setdefault(host[0], {})
+        insort(classes.setdefault(capacity.bit_length(), []), (capacity, host))
+
+    def __remove(self, host):
+        capacity = self.__capacity[host]
+        device = host[0]
+        classes = self.__classes[device]
+        size_class = capacity.bit_length()
+        entries = classes[size_class]
+        del entries[bisect_left(entries, (capacity, host))]
+        if not entries:
+            del classes[size_class]
+            if not classes:
+                del self.__classes[device]
@@ -0,0 +1,269 @@
+#!/usr/bin/env python3
+
+import os
+import re
+import threading
+from . import shell, libbmap, ext4image, stats
+
+class ShellBackend():
+    """Slack I/O through the bmap command line tool, one process per call"""
+    name = 'shell'
+
+    def slackSpace(self, filename):
+        """Gets slack space available on given file"""
+        # the slack itself goes to stdout and may hold binary fragments, so nothing is decoded
+        stdout, stderr = shell.runCmd(f"bmap --mode slack '{filename}'", binary=True)
+        found = re.search(rb'slack size: (\d+)', stderr)
+        if (stdout and len(stdout) > 12 and found):
+            return int(found.groups()[0])
+        else:
+            return 0
+
+    @stats.timed('slack.read', bytes_out=stats.size)
+    def read(self, filename):
+        """Reads the slack space of a file"""
+        stdout, stderr = shell.runCmd(f"bmap --mode slack '{filename}'", binary=True)
+        return stdout
+
+    def write(self, filename, data):
+        """Writes bytes to the slack space of a file"""
+        stdout, stderr = shell.runCmd(f"bmap --mode putslack '{filename}'", input=data)
+        return len(data)
+
+    def wipe(self, filename):
+        """Wipes the slack space of a file"""
+        stdout, stderr = shell.runCmd(f"bmap --mode wipeslack '{filename}'")
+        return stdout
+
+    @stats.timed('slack.writeBatch', bytes_in=lambda self, writes: sum(len(data) for filename, data in writes),
+        fragments=lambda result: len(result[0]))
+    def writeBatch(self, writes):
+        """Wipes and writes the slack of every (filename, bytes) pair with a single bmap call.
+        Returns (files written, files failed, bytes written)."""
+        stdout, stderr = shell.runCmd("bmap --mode batch /dev/stdin", input=self.__manifest(writes))
+        return self.__batchResult(writes, stdout)
+
+    @stats.timedAsync('slack.read', bytes_out=stats.size)
+    async def readAsync(self, filename):
+        """Same as read, as an asyncio subprocess"""
+        stdout, stderr = await shell.runCmdAsync(f"bmap --mode slack '{filename}'", binary=True)
+        return stdout
+
+    @stats.timedAsync('slack.writeBatch', bytes_in=lambda self, writes: sum(len(data) for filename, data in writes))
+    async def writeBatchAsync(self, writes):
+        """Same as writeBatch, as an asyncio subprocess"""
+        stdout, stderr = await shell.runCmdAsync("bmap --mode batch /dev/stdin", input=self.__manifest(writes))
+        return self.__batchResult(writes, stdout)
+
+    def close(self):
+        """Nothing to release"""
+
+# Private methods
+
+    def __manifest(self, writes):
+        return b''.join(f'{len(data)} {filename}\n'.encode() + data for filename, data in writes)
+
+    def __batchResult(self, writes, stdout):
+        written = []
+        failed = []
+        for line in stdout.split('\n'):
+            if line.startswith('ok '):
+                written.append(line[3:])
+            elif line.startswith('failed '):
+                failed.append(line[7:].rsplit(':', 1)[0])
+        sizes = dict((filename, len(data)) for filename, data in writes)
+        return written, failed, sum(sizes[filename] for filename in written if filename in sizes)
+
+class NativeBackend():
+    """Slack I/O in-process through libbmap, keeping raw devices open for the session"""
+    name = 'native'
+
+    def __init__(self, lib=None):
+        self.__lib = lib or libbmap.LibBmap()
+        self.__raw_fds = {}
+        self.__lock = threading.Lock()
+
+    def locate(self, filename):
+        """Returns (raw fd, device offset, slack bytes, block size) of a file's slack"""
+        fd = os.open(filename, os.O_RDONLY)
+        try:
+            st = os.fstat(fd)
+            try:
+                block, slack, block_size = self.__lib.get_slack_block(fd)
+            except OSError:
+                # files without blocks (empty, inline data) have no slack
+                return None, 0, 0, 0
+        finally:
+            os.close(fd)
+        offset = block * block_size + st.st_size % block_size
+        return self.__raw_fd(filename, st.st_dev), offset, slack, block_size
+
+    def slackSpace(self, filename):
+        """Gets slack space available on given file"""
+        raw_fd, offset, slack, block_size = self.locate(filename)
+        return slack
+
+    def slackBlock(self, filename):
+        """Physical block holding a file's slack on its device, None without slack"""
+        raw_fd, offset, slack, block_size = self.locate(filename)
+        if slack == 0:
+            return None
+        return offset // block_size
+
+    @stats.timed('slack.read', bytes_out=stats.size)
+    def read(self, filename):
+        """Reads the slack space of a file"""
+        raw_fd, offset, slack, block_size = self.locate(filename)
+        if slack == 0:
+            return b''
+        return os.pread(raw_fd, slack, offset)
+
+    @stats.timed('slack.readMany', bytes_out=lambda result: sum(len(slack) for slack in result),
+        fragments=len)
+    def readMany(self, filenames):
+        """Reads the slack of files whose last blocks are close on one device with a single
+        pread spanning them, the file data in between being read and dropped"""
+        located = [self.locate(filename) for filename in filenames]
+        raw_fds = set(raw_fd for raw_fd, offset, slack, block_size in located)
+        if len(raw_fds) != 1 or None in raw_fds:
+            return [self.read(filename) for filename in filenames]
+        raw_fd = located[0][0]
+        start = min(offset for raw_fd, offset, slack, block_size in located)
+        end = max(offset + slack for raw_fd, offset, slack, block_size in located)
+        data = os.pread(raw_fd, end - start, start)
+        return [data[offset - start:offset - start + slack] for raw_fd, offset, slack, block_size in located]
+
+    def write(self, filename, data):
+        """Writes bytes to the slack space of a file"""
+        raw_fd, offset, slack, block_size = self.locate(filename)
+        if slack == 0:
+            return 0
+        return os.pwrite(raw_fd, data[:slack], offset)
+
+    def wipe(self, filename):
+        """Wipes the slack space of a file"""
+        raw_fd, offset, slack, block_size = self.locate(filename)
+        if slack == 0:
+            return ''
+        self.__lib.bogowipe(raw_fd, offset, slack, block_size)
+        return ''
+
+    @stats.timed('slack.writeBatch', bytes_in=lambda self, writes: sum(len(data) for filename, data in writes),
+        fragments=lambda result: len(result[0]))
+    def writeBatch(self, writes):
+        """Wipes and writes the slack of every (filename, bytes) pair, one pwrite per file.
+        Returns (files written, files failed, bytes written)."""
+        written = []
+        failed = []
+        total = 0
+        for filename, data in writes:
+            try:
+                raw_fd, offset, slack, block_size = self.locate(filename)
+                if len(data) > slack:
+                    raise OSError(f"{len(data)} bytes don't fit in {slack} bytes of slack")
+                # zero padding up to the end of the slack wipes what was there
+                os.pwrite(raw_fd, data.ljust(slack, b'\x00'), offset)
+            except OSError:
+                failed.append(filename)
+                continue
+            written.append(filename)
+            total = total + len(data)
+        return written, failed, total
+
+    def close(self):
+        """Flushes and closes every raw device opened in this session"""
+        for raw_fd in self.__raw_fds.values():
+            os.fsync(raw_fd)
+            self.__lib.raw_close(raw_fd)
+        self.__raw_fds = {}
+
+# Private methods
+
+    def __raw_fd(self, filename, dev):
+        with self.__lock:
+            if dev not in self.__raw_fds:
+                self.__raw_fds[dev] = self.__lib.raw_open(filename, os.O_RDWR)
+            return self.__raw_fds[dev]
+
+class ImageBackend():
+    """Slack I/O straight on an unmounted ext2/3/4 image or block device mapped in memory.
+    File names are paths inside the image, reads return memoryview slices of the mapping."""
+    name = 'image'
+
+    def __init__(self, path, writable=True):
+        self.image = ext4image.Ext4Image(path, writable)
+
+    def slackSpace(self, filename):
+        """Gets slack space available on given file"""
+        offset, slack = self.__locate(filename)
+        return slack
+
+    def slackBlock(self, filename):
+        """Block of the image holding a file's slack, None without slack"""
+        offset, slack = self.__locate(filename)
+        if slack == 0:
+            return None
+        return offset // self.image.block_size
+
+    @stats.timed('slack.read', bytes_out=stats.size)
+    def read(self, filename):
+        """Reads the slack space of a file"""
+        offset, slack = self.__locate(filename)
+        return self.image.view[offset:offset + slack]
+
+    def write(self, filename, data):
+        """Writes bytes to the slack space of a file"""
+        offset, slack = self.__locate(filename)
+        length = min(len(data), slack)
+        self.image.view[offset:offset + length] = data[:length]
+        return length
+
+    def wipe(self, filename):
+        """Wipes the slack space of a file"""
+        offset, slack = self.__locate(filename)
+        self.image.view[offset:offset + slack] = bytes(slack)
+        return ''
+
+    @stats.timed('slack.writeBatch', bytes_in=lambda self, writes: sum(len(data) for filename, data in writes),
+        fragments=lambda result: len(result[0]))
+    def writeBatch(self, writes):
+        """Wipes and writes the slack of every (filename, bytes) pair.
+        Returns (files written, files failed, bytes written)."""
+        written = []
+        failed = []
+        total = 0
+        for filename, data in writes:
+            try:
+                offset, slack = self.__locate(filename)
+                if len(data) > slack:
+                    raise OSError(f"{len(data)} bytes don't fit in {slack} bytes of slack")
+            except OSError:
+                failed.append(filename)
+                continue
+            self.image.view[offset:offset + slack] = data.ljust(slack, b'\x00')
+            written.append(filename)
+            total = total + len(data)
+        return written, failed, total
+
+    def scanTrees(self, roots, workers=None):
+        """Indexes directories of the image, see indexer.scanTrees"""
+        return self.image.scanTrees(roots)
+
+    def close(self):
+        """Writes the changes back to the image"""
+        self.image.flush()
+
+# Private methods
+
+    def __locate(self, filename):
+        try:
+            return self.image.slack(filename)
+        except (FileNotFoundError, NotADirectoryError):
+            return 0, 0
+
+def detect():
+    """Returns the native backend when libbmap.so is available, the shell one otherwise"""
+    try:
+        return NativeBackend()
+    except OSError:
+        return ShellBackend()
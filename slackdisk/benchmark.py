@@ -0,0 +1,321 @@
+#!/usr/bin/env python3
+
+"""
+Benchmarks of the main SlackDisk paths on a scratch ext4 image.
+
+An ext4 image is created, mounted through a loop device and filled with host
+files of varied sizes and modification times. Indexing, save/load, the encoder
+and the file tree are then timed at several sizes, as well as the binary tree
+format against pickle (with the encoded size in bytes). With --stripes, save
+and load are also timed on a volume striped over that many images, each
+mounted through its own loop device. The results are written as JSON, so runs
+of different versions can be compared:
+
+    sudo ./benchmark.py --files 20000 --sizes 65536,1048576 --output run.json
+
+Every result records the wall time, the fragments in use after the operation,
+the subprocesses started, the read/write system calls made by the process
+(from /proc/self/io) and its peak resident memory during the operation.
+Needs root (mkfs, mount) but no network.
+"""
+
+import argparse
+import json
+import os
+import pickle
+import platform
+import random
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+from . import bmap, backend, encoder, encrypter, filetree, indexcache, shell, treeformat
+
+DEFAULT_FILES = 5000
+DEFAULT_IMAGE_MB = 512
+DEFAULT_SIZES = [65536, 1048576, 8388608]
+DEFAULT_ENTRIES = [1000, 10000]
+
+class Counters():
+    """Counts the subprocesses started through the shell module"""
+    def __init__(self):
+        self.subprocesses = 0
+        self.__popen = shell.subprocess.Popen
+
+    def install(self):
+        counters = self
+        popen = self.__popen
+
+        class CountingPopen(popen):
+            def __init__(self, *args, **kwargs):
+                counters.subprocesses = counters.subprocesses + 1
+                super().__init__(*args, **kwargs)
+
+        shell.subprocess.Popen = CountingPopen
+
+    def uninstall(self):
+        shell.subprocess.Popen = self.__popen
+
+def ioSyscalls():
+    """Read and write system calls made by this process so far"""
+    counts = {}
+    try:
+        with open('/proc/self/io') as f:
+            for line in f:
+                name, value = line.split(':')
+                counts[name] = int(value)
+    except OSError:
+        return 0
+    return counts.get('syscr', 0) + counts.get('syscw', 0)
+
+def resetPeakRss():
+    """Resets the peak resident memory of this process (VmHWM), where the kernel allows it"""
+    try:
+        with open('/proc/self/clear_refs', 'w') as f:
+            f.write('5')
+    except OSError:
+        pass
+
+def peakRss():
+    """Peak resident memory of this process in KiB"""
+    with open('/proc/self/status') as f:
+        for line in f:
+            if line.startswith('VmHWM:'):
+                return int(line.split()[1])
+    return 0
+
+def measure(results, counters, name, size, work, fragments=None):
+    """Runs work() once and appends its measures to results"""
+    subprocesses = counters.subprocesses
+    syscalls = ioSyscalls()
+    resetPeakRss()
+    start = time.perf_counter()
+    work()
+    elapsed = time.perf_counter() - start
+    result = {
+        'name': name,
+        'size': size,
+        'seconds': round(elapsed, 6),
+        'fragments': fragments() if fragments else None,
+        'subprocesses': counters.subprocesses - subprocesses,
+        'syscalls': ioSyscalls() - syscalls,
+        'peak_rss_kb': peakRss(),
+    }
+    results.append(result)
+    print(f"{name:<20} {size:>10} {elapsed:>9.3f}s")
+    return result
+
+def run(command):
+    subprocess.run(command, check=True, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+
+def makeImage(workdir, image_mb, name='slackdisk'):
+    """Creates and mounts an ext4 image, returning (image path, mount point)"""
+    image = os.path.join(workdir, f'{name}.img')
+    mountpoint = os.path.join(workdir, 'mnt' if name == 'slackdisk' else f'{name}-mnt')
+    os.mkdir(mountpoint)
+    with open(image, 'wb') as f:
+        f.truncate(image_mb * 1024 * 1024)
+    run(['mkfs.ext4', '-q', '-F', '-b', '4096', '-O', '^has_journal', image])
+    run(['mount', '-o', 'loop', image, mountpoint])
+    return image, mountpoint
+
+def fillImage(mountpoint, files, seed):
+    """Writes host files of varied sizes and modification times, in a few directories"""
+    rng = random.Random(seed)
+    now = time.time()
+    hosts = []
+    for i in range(files):
+        directory = os.path.join(mountpoint, f'dir{i % 64:02d}')
+        os.makedirs(directory, exist_ok=True)
+        filename = os.path.join(directory, f'host{i:06d}')
+        with open(filename, 'wb') as f:
+            f.write(b'h' * rng.choice([rng.randint(1, 4095), rng.randint(4097, 65535)]))
+        age = rng.randint(0, 1000) * 86400
+        os.utime(filename, (now - age, now - age))
+        hosts.append(filename)
+    os.sync()
+    return hosts
+
+def payload(size, seed):
+    """Half random, half text-like bytes"""
+    rng = random.Random(seed)
+    words = [b'slack', b'disk', b'block', b'inode', b'fragment', b'volume', b'hidden']
+    text = b' '.join(rng.choice(words) for i in range(size // 12 + 1))[:size - size // 2]
+    return rng.randbytes(size // 2) + text
+
+def benchmarkBmap(results, counters, mountpoint, sizes, workdir, seed):
+    cache = indexcache.IndexCache(os.path.join(workdir, 'index'))
+    disk = bmap.Bmap(cache=cache)
+    disk.usabledirs = mountpoint
+    disk.minimaltime = '0'
+    initial = os.path.join(mountpoint, 'dir00', 'host000000')
+    measure(results, counters, 'index', 0, lambda: disk.indexDisk(mountpoint, '0'))
+    measure(results, counters, 'index-refresh', 0, lambda: disk.refreshIndex(mountpoint, '0'))
+    for size in sizes:
+        data = payload(size, seed + size)
+        measure(results, counters, 'save', size, lambda: disk.save(data, initial), disk.fragmentsInUse)
+        loaded = []
+        measure(results, counters, 'load', size, lambda: loaded.append(disk.load(initial)), disk.fragmentsInUse)
+        if loaded[0] != data:
+            print(f"load of {size} bytes didn't match the saved data", file=sys.stderr)
+        changed = data[:size // 2] + b'changed' + data[size // 2:]
+        measure(results, counters, 'save-incremental', size, lambda: disk.save(changed, initial), disk.fragmentsInUse)
+    disk.close()
+
+def benchmarkStriping(results, counters, mountpoints, sizes, workdir, seed):
+    """Save and load of a volume striped over the host files of several file systems"""
+    cache = indexcache.IndexCache(os.path.join(workdir, 'index-striped'))
+    disk = bmap.Bmap(cache=cache)
+    usable = ' '.join(mountpoints)
+    disk.usabledirs = usable
+    disk.minimaltime = '0'
+    initial = os.path.join(mountpoints[0], 'dir00', 'host000000')
+    disk.indexDisk(usable, '0')
+    for size in sizes:
+        data = payload(size, seed + size)
+        saved = []
+        measure(results, counters, f'save-striped-{len(mountpoints)}', size, lambda: saved.append(disk.save(data, initial)), disk.fragmentsInUse)
+        if f'striped over {len(mountpoints)} devices' not in saved[0]:
+            print(f"save of {size} bytes wasn't striped over every image: {saved[0]}", file=sys.stderr)
+        loaded = []
+        measure(results, counters, f'load-striped-{len(mountpoints)}', size, lambda: loaded.append(disk.load(initial)), disk.fragmentsInUse)
+        if loaded[0] != data:
+            print(f"striped load of {size} bytes didn't match the saved data", file=sys.stderr)
+    disk.close()
+
+def benchmarkEncoder(results, counters, sizes, seed):
+    coder = encoder.Encoder()
+    session = encrypter.Session('benchmark')
+    for size in sizes:
+        data = payload(size, seed + size)
+        encoded = []
+        measure(results, counters, 'encode', size, lambda: encoded.append(coder.encode(data, 'benchmark')))
+        measure(results, counters, 'decode', size, lambda: coder.decode(encoded[0], 'benchmark'))
+        measure(results, counters, 'encode-session', size,
+            lambda: b''.join(coder.encode_stream([data], session, report=False)))
+    results.append({'name': 'crypto-throughput', 'size': 0, 'mb_per_s': round(session.throughput(), 1)})
+    session.close()
+
+def benchmarkFiletree(results, counters, entries):
+    for count in entries:
+        tree = filetree.Filetree()
+
+        def build():
+            for i in range(count):
+                if i % 100 == 0:
+                    tree.mkdir(f'/d{i // 100}')
+                tree.putStr(f'content {i}', f'/d{i // 100}/f{i}')
+
+        def lookup():
+            for i in range(count):
+                tree.catFile(f'/d{i // 100}/f{i}')
+
+        def listing():
+            for i in range(0, count, 100):
+                tree.cd(f'/d{i // 100}')
+                tree.ls()
+            tree.cd('/')
+
+        encoded = []
+        measure(results, counters, 'tree-build', count, build)
+        measure(results, counters, 'tree-cat', count, lookup)
+        measure(results, counters, 'tree-ls', count, listing)
+        measure(results, counters, 'tree-encode', count, lambda: encoded.append(b''.join(tree.encodeFiletree('benchmark'))))
+        measure(results, counters, 'tree-decode', count, lambda: filetree.Filetree().loadFileTree(encoded[0], 'benchmark'))
+
+def treeSerializations(count):
+    """The same tree of count files as treeformat entries and as the nested dict pickled by older versions"""
+    entries = [(treeformat.DIR, '', -(-count // 100), 0, None)]
+    nested = {}
+    for i in range(count):
+        if i % 100 == 0:
+            entries.append((treeformat.DIR, f'd{i // 100}', min(100, count - i), 0, None))
+            directory = nested[f'd{i // 100}d'] = {}
+        content = f'content {i}'.encode()
+        entries.append((treeformat.FILE, f'f{i}', 0, len(content), content))
+        directory[f'f{i}f'] = content
+    return entries, nested
+
+def benchmarkSerialization(results, counters, entries):
+    """Binary tree format against pickle, without compression and encryption"""
+    key = os.urandom(32)
+    for count in entries:
+        tree, nested = treeSerializations(count)
+        binary = []
+        pickled = []
+        measure(results, counters, 'serialize-binary', count, lambda: binary.append(b''.join(treeformat.encode(tree, key))))
+        measure(results, counters, 'serialize-pickle', count, lambda: pickled.append(pickle.dumps(nested)))
+        results[-2]['bytes'] = len(binary[0])
+        results[-1]['bytes'] = len(pickled[0])
+
+        def load():
+            reader = treeformat.TreeReader(treeformat.Stream([binary[0]]))
+            for entry in reader.entries():
+                pass
+            for contents in reader.contents():
+                pass
+
+        measure(results, counters, 'deserialize-binary', count, load)
+        measure(results, counters, 'deserialize-pickle', count, lambda: pickle.loads(pickled[0]))
+        measure(results, counters, 'subtree-binary', count,
+            lambda: list(treeformat.TreeReader(treeformat.Stream([binary[0]])).subtree(f'/d{count // 200}')))
+
+def sizeList(text):
+    return [int(size) for size in text.split(',') if size]
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description='Benchmarks SlackDisk on a scratch ext4 image')
+    parser.add_argument('--files', type=int, default=DEFAULT_FILES, help='host files created in the image')
+    parser.add_argument('--image-mb', type=int, default=DEFAULT_IMAGE_MB, help='size of the image in MiB')
+    parser.add_argument('--sizes', type=sizeList, default=DEFAULT_SIZES, help='volume sizes in bytes, comma separated')
+    parser.add_argument('--entries', type=sizeList, default=DEFAULT_ENTRIES, help='file tree sizes, comma separated')
+    parser.add_argument('--stripes', type=int, default=0, help='images to stripe a volume over (0 to skip)')
+    parser.add_argument('--seed', type=int, default=1)
+    parser.add_argument('--output', default='benchmark.json', help='JSON file for the results')
+    parser.add_argument('--keep', action='store_true', help='keep the image and its mount point')
+    args = parser.parse_args(argv)
+    if os.geteuid() != 0:
+        print('The benchmark must be run as root (it creates and mounts an ext4 image)', file=sys.stderr)
+        return 1
+    counters = Counters()
+    counters.install()
+    results = []
+    workdir = tempfile.mkdtemp(prefix='slackdisk-bench-')
+    mountpoints = []
+    try:
+        image, mountpoint = makeImage(workdir, args.image_mb)
+        mountpoints.append(mountpoint)
+        print(f"Filling {mountpoint} with {args.files} host files")
+        fillImage(mountpoint, args.files, args.seed)
+        benchmarkBmap(results, counters, mountpoint, args.sizes, workdir, args.seed)
+        if args.stripes > 0:
+            stripes = []
+            for i in range(args.stripes):
+                image, mountpoint = makeImage(workdir, args.image_mb, f'stripe{i}')
+                mountpoints.append(mountpoint)
+                print(f"Filling {mountpoint} with {args.files // args.stripes} host files")
+                fillImage(mountpoint, args.files // args.stripes, args.seed + i)
+                stripes.append(mountpoint)
+            benchmarkStriping(results, counters, stripes, args.sizes, workdir, args.seed)
+        benchmarkEncoder(results, counters, args.sizes, args.seed)
+        benchmarkFiletree(results, counters, args.entries)
+        benchmarkSerialization(results, counters, args.entries)
+    finally:
+        counters.uninstall()
+        if not args.keep:
+            for mountpoint in mountpoints:
+                subprocess.run(['umount', mountpoint])
+            shutil.rmtree(workdir, ignore_errors=True)
+    report = {
+        'date': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'python': platform.python_version(),
+        'kernel': platform.release(),
+        'backend': backend.detect().name,
+        'files': args.files,
+        'results': results,
+    }
+    with open(args.output, 'w') as f:
+        json.dump(report, f, indent=2)
+    print(f"Results written to {args.output}")
+    return 0
@@ -0,0 +1,205 @@
+#!/usr/bin/env python3
+
+from collections import OrderedDict
+from itertools import islice
+from . import encrypter, compression, chunker
+
+# Bytes of decoded file contents kept in memory by default
+CACHE_SIZE = 32 * 1024 * 1024
+
+class Blob():
+    """Reference to a file's contents saved in slack as its own chain of fragments,
+    listed as [((device, inode), length)]"""
+    __slots__ = ('size', 'fragments')
+
+    def __init__(self, size, fragments):
+        self.size = size
+        self.fragments = fragments
+
+    def __getstate__(self):
+        return (self.size, self.fragments)
+
+    def __setstate__(self, state):
+        self.size, self.fragments = state
+
+class Chunked():
+    """File contents deduplicated in the chunk store, as the strong digests of their chunks"""
+    __slots__ = ('size', 'digests')
+
+    def __init__(self, size, digests):
+        self.size = size
+        self.digests = digests
+
+    def __getstate__(self):
+        return (self.size, self.digests)
+
+    def __setstate__(self, state):
+        self.size, self.digests = state
+
+class BlobStore():
+    """Saves and fetches file contents in slack, keeping recently read ones in a bounded LRU cache.
+    Contents are cut in content defined chunks, each saved once as its own Blob however
+    many files hold it: the chunk store maps digests to [Blob, reference count]. Chunks are
+    cached by digest, as their host files are reused once no file holds them."""
+    def __init__(self, bmap, encoder, initialfile, cache_size=CACHE_SIZE):
+        self.bmap = bmap
+        self.encoder = encoder
+        self.initialfile = initialfile
+        self.cache_size = cache_size
+        self.__cache = OrderedDict()
+        self.__cached = 0
+        self.__session = None
+        self.__chunks = {}
+
+    def write(self, data, datakey):
+        """Saves bytes in slack, returning their Chunked"""
+        return self.writeStream([data], datakey)
+
+    def writeStream(self, pieces, datakey):
+        """Saves an iterable of bytes in slack as it comes, returning its Chunked. Only the
+        chunks missing from the chunk store are written, each compressed with the codec
+        its contents call for. Only a few chunks are held at a time."""
+        size = 0
+        digests = []
+        for offset, chunk in chunker.stream(pieces):
+            digest = chunker.strongDigest(chunk)
+            entry = self.__chunks.get(digest)
+            if entry is None:
+                encoded = self.encoder.encode_stream([chunk], self.__sessionFor(datakey), report=False,
+                    codec=compression.probe(chunk))
+                entry = self.__chunks[digest] = [Blob(len(chunk), self.bmap.saveBlob(encoded, self.initialfile)), 0]
+            entry[1] = entry[1] + 1
+            digests.append(digest)
+            size = size + len(chunk)
+        return Chunked(size, digests)
+
+    def read(self, blob, datakey):
+        """Fetches and decodes the contents of a Blob or Chunked"""
+        if isinstance(blob, Chunked):
+            return b''.join(self.__readChunks(blob, datakey))
+        if blob in self.__cache:
+            self.__cache.move_to_end(blob)
+            return self.__cache[blob]
+        data = b''.join(self.encoder.decode_stream(self.bmap.loadBlob(blob.fragments),
+            self.__sessionFor(datakey)))
+        self.__remember(blob, data)
+        return data
+
+    def readStream(self, blob, datakey):
+        """Fetches and decodes the contents of a Blob, yielding them piece by piece.
+        Contents small enough for the cache are kept there once read."""
+        if isinstance(blob, Chunked):
+            yield from self.__readChunks(blob, datakey)
+            return
+        if blob in self.__cache:
+            self.__cache.move_to_end(blob)
+            yield self.__cache[blob]
+            return
+        kept = [] if blob.size <= self.cache_size else None
+        for piece in self.encoder.decode_stream(self.bmap.loadBlob(blob.fragments),
+                self.__sessionFor(datakey)):
+            if kept is not None:
+                kept.append(piece)
+            yield piece
+        if kept is not None:
+            self.__remember(blob, b''.join(kept))
+
+    def reserve(self, blobs):
+        """Keeps save from reusing the host files of the given blobs, releasing all others"""
+        self.bmap.reserve(host for blob in blobs for host, length in blob.fragments)
+
+    def release(self, contents):
+        """Drops a reference to the chunks of removed file contents. Chunks no file holds
+        any more leave the chunk store and the cache, their host files are freed by the next reserve."""
+        if isinstance(contents, Blob):
+            self.__forget(contents)
+        if not isinstance(contents, Chunked):
+            return
+        for digest in contents.digests:
+            entry = self.__chunks.get(digest)
+            if entry is None:
+                continue
+            entry[1] = entry[1] - 1
+            if entry[1] <= 0:
+                del self.__chunks[digest]
+                self.__forget(digest)
+
+    def chunks(self):
+        """[(digest, Blob)] of the chunk store, for the file tree"""
+        return [(digest, entry[0]) for digest, entry in self.__chunks.items()]
+
+    def chunkBlobs(self):
+        """Blobs of the chunks in the chunk store"""
+        return [entry[0] for entry in self.__chunks.values()]
+
+    def loadChunks(self, chunks, files):
+        """Replaces the chunk store with the (digest, Blob) of a loaded file tree, counting
+        the references from the Chunked contents of its files"""
+        table = {digest: [blob, 0] for digest, blob in chunks}
+        for contents in files:
+            for digest in contents.digests:
+                if digest not in table:
+                    raise ValueError(f"chunk {digest.hex()} missing from the chunk store")
+                table[digest][1] = table[digest][1] + 1
+        self.__chunks = {digest: entry for digest, entry in table.items() if entry[1] > 0}
+
+    def dedup(self):
+        """Chunk store figures: chunk and reference counts, bytes of the contents referenced
+        (logical), bytes of the distinct chunks (stored), bytes they take in slack and the ratio"""
+        logical = sum(entry[0].size * entry[1] for entry in self.__chunks.values())
+        stored = sum(entry[0].size for entry in self.__chunks.values())
+        return {
+            'chunks': len(self.__chunks),
+            'references': sum(entry[1] for entry in self.__chunks.values()),
+            'logical': logical,
+            'stored': stored,
+            'slack': sum(length for entry in self.__chunks.values() for host, length in entry[0].fragments),
+            'ratio': logical / stored if stored else 1.0,
+        }
+
+    def clear(self):
+        """Drops every cached file"""
+        self.__cache = OrderedDict()
+        self.__cached = 0
+
+# Private methods
+
+    def __sessionFor(self, datakey):
+        if self.__session is None or self.__session.key != datakey:
+            self.__session = encrypter.Session(key=datakey)
+        return self.__session
+
+    def __readChunks(self, chunked, datakey):
+        """Yields the chunks of a Chunked, reading the ones not cached as a single chain"""
+        blobs = []
+        for digest in chunked.digests:
+            entry = self.__chunks.get(digest)
+            if entry is None:
+                raise OSError(f"chunk {digest.hex()} missing from the chunk store")
+            blobs.append(entry[0])
+        # taken once, a chunk evicted meanwhile would be out of step with the chain
+        cached = [self.__cache.get(digest) for digest in chunked.digests]
+        payloads = self.bmap.loadBlob([fragment for blob, data in zip(blobs, cached) if data is None
+            for fragment in blob.fragments])
+        session = self.__sessionFor(datakey)
+        for digest, blob, data in zip(chunked.digests, blobs, cached):
+            if data is None:
+                data = b''.join(self.encoder.decode_stream(islice(payloads, len(blob.fragments)), session))
+                self.__remember(digest, data)
+            yield data
+
+    def __remember(self, key, data):
+        """Caches the contents of a chunk (by digest) or of a Blob"""
+        if len(data) > self.cache_size:
+            return
+        self.__forget(key)
+        self.__cache[key] = data
+        self.__cached = self.__cached + len(data)
+        while self.__cached > self.cache_size:
+            key, evicted = self.__cache.popitem(last=False)
+            self.__cached = self.__cached - len(evicted)
+
+    def __forget(self, key):
+        data = self.__cache.pop(key, None)
+        if data is not None:
+            self.__cached = self.__cached - len(data)
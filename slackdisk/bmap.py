@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
 
-from . import shell
-import re
+import base64
+import os
+import stat
+import threading
+import time
+from collections import deque
+from . import shell, backend, indexer, indexcache, fragment, chunker, allocator, scheduler, watcher, stats
 
 helpStr = """
     Usage: bmap [MODE] [FILE] [ARGUMENTS]
@@ -11,50 +16,80 @@ helpStr = """
         clean:\tWipes contents of slack space of a file
 """
 
+# Fragments issued at a time in physical block order, ahead of the consumer
+SWEEP_WINDOW = 256
+# Slack blocks at most this far apart on a device are read with one call, reading through the gap
+MERGE_GAP = 8
+# Fragments merged into one read at most
+MAX_RUN = 32
+
 class Bmap():
-    def __init__(self):
+    def __init__(self, slack_backend=None, cache=None, concurrency=scheduler.DEFAULT_CONCURRENCY):
         self.__disk_index = {}
+        self.__files = []
+        self.__by_host = {}
+        self.__by_path = {}
+        self.__blocks = {}
+        self.__stripe = 0
+        self.__reserved = set()
+        self.__volume = None
+        self.__allocator = allocator.Allocator({})
         self.__priority_list = []
         self.__total_size = 0
+        self.__watcher = None
+        self.__changes = {}
+        self.__rescan = False
+        self.__clobbered = {}
+        self.__lock = threading.Lock()
+        self.onClobbered = None
         self.minimaltime = 100
         self.usabledirs = '/bin /etc /home /lib /lib32 /lib64 /opt /root'
+        self.scheduler = scheduler.Scheduler(concurrency)
+        self.backend = slack_backend or backend.detect()
+        self.cache = cache or indexcache.IndexCache()
 
     def put(self, filename, data_str):
         """Puts a string on the slack space of a file"""
         # TODO: prevent overwrite
-        stdout, stderr = shell.runCmd(f"echo {data_str} | bmap --mode putslack '{filename}'")
-        return stdout
+        self.backend.write(filename, data_str.encode())
+        return ''
 
     def get(self, filename):
         """Gets a string from the slack space of a file"""
-        stdout, stderr = shell.runCmd(f"bmap --mode slack '{filename}'")
-        return stdout
+        return bytes(self.backend.read(filename)).rstrip(b'\x00\n').decode('ascii', 'ignore')
 
     def getSlackSpace(self, filename):
         """Gets slack space available on given file"""
-        # TODO: test
-        stdout, stderr = shell.runCmd(f"bmap --mode slack '{filename}'") 
-        if (stdout and len(stdout) > 12):
-            slack_space = int(re.search(r'slack size: (\d+)', stderr).groups()[0])
-            return slack_space
-        else:
-            return 0
+        return self.backend.slackSpace(filename)
 
     def wipe(self, filename):
         """Wipes the slack space of a file"""
-        stdout, stderr = shell.runCmd(f"bmap --mode wipe '{filename}'")
-        return stdout
+        return self.backend.wipe(filename)
+
+    def writeBatch(self, writes):
+        """Wipes and writes a list of (filename, bytes) fragments as one transaction"""
+        written, failed, total = self.backend.writeBatch(writes)
+        return self.__batchSummary(written, failed, total)
+
+    def close(self):
+        """Releases the slack backend, the scheduler, the watcher and the index file"""
+        self.watch(False)
+        self.scheduler.close()
+        self.backend.close()
+        self.cache.close()
 
     def total(self, usable, days):
         """Gets available slack space on usable dirs that have not been changed in a certain amount of days (total)"""
         if (self.__total_size == 0):
-            self.indexDisk(usable, days)
+            self.refreshIndex(usable, days)
+        self.__applyChanges()
         return f'{self.bytes_to_human(self.__total_size)} in {len(self.__priority_list)} files'
 
     def help(self):
         """Returns bmap's help"""
         return helpStr
 
+    @stats.timed('bmap.indexDisk')
     def indexDisk(self, usable, days):
         """Indexes whole disk by inode.
         Indexed info:
@@ -63,78 +98,706 @@ class Bmap():
             slack space
         """
         print("Indexing usable directories")
+        # backends working on an image walk its directories themselves
+        scanTrees = getattr(self.backend, 'scanTrees', indexer.scanTrees)
+        files, dirs, elapsed = scanTrees(usable.split())
+        self.cache.replace(usable.split(), files, dirs)
+        self.__loadCache(days)
+        return f"Indexing done! {self.__filesPerSecond(len(files), elapsed)}"
+
+    @stats.timed('bmap.refreshIndex')
+    def refreshIndex(self, usable, days):
+        """Loads the index saved by a previous session, re-examining only what changed since"""
+        if not self.cache.roots() or hasattr(self.backend, 'scanTrees'):
+            return self.indexDisk(usable, days)
+        print("Refreshing index")
+        start = time.monotonic()
+        updated, rescanned = self.cache.refresh(usable.split())
+        self.__loadCache(days)
+        return f"Index refreshed! {updated} files updated, {rescanned} directories rescanned in {time.monotonic() - start:.1f}s"
+
+    def filterIndex(self, days):
+        """Re-filters the loaded index by minimal modification age, without rescanning"""
+        cutoff = indexer.cutoffTime(days)
+        index = {}
+        for dev, inode, file, mod_date, size, slack_space in self.__files:
+            if slack_space > indexer.MIN_SLACK and (cutoff is None or mod_date <= cutoff):
+                index[(dev, inode)] = {'filename': file, 'mod_date': mod_date, 'slack': slack_space}
+        self.__setIndex(index)
+        return f'{self.bytes_to_human(self.__total_size)} in {len(self.__priority_list)} files'
+
+    def watch(self, on=True):
+        """Starts (or stops) keeping the index live with inotify on the usable directories.
+        Changed host files are re-indexed on the next operation, in-use ones whose slack was
+        overwritten are flagged at once (see clobbered and onClobbered)."""
+        if not on:
+            if self.__watcher is None:
+                return 'Watcher not running'
+            self.__watcher.stop()
+            self.__watcher = None
+            return 'Watcher stopped'
+        if self.__watcher is not None:
+            return f'Already watching {self.__watcher.watched()} directories'
+        if hasattr(self.backend, 'scanTrees'):
+            return 'Changes to an unmounted image can not be watched'
+        if len(self.__disk_index.keys()) == 0:
+            self.refreshIndex(self.usabledirs, self.minimaltime)
+        try:
+            self.__watcher = watcher.Watcher(self.usabledirs.split(), self.__changed, self.__overflow)
+            watched = self.__watcher.start()
+        except OSError as e:
+            if self.__watcher is not None:
+                self.__watcher.stop()
+            self.__watcher = None
+            return f'Unable to watch: {e}'
+        return f'Watching {watched} directories'
+
+    def watching(self):
+        """Tells if the watcher is running"""
+        return self.__watcher is not None
+
+    def clobbered(self):
+        """{(device, inode): filename} of the in-use host files written to since they were saved"""
+        with self.__lock:
+            return dict(self.__clobbered)
+
+    def indexDiskShell(self, usable, days):
+        """Indexes whole disk with find, stat and bmap subprocesses (old path, kept for comparison)"""
+        print("Indexing usable directories")
+        start = time.monotonic()
         index = {}
-        free = 0
         if days != '0':
             stdout, stderr = shell.runCmd(f"find {usable} -mtime +{days} -type f")
         else:
             stdout, stderr = shell.runCmd(f"find {usable} -type f")
         files = stdout.split('\n')
         for file in files:
-            stdout, stderr = shell.runCmd(f"stat -c '%i %Y' {file}") 
+            stdout, stderr = shell.runCmd(f"stat -c '%d %i %Y' {file}") 
             if (len(stdout) > 0):
-                inode = stdout.split(' ')[0] 
-                mod_date = stdout.split(' ')[1] 
+                host = (int(stdout.split(' ')[0]), int(stdout.split(' ')[1]))
+                mod_date = int(stdout.split(' ')[2])
             slack_space = self.getSlackSpace(file)
-            if(slack_space > 10):
-                free = free + slack_space
-                index[inode] = {}
-                index[inode]['filename'] = file
-                index[inode]['mod_date'] = mod_date
-                index[inode]['slack'] = slack_space
-        self.__disk_index = index
-        self.__priority_list = sorted(index.keys(), key=lambda x: (index[x]['mod_date'], -index[x]['slack']))
-        self.__total_size = free
-        return "Indexing done!"
+            if(slack_space > indexer.MIN_SLACK):
+                index[host] = {}
+                index[host]['filename'] = file
+                index[host]['mod_date'] = mod_date
+                index[host]['slack'] = slack_space
+        self.__setIndex(index)
+        return f"Indexing done! {self.__filesPerSecond(len(files), time.monotonic() - start)}"
 
-    def save(self, encodedString, initialFile):
-        """Saves a arbitrary string on slack space"""
+    @stats.timed('bmap.save', bytes_in=lambda self, data, initialFile: stats.size(data))
+    def save(self, data, initialFile):
+        """Saves arbitrary bytes, or an iterable of bytes, on slack space.
+        The initial file gets the fragment table, the data goes to the other host files.
+        The data is cut in content-defined chunks as it comes in and each chunk is
+        scheduled for writing as soon as it is cut, the table is written once they are
+        all done; chunks already saved by the previous save keep their host files and
+        are not written again. When a write fails the table isn't written and the
+        previous volume stays as it was."""
         if len(self.__disk_index.keys()) == 0:
-            self.indexDisk(self.usabledirs, self.minimaltime)
-        remaining = encodedString
-        currentFile = initialFile
-        nextIndex = 0
-        while len(remaining) != 0:
-            space = self.getSlackSpace(currentFile) 
-            if len(remaining) < space:
-                slackPartial = f':{remaining}'
-                remaining = ''
-                nextFile = ''
-            else:
-                if nextIndex > len(self.__priority_list):
-                    # TODO: treat exception
-                    return
-                nextInode = self.__priority_list[nextIndex]
-                nextFile = self.__disk_index[nextInode]["filename"]
-                nextIndex = nextIndex + 1
-                if nextFile == initialFile:
-                    nextInode = self.__priority_list[nextIndex]
-                    nextFile = self.__disk_index[nextInode]["filename"]
-                    nextIndex = nextIndex + 1
-                space = space - len(str(nextInode)) - 1
-                slackPartial = f'{str(nextInode)}:{remaining[:space]}'
-                remaining = remaining[space:]
-            self.wipe(currentFile)
-            self.put(currentFile, slackPartial)
-            currentFile = nextFile
+            self.refreshIndex(self.usabledirs, self.minimaltime)
+        self.__applyChanges()
+        if isinstance(data, (bytes, bytearray)):
+            data = [data]
+        previous = self.__previousChunks(initialFile)
+        # host files of the previous volume are only free again once the new table is written,
+        # a save that fails half way leaves the previous volume as it was
+        old = set(self.__volumeHosts(initialFile))
+        self.__useInitial(initialFile)
+        allocated = []
+        batches = deque()
+        writes = []
+        kept = {}
+        chunks = []
+        entries = []
+        written = []
+        failed = []
+        saved = 0
+        touched = 0
+        size = 0
+        for offset, chunk in chunker.stream(data):
+            digest = chunker.digest(chunk)
+            chunks.append((digest, offset, len(chunk)))
+            size = offset + len(chunk)
+            if digest in previous:
+                kept[digest] = previous[digest]
+            if digest not in kept:
+                placed = self.__place(len(chunk))
+                if placed is None:
+                    self.scheduler.cancel(batches)
+                    self.__allocator.release(allocated)
+                    return f'Not enough slack space: {self.bytes_to_human(offset)} placed'
+                allocated.extend(host for host, rel, length in placed)
+                kept[digest] = placed
+                for i, (host, rel, length) in enumerate(placed):
+                    nextHost = placed[i + 1][0] if i + 1 < len(placed) else None
+                    writes.append((self.__disk_index[host]['filename'],
+                        fragment.pack(fragment.DATA, nextHost, chunk[rel:rel + length], i)))
+                if len(writes) >= self.scheduler.concurrency:
+                    self.__submitWrites(batches, writes)
+                    writes = []
+                    saved = saved + self.__drain(batches, 2 * self.scheduler.concurrency, written, failed)
+                    if failed:
+                        break
+                touched = touched + len(chunk)
+            entries.extend((host, offset + rel, length) for host, rel, length in kept[digest])
+        if writes and not failed:
+            self.__submitWrites(batches, writes)
+        saved = saved + self.__drain(batches, 0, written, failed)
+        if failed:
+            # a table pointing at fragments that weren't written would lose the volume
+            self.__allocator.release(allocated)
+            return f"Unable to write slack of {', '.join(failed)}, the previous volume is kept"
+        changed = len(written)
+        stripes = len(set(host[0] for host, offset, length in entries))
+        body = fragment.packTable(chunks, entries)
+        if self.getSlackSpace(initialFile) <= fragment.HEADER.size:
+            self.__allocator.release(allocated)
+            return 'Not enough slack space in the initial file'
+        tables = [(initialFile, self.getSlackSpace(initialFile) - fragment.HEADER.size, None)]
+        if len(body) > tables[0][1]:
+            placed = self.__allocator.allocate(len(body) - tables[0][1])
+            if placed is None:
+                self.__allocator.release(allocated)
+                return 'Not enough slack space for the fragment table'
+            tables.extend((self.__disk_index[host]['filename'], length, host) for host, rel, length in placed)
+        writes = []
+        position = 0
+        for i, (filename, capacity, host) in enumerate(tables):
+            nextHost = tables[i + 1][2] if i + 1 < len(tables) else None
+            writes.append((filename, fragment.pack(fragment.TABLE, nextHost, body[position:position + capacity], i)))
+            position = position + capacity
+        batchWritten, batchFailed, total = self.backend.writeBatch(writes)
+        volume = set(host for host, offset, length in entries)
+        volume.update(host for filename, capacity, host in tables[1:])
+        self.__allocator.release(old - volume - self.__reserved)
+        self.__volume = volume
+        # clobbered host files of the volume were either rewritten or left
+        with self.__lock:
+            self.__clobbered = {host: filename for host, filename in self.__clobbered.items() if host in self.__reserved}
+        summary = self.__batchSummary(written + batchWritten, failed + batchFailed, saved + total)
+        # every fragment costs a header, the table is all overhead
+        fragments = len(entries) + len(tables) + len(self.__reserved)
+        overhead = fragments * fragment.HEADER.size + len(body)
+        striped = f', striped over {stripes} devices' if stripes > 1 else ''
+        return (f'{summary} ({changed} of {len(entries)} data fragments, {self.bytes_to_human(touched)} of {self.bytes_to_human(size)} changed, '
+            f'{fragments} fragments in use, {self.bytes_to_human(overhead)} overhead{striped})')
 
     def load(self, initialFile):
-        """Loads a arbitrary string from slack space"""
+        """Loads arbitrary bytes from slack space"""
+        return b''.join(self.loadStream(initialFile))
+
+    @stats.timedStream('bmap.loadStream')
+    def loadStream(self, initialFile):
+        """Loads arbitrary bytes from slack space, yielding them in order fragment by fragment.
+        Fragments are read in parallel, a window ahead of the consumer in physical block order."""
         if len(self.__disk_index.keys()) == 0:
-            self.indexDisk(self.usabledirs, self.minimaltime)
-        slack = self.get(initialFile)
+            self.refreshIndex(self.usabledirs, self.minimaltime)
+        self.__applyChanges()
+        slack = self.backend.read(initialFile)
+        if not fragment.isFragment(slack):
+            yield from self.__loadText(slack)
+            return
+        chunks, entries, tables = self.__readTable(slack)
+        self.__setVolume(set(host for host, offset, length in entries) | tables)
+        entries.sort(key=lambda entry: entry[1])
+        yield from self.__readFragments([(host, length) for host, offset, length in entries], self.__fragmentReader())
+
+    def reserve(self, hosts):
+        """Marks the (device, inode) host files holding file contents (blobs) as in use, save
+        won't touch them. Host files reserved before and not given again are free again."""
+        hosts = set(hosts)
+        self.__allocator.release(self.__reserved - hosts - (self.__volume or set()))
+        self.__allocator.use(hosts)
+        self.__reserved = hosts
+
+    @stats.timed('bmap.saveBlob', fragments=len)
+    def saveBlob(self, pieces, initialFile):
+        """Saves an iterable of bytes as its own chain of data fragments, outside of the
+        volume's fragment table. Returns [((device, inode), length)] and reserves those host files."""
+        if len(self.__disk_index.keys()) == 0:
+            self.refreshIndex(self.usabledirs, self.minimaltime)
+        self.__applyChanges()
+        self.__volumeHosts(initialFile)
+        self.__useInitial(initialFile)
+        # the size is only known at the end: the largest host files are filled while the
+        # data doesn't fit in one, the rest goes to the best fitting one
+        placed = []
+        writes = []
+        batches = deque()
+        pending = None
+        buffer = bytearray()
+        # blobs go to the devices in turn, a device running out leaves the rest to the others
+        device = self.__nextDevice()
+        try:
+            for piece in pieces:
+                buffer += piece
+                start = 0
+                while len(buffer) - start > self.__allocator.largest(device):
+                    host = self.__allocator.take(device)
+                    if host is None and device is not None:
+                        device = None
+                        continue
+                    if host is None:
+                        raise OSError('Not enough slack space')
+                    capacity = self.__capacity(host)
+                    pending = self.__link(writes, pending, host, bytes(buffer[start:start + capacity]))
+                    placed.append((host, capacity))
+                    start = start + capacity
+                    if len(writes) >= self.scheduler.concurrency:
+                        self.__writeAll(batches, writes, 2 * self.scheduler.concurrency)
+                        writes = []
+                # only the tail that fits in one host file stays buffered
+                del buffer[:start]
+            if buffer or not placed:
+                host = self.__allocator.bestFit(len(buffer), device)
+                if host is None and device is not None:
+                    host = self.__allocator.bestFit(len(buffer))
+                if host is None:
+                    raise OSError('Not enough slack space')
+                pending = self.__link(writes, pending, host, bytes(buffer))
+                placed.append((host, len(buffer)))
+            self.__link(writes, pending, None, None)
+            self.__writeAll(batches, writes, 0)
+        except BaseException:
+            # also when the pieces fail or stop coming, as when an imported file can't be read
+            self.scheduler.cancel(batches)
+            self.__allocator.release(host for host, length in placed)
+            raise
+        self.__reserved.update(host for host, length in placed)
+        return placed
+
+    @stats.timedStream('bmap.loadBlob')
+    def loadBlob(self, fragments):
+        """Reads a chain saved by saveBlob, yielding its bytes in order"""
+        return self.__readFragments(fragments, self.__fragmentReader())
+
+    @stats.timed('bmap.verify')
+    def verify(self, initialFile, chains=()):
+        """Checks the volume saved from initialFile and the given blob chains ([((device, inode), length)])
+        fragment by fragment, reading them in parallel without decrypting or decompressing.
+        Returns (fragments checked, [((device, inode), filename, problem)] of the damaged ones)."""
+        if len(self.__disk_index.keys()) == 0:
+            self.refreshIndex(self.usabledirs, self.minimaltime)
+        self.__applyChanges()
+        expected = []
+        damaged = []
+        tables = set()
+        try:
+            slack = self.backend.read(initialFile)
+            if not fragment.isFragment(slack):
+                raise ValueError("no fragment table, the volume is empty or saved as base64 text")
+            chunks, entries, tables = self.__readTable(slack)
+        except (OSError, KeyError, ValueError) as e:
+            damaged.append((self.__by_path.get(initialFile), initialFile, f"fragment table: {e}"))
+        else:
+            for digest, fragments in fragment.chunkFragments(entries, chunks).items():
+                expected.extend(self.__chain([(host, length) for host, rel, length in fragments]))
+        for chain in chains:
+            expected.extend(self.__chain(chain))
+        check = self.__fragmentChecker()
+        for (host, nextHost, length, sequence), problem in zip(expected, self.__sweep(check, expected)):
+            if problem is None:
+                continue
+            try:
+                filename = self.__filenameOf(host)
+            except KeyError:
+                filename = ''
+            damaged.append((host, filename, problem))
+        # the table fragments were checked while reading it
+        return len(expected) + 1 + len(tables), damaged
+
+    def fragmentsInUse(self):
+        """Number of host files holding live fragments: the volume, its table and the blobs"""
+        return len(self.__volume or ()) + len(self.__reserved) + 1
+
+    def bytes_to_human(self, num, suffix='B'):
+        for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
+            if abs(num) < 1024.0:
+                return "%3.1f%s%s" % (num, unit, suffix)
+            num /= 1024.0
+        return "%.1f%s%s" % (num, 'Yi', suffix)
+
+# Private methods
+
+    def __capacity(self, host):
+        return self.__disk_index[host]['slack'] - fragment.HEADER.size
+
+    def __link(self, writes, pending, host, payload):
+        """Packs the pending (host, payload, sequence) of a chain now that the host file of
+        the next one is known, returning the new pending one"""
+        sequence = 0
+        if pending is not None:
+            writes.append((self.__disk_index[pending[0]]['filename'],
+                fragment.pack(fragment.DATA, host, pending[1], pending[2])))
+            sequence = pending[2] + 1
+        if host is None:
+            return None
+        return (host, payload, sequence)
+
+    def __useInitial(self, initialFile):
+        """Keeps the initial file out of the free slack map"""
+        if initialFile not in self.__by_path:
+            self.__by_path.update((entry['filename'], host) for host, entry in self.__disk_index.items()
+                if entry['filename'] == initialFile)
+        if initialFile in self.__by_path:
+            self.__allocator.use([self.__by_path[initialFile]])
+
+    def __setVolume(self, volume):
+        self.__allocator.release((self.__volume or set()) - volume - self.__reserved)
+        self.__allocator.use(volume)
+        self.__volume = volume
+
+    def __place(self, size):
+        """Host files for size bytes of a chunk, on the next device in turn when there are
+        several. A chunk no device holds alone spans them."""
+        device = self.__nextDevice()
+        placed = self.__allocator.allocate(size, device) if device is not None else None
+        if placed is None:
+            placed = self.__allocator.allocate(size)
+        return placed
+
+    def __nextDevice(self):
+        """Next device with free slack, round robin, None when there is only one"""
+        devices = self.__allocator.devices()
+        if len(devices) < 2:
+            return None
+        self.__stripe = self.__stripe + 1
+        return devices[self.__stripe % len(devices)]
+
+    def __submitWrites(self, batches, writes):
+        """Schedules (filename, bytes) writes as one batch per device, each on the lane of its device"""
+        lanes = {}
+        for write in writes:
+            host = self.__by_path.get(write[0])
+            lanes.setdefault(host[0] if host is not None else None, []).append(write)
+        for device, group in lanes.items():
+            batches.append(self.scheduler.submit(self.__batchWriter(), self.__elevator(group), lane=device))
+
+    def __writeAll(self, batches, writes, limit):
+        """Schedules a batch of writes and waits until at most limit batches are pending"""
+        self.__submitWrites(batches, writes)
+        failed = []
+        self.__drain(batches, limit, [], failed)
+        if failed:
+            self.scheduler.cancel(batches)
+            raise OSError(f"unable to write slack of {', '.join(failed)}")
+
+    def __drain(self, batches, limit, written, failed):
+        """Waits for the oldest scheduled batches until at most limit are pending.
+        Returns the bytes written, the rest is cancelled if one of them raises."""
+        saved = 0
+        try:
+            while len(batches) > limit:
+                batchWritten, batchFailed, total = batches.popleft().result()
+                written.extend(batchWritten)
+                failed.extend(batchFailed)
+                saved = saved + total
+        except BaseException:
+            self.scheduler.cancel(batches)
+            batches.clear()
+            raise
+        return saved
+
+    def __batchWriter(self):
+        # the command line backend writes as asyncio subprocesses, the others in threads
+        return getattr(self.backend, 'writeBatchAsync', self.backend.writeBatch)
+
+    def __fragmentReader(self):
+        if hasattr(self.backend, 'readAsync'):
+            return self.__readFragmentAsync
+        return self.__readFragment
+
+    def __volumeHosts(self, initialFile):
+        """Host files of the volume currently saved from initialFile"""
+        if self.__volume is None:
+            try:
+                chunks, entries, tables = self.__readTable(self.backend.read(initialFile))
+                self.__setVolume(set(host for host, offset, length in entries) | tables)
+            except (OSError, KeyError, ValueError):
+                self.__setVolume(set())
+        return self.__volume
+
+    def __readTable(self, slack):
+        """Reads the fragment table starting in the given slack.
+        Returns (chunks, entries, host files of the overflow table fragments)."""
+        kind, nextHost, body = fragment.unpack(slack, 0)
+        tables = set()
+        while nextHost is not None:
+            tables.add(nextHost)
+            kind, nextHost, part = fragment.unpack(self.backend.read(self.__filenameOf(nextHost)), len(tables))
+            body = body + part
+        chunks, entries = fragment.unpackTable(body)
+        return chunks, entries, tables
+
+    def __previousChunks(self, initialFile):
+        """Chunks of the volume currently saved whose host files are still indexed"""
+        try:
+            slack = self.backend.read(initialFile)
+            if not fragment.isFragment(slack):
+                return {}
+            chunks, entries, tables = self.__readTable(slack)
+        except (OSError, KeyError, ValueError):
+            return {}
+        with self.__lock:
+            clobbered = set(self.__clobbered)
+        previous = {}
+        for digest, fragments in fragment.chunkFragments(entries, chunks).items():
+            if all(host in self.__by_host and self.__by_host[host][1] >= length + fragment.HEADER.size
+                    and host not in clobbered for host, rel, length in fragments):
+                previous[digest] = fragments
+        return previous
+
+    def __readFragments(self, fragments, read):
+        """Runs read(host, length) on the scheduler, yielding results in order"""
+        fragments = list(fragments)
+        merge = self.__readRun if hasattr(self.backend, 'readMany') else None
+        results = self.__sweep(read, fragments, merge)
+        try:
+            for (device, inode), length in fragments:
+                try:
+                    yield next(results)
+                except (OSError, KeyError, ValueError) as e:
+                    raise OSError(f"unable to read fragment in inode {inode} of device {device}: {e}")
+        finally:
+            # cancels the reads still pending when the consumer stops early
+            results.close()
+
+    def __sweep(self, function, items, merge=None):
+        """Runs function(*item) on the scheduler for items whose first field is a (device, inode),
+        yielding the results in the order of the items, like scheduler.map. Each window of
+        items is issued in ascending (device, physical block) order of the host files,
+        the next window while the consumer goes through the current one. With merge, items
+        on nearby blocks go to merge(items) as one call returning a result or the exception
+        of each. What is still pending is cancelled when one fails or the consumer stops."""
+        items = list(items)
+        windows = deque()
+        start = 0
+        try:
+            while start < len(items) or windows:
+                while start < len(items) and len(windows) < 2:
+                    windows.append(self.__issue(function, items[start:start + SWEEP_WINDOW], merge))
+                    start = start + SWEEP_WINDOW
+                futures, slots = windows[0]
+                for run, position in slots:
+                    result = futures[run].result()
+                    if position is not None:
+                        result = result[position]
+                        if isinstance(result, Exception):
+                            raise result
+                    yield result
+                windows.popleft()
+        finally:
+            for futures, slots in windows:
+                self.scheduler.cancel(futures)
+
+    def __issue(self, function, window, merge):
+        """Schedules a window of items in physical order, returning the futures and, for
+        every item, (index of its future, position in a merged result or None)"""
+        positions = self.__positions([item[0] for item in window])
+        runs = []
+        for i in sorted(range(len(window)), key=lambda i: positions[i]):
+            if merge is not None and runs and len(runs[-1]) < MAX_RUN and self.__near(positions[runs[-1][-1]], positions[i]):
+                runs[-1].append(i)
+            else:
+                runs.append([i])
+        futures = []
+        slots = [None] * len(window)
+        for run in runs:
+            # every device is read on its own lane, at the same time as the others
+            lane = window[run[0]][0][0]
+            if len(run) == 1:
+                slots[run[0]] = (len(futures), None)
+                futures.append(self.scheduler.submit(function, *window[run[0]], lane=lane))
+            else:
+                for position, i in enumerate(run):
+                    slots[i] = (len(futures), position)
+                futures.append(self.scheduler.submit(merge, [window[i] for i in run], lane=lane))
+        return futures, slots
+
+    def __elevator(self, writes):
+        """(filename, bytes) writes sorted by physical block of the host files"""
+        positions = self.__positions([self.__by_path.get(filename) for filename, data in writes])
+        return [write for position, i, write in sorted(zip(positions, range(len(writes)), writes))]
+
+    def __positions(self, hosts):
+        """Sort keys (0, device, block) of the host files' slack blocks, (1,) when unknown.
+        Blocks not in the index yet are asked to the backend and recorded."""
+        slackBlock = getattr(self.backend, 'slackBlock', None)
+        found = []
+        for host in hosts:
+            if host is None or host in self.__blocks or slackBlock is None:
+                continue
+            try:
+                block = slackBlock(self.__filenameOf(host))
+            except (OSError, KeyError):
+                block = None
+            self.__blocks[host] = block
+            if block is not None:
+                found.append((host[0], host[1], block))
+        if found:
+            self.cache.setBlocks(found)
+        positions = []
+        for host in hosts:
+            block = self.__blocks.get(host)
+            positions.append((1,) if block is None else (0, host[0], block))
+        return positions
+
+    def __near(self, previous, position):
+        return (previous[0] == 0 and position[0] == 0 and previous[1] == position[1]
+            and position[2] - previous[2] <= MERGE_GAP)
+
+    def __readRun(self, run):
+        """Reads (host, length) fragments on nearby blocks with one backend call"""
+        slacks = self.backend.readMany([self.__filenameOf(host) for host, length in run])
+        payloads = []
+        for (host, length), slack in zip(run, slacks):
+            try:
+                payloads.append(self.__payload(slack, length))
+            except ValueError as e:
+                payloads.append(e)
+        return payloads
+
+    def __readFragment(self, host, length):
+        return self.__payload(self.backend.read(self.__filenameOf(host)), length)
+
+    async def __readFragmentAsync(self, host, length):
+        return self.__payload(await self.backend.readAsync(self.__filenameOf(host)), length)
+
+    def __chain(self, fragments):
+        """(host, next host, length, sequence) expected for each fragment of a chain"""
+        return [(host, fragments[i + 1][0] if i + 1 < len(fragments) else None, length, i)
+            for i, (host, length) in enumerate(fragments)]
+
+    def __fragmentChecker(self):
+        if hasattr(self.backend, 'readAsync'):
+            return self.__checkFragmentAsync
+        return self.__checkFragment
+
+    def __checkFragment(self, host, nextHost, length, sequence):
+        try:
+            slack = self.backend.read(self.__filenameOf(host))
+        except (OSError, KeyError) as e:
+            return f"unreadable slack: {e}"
+        return fragment.check(slack, fragment.DATA, nextHost, length, sequence)
+
+    async def __checkFragmentAsync(self, host, nextHost, length, sequence):
+        try:
+            slack = await self.backend.readAsync(self.__filenameOf(host))
+        except (OSError, KeyError) as e:
+            return f"unreadable slack: {e}"
+        return fragment.check(slack, fragment.DATA, nextHost, length, sequence)
+
+    def __payload(self, slack, length):
+        kind, nextHost, payload = fragment.unpack(slack)
+        if len(payload) != length:
+            raise ValueError(f"fragment length {len(payload)} instead of {length}")
+        return payload
+
+    def __loadText(self, slack):
+        """Reads a volume saved as base64 text, as a chain of '<next inode>:<data>' fragments"""
+        slack = bytes(slack).rstrip(b'\x00\n').decode('ascii', 'ignore')
+        # these chains name their host files by inode number alone
+        files = {inode: file for (dev, inode), (file, slack_space) in self.__by_host.items()}
         nextInode = slack.split(':', 2)[0]
         encodedString = slack.split(':', 2)[1]
         while nextInode != '':
-            nextFile = self.__disk_index[nextInode]['filename']
+            nextFile = files[int(nextInode)]
             slack = self.get(nextFile)
             nextInode = slack.split(':', 2)[0]
             encodedString = encodedString + slack.split(':', 2)[1]
-        return encodedString
+        yield base64.b64decode(encodedString)
 
-    def bytes_to_human(self, num, suffix='B'):
-        for unit in ['','Ki','Mi','Gi','Ti','Pi','Ei','Zi']:
-            if abs(num) < 1024.0:
-                return "%3.1f%s%s" % (num, unit, suffix)
-            num /= 1024.0
-        return "%.1f%s%s" % (num, 'Yi', suffix)
\ No newline at end of file
+    def __batchSummary(self, written, failed, total):
+        summary = f'Saved {self.bytes_to_human(total)} in {len(written)} of {len(written) + len(failed)} fragments'
+        if failed:
+            summary = summary + f", failed: {', '.join(failed)}"
+        return summary
+
+    def __filenameOf(self, host):
+        if host in self.__disk_index:
+            return self.__disk_index[host]['filename']
+        return self.__by_host[host][0]
+
+    def __loadCache(self, days):
+        files = self.cache.files()
+        checked = []
+        for i, (dev, inode, file, mod_date, size, slack_space) in enumerate(files):
+            if slack_space is None:
+                # stat was not conclusive, ask the real block map
+                slack_space = self.getSlackSpace(file)
+                checked.append((dev, inode, slack_space))
+                files[i] = (dev, inode, file, mod_date, size, slack_space)
+        self.cache.setSlack(checked)
+        self.__files = files
+        self.__by_host = {(dev, inode): (file, slack_space) for dev, inode, file, mod_date, size, slack_space in files}
+        self.__by_path = {file: (dev, inode) for dev, inode, file, mod_date, size, slack_space in files}
+        self.__blocks = self.cache.blocks()
+        self.filterIndex(days)
+
+    def __setIndex(self, index):
+        self.__disk_index = index
+        self.__priority_list = sorted(index.keys(), key=lambda x: (index[x]['mod_date'], -index[x]['slack']))
+        self.__total_size = sum(entry['slack'] for entry in index.values())
+        self.__allocator = allocator.Allocator({host: entry['slack'] - fragment.HEADER.size
+            for host, entry in index.items() if entry['slack'] > fragment.HEADER.size})
+        self.__allocator.use(self.__reserved | (self.__volume or set()))
+
+    def __changed(self, path, written):
+        """Called from the watcher thread for every changed file"""
+        with self.__lock:
+            self.__changes[path] = self.__changes.get(path, False) or written
+            host = self.__by_path.get(path)
+            if not written or host is None or host in self.__clobbered:
+                return
+            if not (host in (self.__volume or ()) or host in self.__reserved or self.__allocator.isUsed(host)):
+                return
+            self.__clobbered[host] = path
+        if self.onClobbered is not None:
+            self.onClobbered(host, path)
+
+    def __overflow(self):
+        with self.__lock:
+            self.__rescan = True
+
+    def __applyChanges(self):
+        """Brings the loaded index up to date with what the watcher saw, without rescanning"""
+        with self.__lock:
+            changes = self.__changes
+            rescan = self.__rescan
+            self.__changes = {}
+            self.__rescan = False
+        if rescan:
+            # inotify dropped events, the cache knows which directories changed
+            self.refreshIndex(self.usabledirs, self.minimaltime)
+            return
+        if not changes:
+            return
+        roots = self.usabledirs.split()
+        gone = set()
+        fresh = []
+        for path in changes:
+            host = self.__by_path.pop(path, None)
+            if host is not None:
+                gone.add(host)
+                self.__by_host.pop(host, None)
+                self.__blocks.pop(host, None)
+            try:
+                st = os.stat(path, follow_symlinks=False)
+            except OSError:
+                continue
+            if not stat.S_ISREG(st.st_mode) or not indexcache.underRoots(path, roots):
+                continue
+            dev, ino, file, mod_date, size, slack_space = indexer.fileEntry(path, st)
+            if slack_space is None:
+                slack_space = self.getSlackSpace(path)
+            fresh.append((dev, ino, file, mod_date, size, slack_space))
+        self.__files = [entry for entry in self.__files if (entry[0], entry[1]) not in gone] + fresh
+        self.__by_host.update(((dev, inode), (file, slack_space)) for dev, inode, file, mod_date, size, slack_space in fresh)
+        self.__by_path.update((file, (dev, inode)) for dev, inode, file, mod_date, size, slack_space in fresh)
+        self.cache.update(list(gone), fresh)
+        # files modified since are now too young and drop out of the index
+        self.filterIndex(self.minimaltime)
+
+    def __filesPerSecond(self, files, elapsed):
+        return f"{files} files in {elapsed:.1f}s ({files / max(elapsed, 1e-6):.0f} files/s)"
@@ -0,0 +1,66 @@
+#!/usr/bin/env python3
+
+import hashlib
+
+MIN_SIZE = 4096
+AVG_SIZE = 16384
+MAX_SIZE = 65536
+
+MASK64 = (1 << 64) - 1
+
+# Bytes of the hash keying deduplicated chunks, long enough that two chunks never share one
+STRONG_SIZE = 32
+
+# Fixed gear table, boundaries must land in the same place on every run
+GEAR = [int.from_bytes(hashlib.blake2b(bytes([i]), digest_size=8).digest(), 'little') for i in range(256)]
+
+def boundary(data, start, end, min_size=MIN_SIZE, avg_size=AVG_SIZE):
+    """Position of the first content-defined boundary in data[start:end], end if there is none"""
+    mask = (1 << (avg_size.bit_length() - 1)) - 1
+    mask = mask << (64 - mask.bit_length())
+    gear = GEAR
+    h = 0
+    for i in range(start + min_size, end):
+        h = ((h << 1) + gear[data[i]]) & MASK64
+        if not h & mask:
+            return i + 1
+    return end
+
+def chunks(data, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """Splits bytes in content-defined chunks with a gear rolling hash, yielding (offset, length).
+    A change in the data only moves the boundaries around it."""
+    size = len(data)
+    start = 0
+    while start < size:
+        cut = boundary(data, start, min(start + max_size, size), min_size, avg_size)
+        yield start, cut - start
+        start = cut
+
+def stream(pieces, min_size=MIN_SIZE, avg_size=AVG_SIZE, max_size=MAX_SIZE):
+    """Same chunks as chunks() over an iterable of bytes, yielding (offset, chunk) as soon
+    as each one is cut. At most max_size bytes are buffered."""
+    buffer = bytearray()
+    offset = 0
+    for piece in pieces:
+        buffer += piece
+        start = 0
+        while len(buffer) - start >= max_size:
+            cut = boundary(buffer, start, start + max_size, min_size, avg_size)
+            yield offset, bytes(buffer[start:cut])
+            offset = offset + cut - start
+            start = cut
+        del buffer[:start]
+    start = 0
+    while start < len(buffer):
+        cut = boundary(buffer, start, min(start + max_size, len(buffer)), min_size, avg_size)
+        yield offset, bytes(buffer[start:cut])
+        offset = offset + cut - start
+        start = cut
+
+def digest(data):
+    """Hash identifying a chunk of the volume"""
+    return hashlib.blake2b(data, digest_size=8).hexdigest()
+
+def strongDigest(data):
+    """Hash keying a chunk of file contents in the deduplicated chunk store"""
+    return hashlib.blake2b(data, digest_size=STRONG_SIZE).digest()
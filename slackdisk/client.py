@@ -0,0 +1,105 @@
+#!/usr/bin/env python3
+
+"""
+Thin client of the SlackDisk daemon: sends console command lines over its
+Unix socket and prints what they write. It only needs the standard library,
+the index, key and file tree stay in the daemon.
+
+    ./main.py                 prompt sending every line to the daemon
+    ./main.py ls              one command, exit status 1 if it failed
+"""
+
+import os
+import shlex
+import socket
+import sys
+from . import protocol
+
+# Lines ending the client, the daemon keeps running (shutdown stops it)
+QUIT = ('quit', 'exit', 'q', 'eof')
+
+class Client():
+    """Connection to a running daemon"""
+    def __init__(self, path=protocol.DEFAULT_SOCKET):
+        self.path = path
+        self.__sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        try:
+            self.__sock.connect(path)
+        except OSError:
+            self.__sock.close()
+            raise
+
+    def run(self, line, write=None):
+        """Runs a command line in the daemon, passing what it writes to write (stdout by default).
+        Returns the daemon's error message, empty when the command ran."""
+        write = write or sys.stdout.write
+        protocol.send(self.__sock, protocol.REQUEST, protocol.request(line, os.getcwd()))
+        while True:
+            frame = protocol.receive(self.__sock)
+            if frame is None:
+                raise ConnectionError("the daemon closed the connection")
+            kind, payload = frame
+            if kind == protocol.OUTPUT:
+                write(payload.decode('utf-8', 'replace'))
+            elif kind == protocol.END:
+                return payload.decode('utf-8', 'replace')
+
+    def close(self):
+        self.__sock.close()
+
+def running(path=protocol.DEFAULT_SOCKET):
+    """Tells if a daemon is listening on path"""
+    if not os.path.exists(path):
+        return False
+    try:
+        Client(path).close()
+    except OSError:
+        return False
+    return True
+
+def interact(client):
+    """Prompt sending every line to the daemon until quit or end of input"""
+    try:
+        # line editing and history for input()
+        import readline
+    except ImportError:
+        pass
+    while True:
+        try:
+            line = input('slack> ')
+        except EOFError:
+            print()
+            return 0
+        except KeyboardInterrupt:
+            print()
+            continue
+        if line.strip().lower() in QUIT:
+            return 0
+        if not line.strip():
+            continue
+        error = client.run(line)
+        if error:
+            print(error, file=sys.stderr)
+        if line.split()[0] == 'shutdown':
+            return 0
+
+def main(path, argv):
+    """Runs argv as one command in the daemon, or a prompt without arguments"""
+    try:
+        client = Client(path)
+    except OSError as e:
+        print(f"Unable to reach the daemon on {path}: {e}", file=sys.stderr)
+        return 1
+    try:
+        if not argv:
+            return interact(client)
+        error = client.run(shlex.join(argv))
+        if error:
+            print(error, file=sys.stderr)
+            return 1
+        return 0
+    except (OSError, ValueError) as e:
+        print(f"Lost the daemon: {e}", file=sys.stderr)
+        return 1
+    finally:
+        client.close()
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+Compression codecs, identified by the one byte id stored in front of the data.
+
+probe() picks a codec from a sample: already compressed data (archives,
+images, encrypted blobs) is stored as is, text-heavy data goes to lzma and
+everything else to zlib.
+"""
+
+import bz2
+import lzma
+import zlib
+
+STORE = 0
+ZLIB_FAST = 1
+ZLIB = 2
+ZLIB_BEST = 3
+LZMA = 4
+BZ2 = 5
+
+# Bytes looked at by probe(), taken from the start, middle and end of the data
+SAMPLE_SIZE = 65536
+
+# zlib level 1 ratios deciding the codec in probe()
+STORE_RATIO = 0.95
+TEXT_RATIO = 0.4
+
+class Store():
+    """Codec that leaves the data as it is"""
+    def compress(self, data):
+        return bytes(data)
+
+    def decompress(self, data, max_length=-1):
+        return bytes(data)
+
+    def flush(self):
+        return b''
+
+class Codec():
+    def __init__(self, id, name, compressor, decompressor):
+        self.id = id
+        self.name = name
+        self.compressor = compressor
+        self.decompressor = decompressor
+
+CODECS = {
+    STORE: Codec(STORE, 'store', Store, Store),
+    ZLIB_FAST: Codec(ZLIB_FAST, 'zlib-1', lambda: zlib.compressobj(level=1), zlib.decompressobj),
+    ZLIB: Codec(ZLIB, 'zlib-6', lambda: zlib.compressobj(level=6), zlib.decompressobj),
+    ZLIB_BEST: Codec(ZLIB_BEST, 'zlib-9', lambda: zlib.compressobj(level=9), zlib.decompressobj),
+    LZMA: Codec(LZMA, 'lzma', lzma.LZMACompressor, lzma.LZMADecompressor),
+    BZ2: Codec(BZ2, 'bz2', lambda: bz2.BZ2Compressor(9), bz2.BZ2Decompressor),
+}
+
+def get(id):
+    """Codec for an id, raises ValueError for unknown ones"""
+    if id not in CODECS:
+        raise ValueError(f"unknown codec {id}")
+    return CODECS[id]
+
+def byName(name):
+    """Codec for a name like 'zlib-9' or 'lzma', None if there is none"""
+    for codec in CODECS.values():
+        if codec.name == name:
+            return codec
+    return None
+
+def sample(data, size=SAMPLE_SIZE):
+    """Up to size bytes from the start, middle and end of data"""
+    if len(data) <= size:
+        return bytes(data)
+    third = size // 3
+    middle = (len(data) - third) // 2
+    return bytes(data[:third]) + bytes(data[middle:middle + third]) + bytes(data[-third:])
+
+def probe(data):
+    """Picks a codec id for data with a quick zlib pass over a sample of it"""
+    piece = sample(data)
+    if len(piece) == 0:
+        return STORE
+    ratio = len(zlib.compress(piece, 1)) / len(piece)
+    if ratio >= STORE_RATIO:
+        return STORE
+    if ratio <= TEXT_RATIO:
+        return LZMA
+    return ZLIB_BEST
+
+def inflate(decompressor, data, max_length):
+    """Decompresses without letting a highly compressed input expand all at once"""
+    if isinstance(decompressor, Store):
+        if data:
+            yield bytes(data)
+        return
+    if hasattr(decompressor, 'unconsumed_tail'):
+        while data:
+            out = decompressor.decompress(data, max_length)
+            data = decompressor.unconsumed_tail
+            if out:
+                yield out
+        return
+    out = decompressor.decompress(data, max_length)
+    if out:
+        yield out
+    while not decompressor.eof and not decompressor.needs_input:
+        out = decompressor.decompress(b'', max_length)
+        if out:
+            yield out
+
+def finish(decompressor):
+    """Whatever output a decompressor still holds once the input is over"""
+    if hasattr(decompressor, 'flush') and not isinstance(decompressor, Store):
+        return decompressor.flush()
+    return b''
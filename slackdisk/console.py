@@ -1,8 +1,11 @@
 #!/usr/bin/env python3
 
+import os
+import subprocess
+import time
 import cmd2
 from cmd2 import style
-from . import bmap, filetree, encoder
+from . import bmap, backend, indexcache, filetree, encoder, encrypter, blobstore, stats
 
 class Console(cmd2.Cmd):
     def __init__(self):
@@ -16,21 +19,28 @@ class Console(cmd2.Cmd):
         
         self.usabledirs = '/bin /etc /home /lib /lib32 /lib64 /opt /root'
         self.initialfile = '/bin/bash'
+        self.image = ''
         self.password = 'slackdisk'
+        self.session = encrypter.Session(self.password)
         self.tree = filetree.Filetree() 
         self.bmap = bmap.Bmap()
         self.encoder = encoder.Encoder()
+        self.tree.store = blobstore.BlobStore(self.bmap, self.encoder, self.initialfile)
         self.statement_parser.aliases = {
             'exit': 'quit',
             'q': 'quit',
-            'h': 'help'
+            'h': 'help',
+            'scrub': 'verify'
             }
         self.minimaltime = '100' # days
+        self.concurrency = '16'
         self.prompt = style("slack> ", fg='blue')
         self.settable['usabledirs'] = "Directories to save hidden file system, separated by spaces."
         self.settable['minimaltime'] = "Minimal time (in days) that the file must not have been modified"
         self.settable['password'] = "Password used to encrypt the file system on slack space"
         self.settable['initialfile'] = "File to save (or load) the beginning of the file system on slack space"
+        self.settable['image'] = "Unmounted ext2/3/4 image or device to work on instead of the mounted file systems (empty for none)"
+        self.settable['concurrency'] = "Fragment reads and writes running at the same time"
         self.intro = style(r"""
    _____ _            _    _____  _     _    
   / ____| |          | |  |  __ \(_)   | |   
@@ -85,7 +95,10 @@ class Console(cmd2.Cmd):
         else:
             filepath = args[0]
             name = args[1]
-            self.poutput(self.tree.putFile(filepath, name))
+            try:
+                self.poutput(self.tree.putFile(filepath, name, self.__progress('put')))
+            except OSError as e:
+                self.poutput(f'\n{e}')
 
     def do_get(self, args):
         """
@@ -98,11 +111,32 @@ class Console(cmd2.Cmd):
         else:
             name = args[0]
             filepath = args[1]
-            self.poutput(self.tree.getFile(name, filepath))
+            try:
+                self.poutput(self.tree.getFile(name, filepath, self.__progress('get')))
+            except OSError as e:
+                self.poutput(f'\n{e}')
 
     def do_cat(self,file):
-        """Prints a file content on screen"""
-        self.poutput(self.tree.catFile(file))
+        """Prints a file content on screen, through the pager on a terminal"""
+        pieces = self.tree.catStream(file)
+        try:
+            # not a terminal when run by the daemon for a client
+            if not self.stdout.isatty():
+                for piece in pieces:
+                    self.stdout.write(piece)
+                self.stdout.write('\n')
+                return
+            pager = subprocess.Popen(os.environ.get('PAGER', 'less -FRX'), shell=True, stdin=subprocess.PIPE)
+            try:
+                for piece in pieces:
+                    pager.stdin.write(piece.encode('utf-8'))
+                pager.stdin.close()
+            except BrokenPipeError:
+                # the pager was quit before the end
+                pass
+            pager.wait()
+        except OSError as e:
+            self.poutput(str(e))
 
     def do_rm(self,file):
         """Removes a file"""
@@ -112,6 +146,13 @@ class Console(cmd2.Cmd):
         """Gets available slack space in the usable directories (total)"""
         self.poutput(self.bmap.total(self.usabledirs, self.minimaltime))
 
+    def do_dedup(self, args):
+        """Shows how much the chunk store saves: bytes of the file contents against bytes of their distinct chunks"""
+        dedup = self.tree.store.dedup()
+        self.poutput(f"{dedup['chunks']} chunks, {dedup['references']} references")
+        self.poutput(f"{dedup['logical']} bytes of contents stored as {dedup['stored']} bytes of chunks "
+            f"({dedup['slack']} bytes of slack), dedup ratio {dedup['ratio']:.2f}")
+
     def do_bmap(self, args):
         """Using bmap's functions. Type bmap help to get command help."""
         args = args.arg_list
@@ -136,35 +177,95 @@ class Console(cmd2.Cmd):
             self.poutput(self.bmap.help())
     
     def do_index(self, args):
-        """Index disk"""
-        self.poutput(self.bmap.indexDisk(self.usabledirs, self.minimaltime))
+        """
+        Index disk
+        Usage: index [shell]
+        """
+        if args.strip() == 'shell':
+            self.poutput(self.bmap.indexDiskShell(self.usabledirs, self.minimaltime))
+        else:
+            self.poutput(self.bmap.indexDisk(self.usabledirs, self.minimaltime))
 
     def do_save(self, args):
         """Save current file system to slack space"""
-        encoded = self.tree.encodeFiletree(self.password)
-        self.bmap.save(encoded, self.initialfile)
+        try:
+            encoded = self.tree.encodeFiletree(self.session)
+            self.poutput(self.bmap.save(encoded, self.initialfile))
+        except OSError as e:
+            self.poutput(str(e))
 
     def do_load(self, args):
         """Load file system from slack space"""
-        encoded = self.bmap.load(self.initialfile)
-        self.tree.loadFileTree(encoded, self.password)
+        encoded = self.bmap.loadStream(self.initialfile)
+        self.tree.loadFileTree(encoded, self.session)
+
+    def do_verify(self, args):
+        """Checks every fragment of the saved volume and of the loaded file contents, without decoding them"""
+        try:
+            checked, damaged = self.bmap.verify(self.initialfile, [blob.fragments for blob in self.tree.blobs()])
+        except OSError as e:
+            self.poutput(str(e))
+            return
+        for host, filename, problem in damaged:
+            inode = host[1] if host is not None else '?'
+            self.poutput(f'inode {inode} {filename}: {problem}')
+        self.poutput(f'{checked} fragments checked, {len(damaged)} damaged')
 
     def do_savestring(self, data):
         """Save arbitrary string to slack space"""
-        self.bmap.save(data, self.initialfile)
+        self.poutput(self.bmap.save(data.encode(), self.initialfile))
 
     def do_loadstring(self, args):
         """Load arbitrary string to from slack space"""
         loaded = self.bmap.load(self.initialfile)
-        self.poutput(loaded)
+        self.poutput(loaded.decode('utf-8', 'replace'))
 
     def do_encode(self, args):
-        """Encode file tree"""
-        encoded = self.tree.encodeFiletree(self.password)
+        """Encode file tree, printing it in base64"""
+        encoded = b''.join(self.tree.encodeFiletree(self.session))
+        self.poutput(self.encoder.base64encode(encoded).decode('ascii'))
 
     def do_decode(self, data):
-        """Decode file tree"""
-        self.tree.loadFileTree(data, self.password)
+        """Decode file tree from base64"""
+        self.tree.loadFileTree(self.encoder.base64decode(data), self.session)
+
+    def do_stats(self, args):
+        """
+        Shows calls, bytes, fragments and latencies of the hot paths
+        Usage: stats [on|off|reset|json <file>]
+        """
+        args = args.arg_list
+        if len(args) == 0:
+            self.poutput(stats.report())
+        elif args[0] == 'on':
+            stats.enable(True)
+        elif args[0] == 'off':
+            stats.enable(False)
+        elif args[0] == 'reset':
+            stats.reset()
+        elif args[0] == 'json' and len(args) == 2:
+            stats.export(args[1])
+        else:
+            self.poutput('Usage: stats [on|off|reset|json <file>]')
+
+    def do_watch(self, args):
+        """
+        Keeps the slack index live with inotify, flagging in-use host files that get overwritten
+        Usage: watch [on|off]
+        """
+        args = args.arg_list
+        if len(args) == 0:
+            self.poutput('Watcher running' if self.bmap.watching() else 'Watcher not running')
+            for (device, inode), filename in self.bmap.clobbered().items():
+                self.poutput(f'Slack of {filename} (inode {inode}) was overwritten, save again')
+        elif args[0] == 'on':
+            self.bmap.onClobbered = lambda host, filename: self.poutput(
+                f'\nWarning: slack of {filename} (inode {host[1]}) was overwritten, save again')
+            self.poutput(self.bmap.watch(True))
+        elif args[0] == 'off':
+            self.poutput(self.bmap.watch(False))
+        else:
+            self.poutput('Usage: watch [on|off]')
 
     def do_print(self, args):
         """Print file tree"""
@@ -172,13 +273,75 @@ class Console(cmd2.Cmd):
         
     def do_quit(self, arg):
         """Exits the application"""
+        self.bmap.close()
+        self.session.close()
         print("Bye")
         return True
 
+    def _onchange_password(self, old, new):
+        """Hook to be called when the password is changed"""
+        self.session.setPassword(new)
+
+    def _onchange_initialfile(self, old, new):
+        """Hook to be called when the initial file is changed"""
+        self.tree.store.initialfile = new
+
+    def _onchange_image(self, old, new):
+        """Hook to be called when the image is changed"""
+        try:
+            if new:
+                # the index of an image lives only as long as the session
+                disk = bmap.Bmap(backend.ImageBackend(new), indexcache.IndexCache(':memory:'), int(self.concurrency))
+            else:
+                disk = bmap.Bmap(concurrency=int(self.concurrency))
+        except OSError as e:
+            self.poutput(str(e))
+            return
+        self.bmap.close()
+        self.bmap = disk
+        self.bmap.minimaltime = self.minimaltime
+        self.bmap.usabledirs = self.usabledirs
+        self.tree.store.bmap = self.bmap
+
+    def _onchange_usabledirs(self, old, new):
+        """Hook to be called when the usable directories are changed"""
+        self.bmap.usabledirs = new
+        if self.bmap.watching():
+            # the watcher follows the new directories
+            self.bmap.watch(False)
+            self.poutput(self.bmap.watch(True))
+
     def _onchange_minimaltime(self, old, new):
         """Hook to be called when minimal time is changed"""
-        # TODO: redo indexing
-        print(old, new)
+        self.bmap.minimaltime = new
+        self.poutput(self.bmap.filterIndex(new))
+
+    def _onchange_concurrency(self, old, new):
+        """Hook to be called when the concurrency is changed"""
+        try:
+            concurrency = int(new)
+        except ValueError:
+            concurrency = 0
+        if concurrency < 1:
+            self.poutput('Concurrency must be a positive number')
+            self.concurrency = old
+            return
+        self.bmap.scheduler.concurrency = concurrency
+
+# Private methods
+
+    def __progress(self, label):
+        """Callback showing bytes done, total and throughput on one line"""
+        start = time.monotonic()
+
+        def show(done, total):
+            rate = done / max(time.monotonic() - start, 1e-6)
+            human = self.bmap.bytes_to_human
+            self.stdout.write(f'\r{label}: {human(done)} of {human(total)} ({human(rate)}/s)')
+            if done >= total:
+                self.stdout.write('\n')
+            self.stdout.flush()
+        return show
 
 def new():
     app = Console()
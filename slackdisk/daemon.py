@@ -0,0 +1,183 @@
+#!/usr/bin/env python3
+
+"""
+SlackDisk daemon: keeps one console session (slack index, derived key, file
+tree and blob cache) in memory and runs the command lines clients send to its
+Unix socket, so repeated operations skip the cold start of a new process.
+
+    sudo ./main.py serve [--socket PATH] [--set NAME=VALUE]... [--load]
+
+Commands run one at a time in the shared session (current directory and
+settings included), their output streamed back as it is written. Anyone able
+to connect can read and change the hidden volume, the socket is created
+accessible to the daemon's user only. See protocol for the frames.
+"""
+
+import argparse
+import contextlib
+import os
+import shlex
+import signal
+import socket
+import sys
+import threading
+from . import console, client, protocol
+
+class Output():
+    """File-like object sending what a command writes to its client as OUTPUT frames"""
+    def __init__(self, sock):
+        self.sock = sock
+
+    def write(self, text):
+        data = text.encode('utf-8', 'replace')
+        for start in range(0, len(data), protocol.MAX_FRAME):
+            protocol.send(self.sock, protocol.OUTPUT, data[start:start + protocol.MAX_FRAME])
+        return len(text)
+
+    def flush(self):
+        pass
+
+    def isatty(self):
+        return False
+
+class Daemon():
+    """Serves a console session on a Unix socket, one thread per client"""
+    def __init__(self, path=protocol.DEFAULT_SOCKET, session=None):
+        self.path = path
+        self.console = session or console.Console()
+        self.__sock = None
+        self.__lock = threading.Lock()
+        self.__stopping = threading.Event()
+        self.__closed = False
+
+    def run(self, line, cwd, output):
+        """Runs a console command line, what it writes going to output.
+        Relative paths of the command are taken from cwd. Returns an error message or ''."""
+        with self.__lock:
+            if self.__closed:
+                return 'The daemon is stopping'
+            if cwd:
+                try:
+                    os.chdir(cwd)
+                except OSError as e:
+                    return f'Unable to use the client directory: {e}'
+            previous = self.console.stdout
+            self.console.stdout = output
+            try:
+                with contextlib.redirect_stdout(output), contextlib.redirect_stderr(output):
+                    self.console.onecmd_plus_hooks(line)
+            except OSError:
+                # the client went away while the command was writing
+                raise
+            except Exception as e:
+                return str(e)
+            finally:
+                self.console.stdout = previous
+        return ''
+
+    def serve(self):
+        """Accepts clients until stop"""
+        if os.path.exists(self.path):
+            if client.running(self.path):
+                raise OSError(f"a daemon is already listening on {self.path}")
+            # left over by a daemon that didn't stop cleanly
+            os.unlink(self.path)
+        sock = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        umask = os.umask(0o077)
+        try:
+            sock.bind(self.path)
+        finally:
+            os.umask(umask)
+        sock.listen()
+        self.__sock = sock
+        try:
+            while not self.__stopping.is_set():
+                try:
+                    conn, address = sock.accept()
+                except OSError:
+                    if self.__stopping.is_set():
+                        break
+                    raise
+                threading.Thread(target=self.__handle, args=(conn,), daemon=True).start()
+        finally:
+            self.close()
+
+    def stop(self):
+        """Makes serve return, from any thread or a signal handler"""
+        self.__stopping.set()
+        if self.__sock is not None:
+            try:
+                self.__sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+    def close(self):
+        """Stops listening and ends the session, releasing the slack backend"""
+        self.stop()
+        with self.__lock:
+            if self.__closed:
+                return
+            self.__closed = True
+            if self.__sock is not None:
+                self.__sock.close()
+                with contextlib.suppress(OSError):
+                    os.unlink(self.path)
+            self.console.do_quit('')
+
+# Private methods
+
+    def __handle(self, conn):
+        with conn:
+            try:
+                while True:
+                    frame = protocol.receive(conn)
+                    if frame is None:
+                        return
+                    kind, payload = frame
+                    if kind != protocol.REQUEST:
+                        protocol.send(conn, protocol.END, f'unexpected frame type {kind}')
+                        return
+                    line, cwd = protocol.parseRequest(payload)
+                    words = line.split()
+                    command = words[0].lower() if words else ''
+                    if command in client.QUIT:
+                        protocol.send(conn, protocol.END, '')
+                        return
+                    if command == 'shutdown':
+                        protocol.send(conn, protocol.OUTPUT, 'Daemon stopped\n')
+                        protocol.send(conn, protocol.END, '')
+                        self.stop()
+                        return
+                    protocol.send(conn, protocol.END, self.run(line, cwd, Output(conn)))
+            except (OSError, ValueError) as e:
+                print(f'Client dropped: {e}', file=sys.__stderr__)
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(prog='slackdisk serve',
+        description='Keeps a SlackDisk session in memory and serves it on a Unix socket')
+    parser.add_argument('--socket', default=os.environ.get('SLACKDISK_SOCKET', protocol.DEFAULT_SOCKET),
+        help='path of the socket (default: $SLACKDISK_SOCKET or %(default)s)')
+    parser.add_argument('--set', action='append', default=[], metavar='NAME=VALUE',
+        help='console setting applied at start (usabledirs, initialfile, image...), can be repeated')
+    parser.add_argument('--load', action='store_true', help='load the hidden file system at start')
+    args = parser.parse_args(argv)
+    daemon = Daemon(args.socket)
+    for setting in args.set:
+        name, separator, value = setting.partition('=')
+        daemon.run(f'set {name} {shlex.quote(value)}', None, sys.stdout)
+    # index the usable directories now rather than on the first request
+    daemon.run('total', None, sys.stdout)
+    if args.load:
+        daemon.run('load', None, sys.stdout)
+    signal.signal(signal.SIGTERM, lambda signum, frame: daemon.stop())
+    print(f'Serving on {args.socket}')
+    try:
+        daemon.serve()
+    except KeyboardInterrupt:
+        pass
+    except OSError as e:
+        print(e, file=sys.stderr)
+        return 1
+    finally:
+        daemon.close()
+    return 0
@@ -1,9 +1,24 @@
 #!/usr/bin/env python3
 
+import io
+import itertools
 import pickle
+import queue
+import struct
+import threading
 import zlib
 import base64
-from . import encrypter
+from . import encrypter, compression, stats
+
+# Size of the pieces going through the streaming pipeline
+STREAM_CHUNK = 65536
+
+# Encoded data made of independently encrypted chunks starts with this magic and
+# the compression codec id, each chunk is a big endian u32 length followed by
+# encrypter.Session.encryptChunk's output
+CODEC_MAGIC = b'SDC2'
+FRAME = struct.Struct('>I')
+
 class Encoder():
     def __init__(self):
         """Encoder class constructor"""
@@ -24,37 +39,211 @@ class Encoder():
         """Decrypt a string using AES"""
         return encrypter.decrypt(key, data)
 
-    def compress(self, data):
-        """Compress a string using gzip"""
-        compressed = zlib.compress(data, level=9)
+    @stats.timed('encoder.compress', bytes_in=lambda self, data, codec=None: len(data), bytes_out=len)
+    def compress(self, data, codec=None):
+        """Compress a string with the given codec id (probed when None), the id goes first"""
+        if codec is None:
+            codec = compression.probe(data)
+        compressor = compression.get(codec).compressor()
+        compressed = bytes([codec]) + compressor.compress(data) + compressor.flush()
         return(compressed)
-    
+
+    @stats.timed('encoder.decompress', bytes_in=lambda self, data: len(data), bytes_out=len)
     def decompress(self, data):
-        """Decompress a string using gzip"""
-        decompressed = zlib.decompress(data)
+        """Decompress a string made by compress (or plain zlib data)"""
+        if len(data) == 0:
+            raise ValueError("no data to decompress")
+        if data[0] not in compression.CODECS:
+            return zlib.decompress(data)
+        decompressor = compression.get(data[0]).decompressor()
+        decompressed = decompressor.decompress(data[1:]) + compression.finish(decompressor)
         return decompressed
 
     def encode(self, data, key):
-        """Compress and encrypt a string, returning it encoded using base64"""
+        """Compress and encrypt a string, returning the encrypted bytes"""
         try:
             databyte = data.encode()
-        except:
+        except AttributeError:
             databyte = data
-        finally:
-            encoded = base64.b64encode(self.encrypt(self.compress(databyte), key))
-            print(f"Original size {len(data)}")
-            print(f"Encoded size {len(encoded)}")
-            return encoded.decode('ascii')
+        return b''.join(self.encode_stream([databyte], key))
 
     def decode(self, data, key):
-        """Decrypt and decompress a base64 encoded string"""
-        return self.decompress(self.decrypt(base64.b64decode(data), key))
+        """Decrypt and decompress encrypted bytes"""
+        return b''.join(self.decode_stream([data], key))
+
+    @stats.timedStream('encoder.encode_stream')
+    def encode_stream(self, pieces, key, chunk_size=STREAM_CHUNK, report=True, codec=None):
+        """Compress and encrypt an iterable of bytes, yielding encrypted bytes.
+        Only a few chunks of the volume are held at a time.
+        key is a password or an encrypter.Session. The compression codec id is
+        probed on the first bytes when not given."""
+        session = self.__session(key)
+        pieces = iter(pieces)
+        if codec is None:
+            head = []
+            size = 0
+            for piece in pieces:
+                head.append(piece)
+                size = size + len(piece)
+                if size >= compression.SAMPLE_SIZE:
+                    break
+            codec = compression.probe(b''.join(head))
+            pieces = itertools.chain(head, pieces)
+        sizes = [0, 0]
+        yield CODEC_MAGIC + bytes([codec])
+        for data in session.encryptChunks(self.__deflate(pieces, chunk_size, codec, sizes)):
+            yield FRAME.pack(len(data)) + data
+        if report:
+            print(f"Original size {sizes[0]}")
+            print(f"Encoded size {sizes[1]} ({compression.get(codec).name})")
+
+    @stats.timedStream('encoder.decode_stream')
+    def decode_stream(self, pieces, key, chunk_size=STREAM_CHUNK):
+        """Decrypt and decompress an iterable of encrypted bytes, yielding bytes.
+        Volumes encrypted as a single stream before chunking are still read."""
+        session = self.__session(key)
+        pieces = iter(pieces)
+        head = b''
+        while len(head) < len(CODEC_MAGIC) + 1:
+            piece = next(pieces, None)
+            if piece is None:
+                break
+            head = head + piece
+        if head.startswith(CODEC_MAGIC):
+            if len(head) <= len(CODEC_MAGIC):
+                raise ValueError("truncated encoded data, the codec id is missing")
+            decompressor = compression.get(head[len(CODEC_MAGIC)]).decompressor()
+            frames = self.__frames(itertools.chain([head[len(CODEC_MAGIC) + 1:]], pieces))
+        else:
+            decompressor = zlib.decompressobj()
+            cipher = session.cipher()
+            for piece in itertools.chain([head], pieces):
+                yield from compression.inflate(decompressor, cipher.decrypt(piece), chunk_size)
+            yield decompressor.flush()
+            return
+        for data in session.decryptChunks(frames):
+            yield from compression.inflate(decompressor, data, chunk_size)
+        yield compression.finish(decompressor)
 
     def encodeTree(self, tree, key):
         """Encode a python dictionary object"""
-        return self.encode(pickle.dumps(tree), key)
+        return b''.join(self.encodeTreeStream(tree, key))
 
     def decodeTree(self, encoded, key):
         """Decode a encoded python dictionary object"""
-        decoded = self.decode(encoded, key)
-        return pickle.loads(decoded)
+        return self.decodeTreeStream([encoded], key)
+
+    def encodeTreeStream(self, tree, key):
+        """Encode a python dictionary object, yielding encrypted bytes as they are ready"""
+        return self.encode_stream(self.__pickleStream(tree), key)
+
+    @stats.timed('encoder.decodeTree')
+    def decodeTreeStream(self, pieces, key):
+        """Decode a python dictionary object from an iterable of encrypted bytes"""
+        return self.unpickleStream(self.decode_stream(pieces, key))
+
+    def unpickleStream(self, pieces):
+        """Unpickles an iterable of decrypted bytes"""
+        return pickle.load(io.BufferedReader(StreamReader(pieces)))
+
+# Private methods
+
+    def __session(self, key):
+        if isinstance(key, encrypter.Session):
+            return key
+        return encrypter.Session(key)
+
+    def __deflate(self, pieces, chunk_size, codec, sizes):
+        """Compresses an iterable of bytes, yielding the output regrouped in
+        encrypter.CHUNK_SIZE pieces. sizes gets the original and compressed lengths."""
+        compressor = compression.get(codec).compressor()
+        buffer = bytearray()
+        for piece in pieces:
+            view = memoryview(piece)
+            sizes[0] = sizes[0] + len(view)
+            for start in range(0, len(view), chunk_size):
+                data = compressor.compress(view[start:start + chunk_size])
+                sizes[1] = sizes[1] + len(data)
+                buffer += data
+                while len(buffer) >= encrypter.CHUNK_SIZE:
+                    yield bytes(buffer[:encrypter.CHUNK_SIZE])
+                    del buffer[:encrypter.CHUNK_SIZE]
+        data = compressor.flush()
+        sizes[1] = sizes[1] + len(data)
+        buffer += data
+        while buffer:
+            yield bytes(buffer[:encrypter.CHUNK_SIZE])
+            del buffer[:encrypter.CHUNK_SIZE]
+
+    def __frames(self, pieces):
+        """Splits a byte stream back into the encrypted chunks it was framed from"""
+        buffer = bytearray()
+        for piece in pieces:
+            buffer += piece
+            while len(buffer) >= FRAME.size:
+                length, = FRAME.unpack_from(buffer)
+                if len(buffer) < FRAME.size + length:
+                    break
+                yield bytes(buffer[FRAME.size:FRAME.size + length])
+                del buffer[:FRAME.size + length]
+        if buffer:
+            raise ValueError("truncated encrypted chunk")
+
+    @stats.timedStream('encoder.pickle')
+    def __pickleStream(self, tree):
+        """Pickles in a producer thread, yielding the pickle's pieces through a bounded queue"""
+        pieces = queue.Queue(maxsize=4)
+        failure = []
+
+        def produce():
+            try:
+                pickle.dump(tree, QueueWriter(pieces))
+            except Exception as e:
+                failure.append(e)
+            finally:
+                pieces.put(None)
+
+        threading.Thread(target=produce, daemon=True).start()
+        done = False
+        try:
+            while True:
+                piece = pieces.get()
+                if piece is None:
+                    done = True
+                    break
+                yield piece
+        finally:
+            # unblock the producer if the consumer gave up early
+            while not done:
+                done = pieces.get() is None
+        if failure:
+            raise failure[0]
+
+class QueueWriter():
+    """File-like object handing every write to a queue"""
+    def __init__(self, pieces):
+        self.pieces = pieces
+
+    def write(self, data):
+        self.pieces.put(bytes(data))
+        return len(data)
+
+class StreamReader(io.RawIOBase):
+    """Readable raw stream over an iterable of bytes"""
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.pending = memoryview(b'')
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self.pending:
+            piece = next(self.pieces, None)
+            if piece is None:
+                return 0
+            self.pending = memoryview(piece)
+        size = min(len(buffer), len(self.pending))
+        buffer[:size] = self.pending[:size]
+        self.pending = self.pending[size:]
+        return size
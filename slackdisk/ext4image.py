@@ -0,0 +1,246 @@
+#!/usr/bin/env python3
+
+"""
+Read and write access to an ext2/3/4 file system image (or an unmounted block
+device) without mounting it: the image is mapped in memory and the superblock,
+group descriptors, inode tables, directories and extent trees (or the indirect
+blocks of ext2/3) are parsed directly. Slack regions come out as memoryview
+slices of the mapping, no copy and no system call involved.
+
+Only use it on file systems that are not mounted, the kernel wouldn't see the
+writes and could overwrite them.
+"""
+
+import mmap
+import os
+import stat
+import struct
+import time
+
+SUPERBLOCK_OFFSET = 1024
+MAGIC = 0xEF53
+ROOT_INODE = 2
+
+INCOMPAT_64BIT = 0x80
+EXTENTS_FL = 0x80000
+INLINE_DATA_FL = 0x10000000
+
+EXTENT_MAGIC = 0xF30A
+EXTENT_HEADER = struct.Struct('<HHHHI')
+EXTENT_LEAF = struct.Struct('<IHHI')
+EXTENT_INDEX = struct.Struct('<IIHH')
+# extents longer than this are uninitialized, their length is stored plus this
+EXTENT_INIT_MAX = 32768
+
+DIRECT_BLOCKS = 12
+DIR_ENTRY = struct.Struct('<IHBB')
+
+class Inode():
+    __slots__ = ('number', 'mode', 'size', 'mtime', 'flags', 'block')
+
+    def __init__(self, number, mode, size, mtime, flags, block):
+        self.number = number
+        self.mode = mode
+        self.size = size
+        self.mtime = mtime
+        self.flags = flags
+        self.block = block
+
+class Ext4Image():
+    """An ext2/3/4 image mapped in memory"""
+    def __init__(self, path, writable=True):
+        fd = os.open(path, os.O_RDWR if writable else os.O_RDONLY)
+        try:
+            size = os.lseek(fd, 0, os.SEEK_END)
+            self.__map = mmap.mmap(fd, size, access=mmap.ACCESS_WRITE if writable else mmap.ACCESS_READ)
+        finally:
+            os.close(fd)
+        self.path = path
+        self.view = memoryview(self.__map)
+        self.__dirs = {}
+        self.__paths = {'/': ROOT_INODE}
+        self.__readSuperblock()
+
+    def inode(self, number):
+        """Parses an inode of the inode tables"""
+        group, index = divmod(number - 1, self.inodes_per_group)
+        offset = self.__inodeTable(group) * self.block_size + index * self.inode_size
+        mode, size_lo, mtime, flags = (struct.unpack_from('<H', self.view, offset)[0],
+            struct.unpack_from('<I', self.view, offset + 0x04)[0],
+            struct.unpack_from('<I', self.view, offset + 0x10)[0],
+            struct.unpack_from('<I', self.view, offset + 0x20)[0])
+        size_hi = struct.unpack_from('<I', self.view, offset + 0x6C)[0]
+        return Inode(number, mode, size_lo | (size_hi << 32), mtime, flags,
+            bytes(self.view[offset + 0x28:offset + 0x28 + 60]))
+
+    def mapBlock(self, inode, logical):
+        """Physical block holding a logical block of an inode, None for holes"""
+        if inode.flags & INLINE_DATA_FL:
+            return None
+        if inode.flags & EXTENTS_FL:
+            return self.__mapExtent(inode.block, logical)
+        return self.__mapIndirect(inode.block, logical)
+
+    def listdir(self, number):
+        """{name: inode number} of a directory"""
+        if number not in self.__dirs:
+            inode = self.inode(number)
+            entries = {}
+            for logical in range((inode.size + self.block_size - 1) // self.block_size):
+                physical = self.mapBlock(inode, logical)
+                if physical:
+                    self.__readDirBlock(physical * self.block_size, entries)
+            self.__dirs[number] = entries
+        return self.__dirs[number]
+
+    def lookup(self, path):
+        """Inode number of a path inside the image, raises FileNotFoundError"""
+        path = os.path.normpath('/' + path.lstrip('/'))
+        if path in self.__paths:
+            return self.__paths[path]
+        number = ROOT_INODE
+        for name in path.strip('/').split('/'):
+            entries = self.listdir(number)
+            if name not in entries:
+                raise FileNotFoundError(f"{path} not found in {self.path}")
+            number = entries[name]
+        self.__paths[path] = number
+        return number
+
+    def slack(self, path):
+        """Returns (offset in the image, length) of the slack after a file's last block"""
+        return self.slackOf(self.inode(self.lookup(path)))
+
+    def slackOf(self, inode):
+        if not stat.S_ISREG(inode.mode) or inode.size == 0 or inode.size % self.block_size == 0:
+            return 0, 0
+        physical = self.mapBlock(inode, (inode.size - 1) // self.block_size)
+        if not physical:
+            return 0, 0
+        used = inode.size % self.block_size
+        return physical * self.block_size + used, self.block_size - used
+
+    def scanTrees(self, roots):
+        """Walks directories of the image like indexer.scanTrees.
+        Returns ([(dev, inode, path, mtime, size, slack)], [(dir, mtime ns)], seconds)."""
+        start = time.monotonic()
+        files = []
+        dirs = []
+        pending = []
+        for root in roots:
+            try:
+                pending.append((os.path.normpath('/' + root.lstrip('/')), self.lookup(root)))
+            except FileNotFoundError:
+                continue
+        seen = set()
+        while pending:
+            path, number = pending.pop()
+            if number in seen:
+                continue
+            seen.add(number)
+            inode = self.inode(number)
+            if not stat.S_ISDIR(inode.mode):
+                continue
+            dirs.append((path, inode.mtime * 1000000000))
+            for name, child in self.listdir(number).items():
+                childpath = os.path.join(path, name)
+                self.__paths[childpath] = child
+                entry = self.inode(child)
+                if stat.S_ISDIR(entry.mode):
+                    pending.append((childpath, child))
+                elif stat.S_ISREG(entry.mode):
+                    offset, slack = self.slackOf(entry)
+                    files.append((0, child, childpath, entry.mtime, entry.size, slack))
+        return files, dirs, time.monotonic() - start
+
+    def flush(self):
+        """Writes modified pages back to the image"""
+        self.__map.flush()
+
+    def close(self):
+        """Flushes and unmaps the image. Slack views still held elsewhere keep the
+        mapping alive until they are gone."""
+        self.flush()
+        try:
+            self.view.release()
+            self.__map.close()
+        except BufferError:
+            pass
+
+# Private methods
+
+    def __readSuperblock(self):
+        sb = SUPERBLOCK_OFFSET
+        if struct.unpack_from('<H', self.view, sb + 0x38)[0] != MAGIC:
+            raise OSError(f"{self.path} is not an ext2/3/4 file system")
+        self.block_size = 1024 << struct.unpack_from('<I', self.view, sb + 0x18)[0]
+        self.first_data_block = struct.unpack_from('<I', self.view, sb + 0x14)[0]
+        self.inodes_per_group = struct.unpack_from('<I', self.view, sb + 0x28)[0]
+        revision = struct.unpack_from('<I', self.view, sb + 0x4C)[0]
+        self.inode_size = struct.unpack_from('<H', self.view, sb + 0x58)[0] if revision > 0 else 128
+        incompat = struct.unpack_from('<I', self.view, sb + 0x60)[0]
+        self.is64 = bool(incompat & INCOMPAT_64BIT)
+        self.desc_size = struct.unpack_from('<H', self.view, sb + 0xFE)[0] if self.is64 else 32
+        self.desc_offset = (self.first_data_block + 1) * self.block_size
+
+    def __inodeTable(self, group):
+        offset = self.desc_offset + group * self.desc_size
+        table = struct.unpack_from('<I', self.view, offset + 0x08)[0]
+        if self.is64 and self.desc_size >= 64:
+            table = table | (struct.unpack_from('<I', self.view, offset + 0x28)[0] << 32)
+        return table
+
+    def __mapExtent(self, node, logical):
+        while True:
+            magic, entries, maximum, depth, generation = EXTENT_HEADER.unpack_from(node)
+            if magic != EXTENT_MAGIC:
+                raise OSError("bad extent header")
+            found = None
+            for i in range(entries):
+                offset = EXTENT_HEADER.size + i * EXTENT_LEAF.size
+                first = struct.unpack_from('<I', node, offset)[0]
+                if first > logical:
+                    break
+                found = offset
+            if found is None:
+                return None
+            if depth == 0:
+                first, length, start_hi, start_lo = EXTENT_LEAF.unpack_from(node, found)
+                if length > EXTENT_INIT_MAX:
+                    length = length - EXTENT_INIT_MAX
+                if logical >= first + length:
+                    return None
+                return ((start_hi << 32) | start_lo) + logical - first
+            first, leaf_lo, leaf_hi, unused = EXTENT_INDEX.unpack_from(node, found)
+            block = (leaf_hi << 32) | leaf_lo
+            node = self.view[block * self.block_size:(block + 1) * self.block_size]
+
+    def __mapIndirect(self, blocks, logical):
+        per_block = self.block_size // 4
+        if logical < DIRECT_BLOCKS:
+            return struct.unpack_from('<I', blocks, logical * 4)[0]
+        logical = logical - DIRECT_BLOCKS
+        for level in range(3):
+            span = per_block ** (level + 1)
+            if logical < span:
+                block = struct.unpack_from('<I', blocks, (DIRECT_BLOCKS + level) * 4)[0]
+                while block and span > 1:
+                    span = span // per_block
+                    index, logical = divmod(logical, span)
+                    block = struct.unpack_from('<I', self.view, block * self.block_size + index * 4)[0]
+                return block
+            logical = logical - span
+        return None
+
+    def __readDirBlock(self, offset, entries):
+        end = offset + self.block_size
+        while offset + DIR_ENTRY.size <= end:
+            number, rec_len, name_len, file_type = DIR_ENTRY.unpack_from(self.view, offset)
+            if rec_len < DIR_ENTRY.size:
+                break
+            if number != 0 and name_len:
+                name = bytes(self.view[offset + DIR_ENTRY.size:offset + DIR_ENTRY.size + name_len])
+                name = os.fsdecode(name)
+                if name not in ('.', '..'):
+                    entries[name] = number
+            offset = offset + rec_len
@@ -1,187 +1,353 @@
 #!/usr/bin/env python3
 
+import codecs
+import os
+from bisect import bisect_left, insort
 from os import path
 from cmd2 import style
-import pprint
-from . import shell, encoder
+from . import shell, encoder, blobstore, treeformat, stats
+
+DIR = 'd'
+FILE = 'f'
+
+# Bytes of real files read at a time when importing them
+BLOCK_SIZE = 1024 * 1024
+
+class Node():
+    """Entry of the node table. Directories keep the sorted names of their children,
+    files their size and contents (bytes until saved, a Chunked or Blob afterwards)."""
+    __slots__ = ('id', 'parent', 'name', 'kind', 'size', 'blob', 'children')
+
+    def __init__(self, id, parent, name, kind, size=0, blob=None):
+        self.id = id
+        self.parent = parent
+        self.name = name
+        self.kind = kind
+        self.size = size
+        self.blob = blob
+        self.children = [] if kind == DIR else None
 
 class Filetree():
     def __init__(self):
-        # TODO: load filetree dinamically from slack space
-        self.__filetree = {}
-        self.__pwd_value = '/'
-        self.__currentdir = self.__filetree
         self.encoder = encoder.Encoder()
+        # file contents live in slack as blobs fetched on demand, encrypted with a per-volume key
+        self.store = None
+        self.__datakey = os.urandom(32)
+        # chunk store of a tree loaded without a blob store, written back as it was
+        self.__chunks = []
+        self.__reset()
 
     def print(self):
-        """Prints file tree dictionary."""
-        pprint.PrettyPrinter(width=1)
-        pprint.pprint(self.__filetree)
+        """Prints file tree."""
+        for node, depth in self.__walk(self.__nodes[0], 0):
+            if node.kind == DIR:
+                print(f"{'    ' * depth}{node.name}/")
+            else:
+                print(f"{'    ' * depth}{node.name} ({node.size} bytes)")
 
     def pwd(self):
         """Returns current directory."""
         return self.__pwd_value
 
+    @stats.timed('filetree.ls')
     def ls(self):
         """Returns current directory listing."""
-        entries = sorted(self.__currentdir.keys())
-        listing = ""
-        for entry in entries:
-            if entry.endswith('d'):
-                listing = listing + style(f'{entry[:-1]}\t', fg='cyan')
-            else:
-                listing = listing + style(f'{entry[:-1]}\t', fg='white')
-        return listing
+        current = self.__paths[self.__pwd_value]
+        listing = []
+        for name in current.children:
+            node = self.__paths[path.join(self.__pwd_value, name)]
+            listing.append(style(f'{name}\t', fg='cyan' if node.kind == DIR else 'white'))
+        return ''.join(listing)
 
+    @stats.timed('filetree.cd')
     def cd(self, dir):
         """Changes current directory."""
-        new_pwd = path.normpath(path.join(self.__pwd_value, dir))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        if valid:
+        new_pwd = self.__absolute(dir)
+        node = self.__paths.get(new_pwd)
+        if node is not None and node.kind == DIR:
             self.__pwd_value = new_pwd
-            self.__currentdir = new_dir
             return ''
         else:
             return "Directory doesn't exist"
 
+    @stats.timed('filetree.mkdir')
     def mkdir(self, dir):
         """Create a new directory"""
         if dir == '':
             return ''
-        new_pwd = path.normpath(path.join(self.__pwd_value, dir, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        dirname = dir.split('/')[-1]
-        if valid:
-            if f'{dirname}d' in new_dir:
-                return 'Directory exists'
-            
-            if f'{dirname}f' in new_dir:
-                return 'File exists'
-            
-            new_dir[f'{dirname}d'] = {} 
-            return ''
-        else:
+        parent, dirpath = self.__parentOf(dir)
+        if parent is None:
             return 'Invalid path'
+        existing = self.__paths.get(dirpath)
+        if existing is not None:
+            return 'Directory exists' if existing.kind == DIR else 'File exists'
+        self.__add(parent, dirpath, DIR)
+        return ''
 
+    @stats.timed('filetree.rmdir')
     def rmdir(self, dir):
         """Remove a directory"""
         if dir == '':
             return ''
-        new_pwd = path.normpath(path.join(self.__pwd_value, dir, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        dirname = dir.split('/')[-1]
-        if valid:
-            if f'{dirname}d' not in new_dir:
-                return 'Directory does not exist'
-            
-            if len(new_dir[f'{dirname}d']) == 0:
-                del new_dir[f'{dirname}d']
-            else:
-                return 'This directory is not empty'
-
-            return ''
-        else:
+        parent, dirpath = self.__parentOf(dir)
+        if parent is None:
             return 'Invalid path'
+        node = self.__paths.get(dirpath)
+        if node is None or node.kind != DIR:
+            return 'Directory does not exist'
+        if node.children:
+            return 'This directory is not empty'
+        self.__remove(parent, dirpath, node)
+        return ''
 
+    @stats.timed('filetree.putStr')
     def putStr(self, content, filepath):
         """Write a sting to a file"""
-        new_pwd = path.normpath(path.join(self.__pwd_value, filepath, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        filename = filepath.split('/')[-1]
-        if valid:
-            if f'{filename}f' not in new_dir:
-                new_dir[f'{filename}f'] = content.encode('utf-8')
-                return ''
-            else:
-                # TODO: treat overwrite
-                return 'File already exists'
-        else:
-            return 'Invalid path'
+        data = content.encode('utf-8')
+        return self.__put(filepath, lambda: (len(data), data))
 
-    def putFile(self, real_filepath, virtual_filepath):
-        """Add a file to the current directory of filetree"""
-        # TODO: check if file exists (disk)
-        new_pwd = path.normpath(path.join(self.__pwd_value, virtual_filepath, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        filename = virtual_filepath.split('/')[-1]
-        if valid:
-            if f'{filename}f' not in new_dir:
+    @stats.timed('filetree.putFile')
+    def putFile(self, real_filepath, virtual_filepath, progress=None):
+        """Add a file to the current directory of filetree.
+        With a blob store the file is read block by block and saved to slack as it is
+        read, progress(bytes done, total bytes) being called after every block."""
+        def read():
+            if self.store is None:
                 with open(real_filepath, 'rb') as f:
-                    content = f.read()
-                new_dir[f'{filename}f'] = content
-                return ''
-            else:
-                # TODO: treat overwrite
-                return 'File already exists'
-        else:
-            return 'Invalid path'
+                    data = f.read()
+                return len(data), data
+            blob = self.store.writeStream(self.__blocks(real_filepath, progress), self.__datakey)
+            return blob.size, blob
+        return self.__put(virtual_filepath, read)
 
+    @stats.timed('filetree.catFile', bytes_out=stats.size)
     def catFile(self, filepath):
         """Returns the content of a file"""
-        new_pwd = path.normpath(path.join(self.__pwd_value, filepath, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        filename = filepath.split('/')[-1]
-        if valid:
-            if f'{filename}f' not in new_dir:
-                return 'File does not exist'
-            try:
-                return new_dir[f'{filename}f'].decode()
-            except:
-                return new_dir[f'{filename}f']
-        else:
-            return 'Invalid path'
+        node, error = self.__file(filepath)
+        if node is None:
+            return error
+        content = self.__contents(node)
+        try:
+            return content.decode()
+        except:
+            return content
 
+    def catStream(self, filepath):
+        """Yields the content of a file as text, piece by piece"""
+        node, error = self.__file(filepath)
+        if node is None:
+            yield error
+            return
+        decoder = codecs.getincrementaldecoder('utf-8')('replace')
+        for piece in self.__stream(node):
+            yield decoder.decode(piece)
+        yield decoder.decode(b'', True)
+
+    @stats.timed('filetree.rmFile')
     def rmFile(self, filepath):
         """Removes a file"""
-        new_pwd = path.normpath(path.join(self.__pwd_value, filepath, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        filename = filepath.split('/')[-1]
-        if valid:
-            if f'{filename}f' not in new_dir:
-                return 'File does not exist'
-            del new_dir[f'{filename}f']
-            return ''
-        else:
-            return 'Invalid path'
+        node, error = self.__file(filepath)
+        if node is None:
+            return error
+        self.__remove(self.__nodes[node.parent], self.__absolute(filepath), node)
+        if self.store is not None:
+            self.store.release(node.blob)
+        return ''
 
-    def getFile(self, filepath, real_filepath):
-        """Saves a file to disk"""
-        new_pwd = path.normpath(path.join(self.__pwd_value, filepath, '..'))
-        valid, new_dir = self.__isValidDir(new_pwd)
-        filename = filepath.split('/')[-1]
-        if valid:
-            if f'{filename}f' not in new_dir:
-                return 'File does not exist'
-            with open(real_filepath, 'wb') as f:
-                f.write(new_dir[f'{filename}f'])
-            return ''
-        else:
-            return 'Invalid path'
+    @stats.timed('filetree.getFile')
+    def getFile(self, filepath, real_filepath, progress=None):
+        """Saves a file to disk, writing it piece by piece as it is decoded.
+        progress(bytes done, total bytes) is called after every piece."""
+        node, error = self.__file(filepath)
+        if node is None:
+            return error
+        done = 0
+        with open(real_filepath, 'wb') as f:
+            for piece in self.__stream(node):
+                f.write(piece)
+                done = done + len(piece)
+                if progress is not None:
+                    progress(done, node.size)
+        return ''
+
+    def blobs(self):
+        """Blobs of the file contents already saved to slack, chunks of the chunk store included"""
+        blobs = [node.blob for node in self.__nodes
+            if node is not None and isinstance(node.blob, blobstore.Blob)]
+        if self.store is not None:
+            blobs.extend(self.store.chunkBlobs())
+        return blobs
 
+    @stats.timed('filetree.encodeFiletree')
     def encodeFiletree(self, password):
-        encodedTree = self.encoder.encodeTree(self.__filetree, password)
+        """Encodes the file tree, yielding encrypted bytes as they are ready.
+        New file contents are first saved to slack, the tree only keeps their blobs."""
+        self.__flush()
+        chunks = self.store.chunks() if self.store is not None else self.__chunks
+        encodedTree = self.encoder.encode_stream(treeformat.encode(self.__entries(), self.__datakey, chunks), password)
         return encodedTree
 
+    @stats.timed('filetree.loadFileTree')
     def loadFileTree(self, encoded, password):
-        decoded = self.encoder.decodeTree(str(encoded), password)
-        self.__filetree = decoded.copy()
-        self.__currentdir = self.__filetree
+        """Loads the file tree from encrypted bytes or an iterable of them"""
+        if isinstance(encoded, bytes):
+            encoded = [encoded]
+        stream = treeformat.Stream(self.encoder.decode_stream(encoded, password))
+        if stream.peek(len(treeformat.MAGIC)) == treeformat.MAGIC:
+            reader = treeformat.TreeReader(stream)
+            self.__reset()
+            chunks = self.__read(reader)
+            self.__datakey = reader.datakey
+            self.__attach(chunks)
+            return
+        # volumes saved before the binary tree format are a pickled dict keeping every file inline
+        decoded = self.encoder.unpickleStream(stream)
+        self.__reset()
+        self.__fromDict(self.__nodes[0], '/', decoded)
+        self.__datakey = os.urandom(32)
+        self.__attach([])
 
 # Private methods
 
-    def __isValidDir(self, dir):
-        dirs = list(map(lambda x: x+'d', dir.split('/')))[1:]
-        new_dir = self.__filetree
-        if dir == '/':
-            return (True, new_dir)
-        for d in dirs:
-            if d in new_dir:
-                new_dir = new_dir[d]
+    def __reset(self):
+        self.__nodes = [Node(0, 0, '', DIR)]
+        self.__paths = {'/': self.__nodes[0]}
+        self.__pwd_value = '/'
+
+    def __absolute(self, filepath):
+        return path.normpath(path.join(self.__pwd_value, filepath))
+
+    def __parentOf(self, filepath):
+        """Returns (parent directory node or None, absolute path)"""
+        fullpath = self.__absolute(filepath)
+        parent = self.__paths.get(path.dirname(fullpath))
+        if parent is None or parent.kind != DIR or fullpath == '/':
+            return None, fullpath
+        return parent, fullpath
+
+    def __file(self, filepath):
+        """Returns (file node, None) or (None, error message)"""
+        parent, fullpath = self.__parentOf(filepath)
+        if parent is None:
+            return None, 'Invalid path'
+        node = self.__paths.get(fullpath)
+        if node is None or node.kind != FILE:
+            return None, 'File does not exist'
+        return node, None
+
+    def __put(self, filepath, read):
+        parent, fullpath = self.__parentOf(filepath)
+        if parent is None:
+            return 'Invalid path'
+        if fullpath in self.__paths:
+            # TODO: treat overwrite
+            return 'File already exists'
+        size, content = read()
+        self.__add(parent, fullpath, FILE, size, content)
+        return ''
+
+    def __add(self, parent, fullpath, kind, size=0, blob=None):
+        node = Node(len(self.__nodes), parent.id, path.basename(fullpath), kind, size, blob)
+        self.__nodes.append(node)
+        self.__paths[fullpath] = node
+        insort(parent.children, node.name)
+        return node
+
+    def __remove(self, parent, fullpath, node):
+        del parent.children[bisect_left(parent.children, node.name)]
+        del self.__paths[fullpath]
+        self.__nodes[node.id] = None
+
+    def __walk(self, node, depth, prefix='/'):
+        """Yields (node, depth) of the subtree below node, children in name order"""
+        for name in node.children:
+            child = self.__paths[path.join(prefix, name)]
+            yield child, depth
+            if child.kind == DIR:
+                yield from self.__walk(child, depth + 1, path.join(prefix, name))
+
+    def __saved(self, node):
+        return isinstance(node.blob, (blobstore.Chunked, blobstore.Blob))
+
+    def __contents(self, node):
+        if self.__saved(node):
+            return self.store.read(node.blob, self.__datakey)
+        return node.blob
+
+    def __stream(self, node):
+        if self.__saved(node):
+            return self.store.readStream(node.blob, self.__datakey)
+        return [node.blob]
+
+    def __blocks(self, real_filepath, progress):
+        with open(real_filepath, 'rb') as f:
+            total = os.fstat(f.fileno()).st_size
+            done = 0
+            while True:
+                block = f.read(BLOCK_SIZE)
+                if not block:
+                    break
+                done = done + len(block)
+                if progress is not None:
+                    progress(done, total)
+                yield block
+
+    def __flush(self):
+        """Saves the contents of new files to the chunk store"""
+        if self.store is None:
+            return
+        self.store.reserve(self.blobs())
+        for node in self.__nodes:
+            if node is not None and node.kind == FILE and not self.__saved(node):
+                node.blob = self.store.write(node.blob, self.__datakey)
+
+    def __attach(self, chunks):
+        """Hands the chunk store of a loaded tree to the blob store, whose host files are then reserved"""
+        if self.store is None:
+            self.__chunks = chunks
+            return
+        self.store.clear()
+        self.store.loadChunks(chunks, [node.blob for node in self.__nodes
+            if node is not None and isinstance(node.blob, blobstore.Chunked)])
+        self.store.reserve(self.blobs())
+
+    def __entries(self):
+        """(kind, name, children, size, contents) of every node in walk order, for treeformat"""
+        root = self.__nodes[0]
+        yield treeformat.DIR, '', len(root.children), 0, None
+        for node, depth in self.__walk(root, 0):
+            if node.kind == DIR:
+                yield treeformat.DIR, node.name, len(node.children), 0, None
             else:
-                return (False, {})
-        return (True, new_dir)
+                yield treeformat.FILE, node.name, 0, node.size, node.blob
 
-    def __getFileFromPath(self, filepath):
-        dir = path.normpath(path.join(self.__pwd_value, dir, '..'))
-        dirs = list(map(lambda x: x+'d', dir.split('/')))[1:]
-        new_dir = self.__filetree
+    def __read(self, reader):
+        """Builds the nodes of a tree serialized with treeformat, returning its chunk store"""
+        entries = reader.entries()
+        kind, name, children, size = next(entries)
+        files = []
+        # directories still expecting children: [node, path, children left]
+        stack = [[self.__nodes[0], '/', children]]
+        for kind, name, children, size in entries:
+            while stack[-1][2] == 0:
+                stack.pop()
+            parent = stack[-1]
+            parent[2] = parent[2] - 1
+            fullpath = path.join(parent[1], name)
+            if kind == treeformat.DIR:
+                node = self.__add(parent[0], fullpath, DIR)
+                stack.append([node, fullpath, children])
+            else:
+                files.append(self.__add(parent[0], fullpath, FILE, size))
+        for node, contents in zip(files, reader.contents()):
+            node.blob = contents
+        return list(reader.chunks())
+
+    def __fromDict(self, parent, prefix, tree):
+        """Builds nodes from the nested dicts of older volumes ('name' + 'd' or 'f' keys)"""
+        for key, value in tree.items():
+            fullpath = path.join(prefix, key[:-1])
+            if key.endswith(DIR):
+                self.__fromDict(self.__add(parent, fullpath, DIR), fullpath, value)
+            else:
+                self.__add(parent, fullpath, FILE, len(value), value)
@@ -0,0 +1,114 @@
+#!/usr/bin/env python3
+
+"""
+On-slack layout of a saved volume.
+
+Host files are named by (device, inode): inode numbers are only unique on
+their device, and a volume may span several. Every fragment starts with a
+binary header:
+
+    magic 'SD' | version | kind | next device (u64) | next inode (u64) | sequence (u32) | length (u32) | crc32 (u32)
+
+followed by length bytes of payload. The next host file is (0, 0) at the end
+of a chain. The sequence is the position of the fragment in its chain (a
+chunk, the table or a blob), so a fragment left over from another chain is
+told apart from the expected one. The initial file holds the fragment table
+(kind TABLE); when the table doesn't fit it continues in the next host file.
+The table lists the content-defined chunks of the volume (hash, offset,
+length) and then every data fragment (device, inode, offset, length), so all
+data fragments can be read at once and put back in place, on whichever
+device each one is. The fragments of a chunk never hold bytes of another
+chunk and are linked with their next host file, so an unchanged chunk keeps
+its host files on the next save.
+
+Volumes saved before the binary layout are base64 text, as a chain of
+'<next inode>:<data>' fragments, and are read through the compatibility
+reader in Bmap.
+"""
+
+import struct
+import zlib
+
+MAGIC = b'SD'
+VERSION = 2
+
+DATA = 0
+TABLE = 1
+
+HEADER = struct.Struct('>2sBBQQIII')
+COUNTS = struct.Struct('>II')
+CHUNK = struct.Struct('>8sQI')
+ENTRY = struct.Struct('>QQQI')
+
+def isFragment(slack):
+    """Tells if raw slack bytes start with a binary fragment header"""
+    return len(slack) >= HEADER.size and slack[:2] == MAGIC
+
+def pack(kind, next_host, payload, sequence=0):
+    """Builds a fragment: header followed by payload. next_host is the (device, inode)
+    of the next fragment of the chain, None for the last one."""
+    device, inode = next_host or (0, 0)
+    return HEADER.pack(MAGIC, VERSION, kind, device, inode, sequence, len(payload), zlib.crc32(payload)) + payload
+
+def unpack(slack, sequence=None):
+    """Parses a fragment, returning (kind, next (device, inode) or None, payload).
+    Raises ValueError when the header or the checksum doesn't match, or when
+    a sequence is given and the fragment has another one."""
+    if not isFragment(slack):
+        raise ValueError("no fragment header")
+    magic, version, kind, device, inode, found, length, crc = HEADER.unpack_from(slack)
+    if version != VERSION:
+        raise ValueError(f"unknown fragment version {version}")
+    if sequence is not None and found != sequence:
+        raise ValueError(f"fragment sequence {found} instead of {sequence}")
+    payload = bytes(slack[HEADER.size:HEADER.size + length])
+    if len(payload) != length or zlib.crc32(payload) != crc:
+        raise ValueError("fragment checksum mismatch")
+    return kind, (device, inode) if inode else None, payload
+
+def check(slack, kind, next_host, length, sequence):
+    """Tells what is wrong with a fragment read back from slack, None when it is the one expected.
+    Only the header and the checksum are looked at, the payload is not decoded."""
+    try:
+        found_kind, found_next, payload = unpack(slack, sequence)
+    except ValueError as e:
+        return str(e)
+    if found_kind != kind:
+        return f"fragment kind {found_kind} instead of {kind}"
+    if found_next != next_host:
+        return f"fragment links to {found_next} instead of {next_host}"
+    if len(payload) != length:
+        return f"fragment length {len(payload)} instead of {length}"
+    return None
+
+def packTable(chunks, entries):
+    """Serializes the table body from [(hash, offset, length)] and [((device, inode), offset, length)]"""
+    body = [COUNTS.pack(len(chunks), len(entries))]
+    body.extend(CHUNK.pack(bytes.fromhex(digest), offset, length) for digest, offset, length in chunks)
+    body.extend(ENTRY.pack(device, inode, offset, length) for (device, inode), offset, length in entries)
+    return b''.join(body)
+
+def unpackTable(body):
+    """Parses a table body, returning ([(hash, offset, length)], [((device, inode), offset, length)])"""
+    chunk_count, entry_count = COUNTS.unpack_from(body)
+    position = COUNTS.size
+    chunks = []
+    for i in range(chunk_count):
+        digest, offset, length = CHUNK.unpack_from(body, position)
+        chunks.append((digest.hex(), offset, length))
+        position = position + CHUNK.size
+    entries = []
+    for i in range(entry_count):
+        device, inode, offset, length = ENTRY.unpack_from(body, position)
+        entries.append(((device, inode), offset, length))
+        position = position + ENTRY.size
+    return chunks, entries
+
+def chunkFragments(entries, chunks):
+    """Groups fragment entries by chunk: {hash: [(host, offset in chunk, length)]}"""
+    placed = {}
+    for digest, offset, length in chunks:
+        placed[digest] = [(host, frag_offset - offset, frag_length)
+            for host, frag_offset, frag_length in entries
+            if offset <= frag_offset < offset + length]
+    return placed
@@ -0,0 +1,163 @@
+#!/usr/bin/env python3
+
+import os
+import sqlite3
+from . import indexer
+
+DEFAULT_PATH = '~/.slackdisk.index'
+
+SCHEMA = """
+    CREATE TABLE IF NOT EXISTS files (
+        dev INTEGER NOT NULL,
+        ino INTEGER NOT NULL,
+        path TEXT NOT NULL,
+        dir TEXT NOT NULL,
+        mtime INTEGER NOT NULL,
+        size INTEGER NOT NULL,
+        slack INTEGER,
+        block INTEGER,
+        PRIMARY KEY (dev, ino)
+    ) WITHOUT ROWID;
+    CREATE INDEX IF NOT EXISTS files_dir ON files (dir);
+    CREATE TABLE IF NOT EXISTS dirs (
+        path TEXT PRIMARY KEY,
+        mtime INTEGER NOT NULL
+    ) WITHOUT ROWID;
+    CREATE TABLE IF NOT EXISTS roots (
+        path TEXT PRIMARY KEY
+    ) WITHOUT ROWID;
+"""
+
+def underRoots(path, roots):
+    """Tells if path is one of roots or inside one of them"""
+    return any(path == root or path.startswith(root.rstrip('/') + '/') for root in roots)
+
+class IndexCache():
+    """Slack index kept in a local sqlite file between sessions, keyed by device and inode"""
+    def __init__(self, path=DEFAULT_PATH):
+        self.path = os.path.expanduser(path)
+        self.__db = None
+
+    def roots(self):
+        """Returns the usable dirs the cached index covers"""
+        return set(row[0] for row in self.__connect().execute("SELECT path FROM roots"))
+
+    def files(self):
+        """Returns every cached (dev, inode, path, mtime, size, slack) entry"""
+        return self.__connect().execute(
+            "SELECT dev, ino, path, mtime, size, slack FROM files").fetchall()
+
+    def replace(self, roots, files, dirs):
+        """Replaces the cached index with the result of a full scan"""
+        db = self.__connect()
+        with db:
+            db.execute("DELETE FROM files")
+            db.execute("DELETE FROM dirs")
+            db.execute("DELETE FROM roots")
+            db.executemany("INSERT INTO roots VALUES (?)", [(root,) for root in roots])
+            self.__store(db, files, dirs)
+
+    def refresh(self, roots):
+        """Brings the cached index up to date, re-examining only what changed.
+        Unchanged directories only get their files stat'ed, changed ones are rescanned.
+        Returns (files updated, directories rescanned)."""
+        db = self.__connect()
+        cached_roots = self.roots()
+        rescan = [root for root in roots if root not in cached_roots]
+        by_dir = {}
+        for dev, ino, path, mtime, size, dir in db.execute(
+                "SELECT dev, ino, path, mtime, size, dir FROM files"):
+            by_dir.setdefault(dir, []).append((dev, ino, path, mtime, size))
+        known = dict(db.execute("SELECT path, mtime FROM dirs"))
+        gone = []
+        changed = []
+        stale = []
+        fresh = []
+        for dir, mtime in known.items():
+            if not underRoots(dir, roots):
+                gone.append(dir)
+                continue
+            try:
+                st = os.stat(dir)
+            except OSError:
+                gone.append(dir)
+                continue
+            if st.st_mtime_ns != mtime:
+                changed.append(dir)
+                continue
+            for dev, ino, path, mtime, size in by_dir.get(dir, []):
+                try:
+                    st = os.stat(path, follow_symlinks=False)
+                except OSError:
+                    continue
+                if (st.st_dev, st.st_ino, int(st.st_mtime), st.st_size) != (dev, ino, mtime, size):
+                    stale.append((dev, ino))
+                    fresh.append(indexer.fileEntry(path, st))
+        with db:
+            db.executemany("DELETE FROM files WHERE dev = ? AND ino = ?", stale)
+            self.__store(db, fresh, [])
+            for dir in gone:
+                db.execute("DELETE FROM files WHERE dir = ?", (dir,))
+                db.execute("DELETE FROM dirs WHERE path = ?", (dir,))
+            for dir in changed:
+                files, dirs, subdirs = indexer.scanFiles(dir, recursive=False)
+                db.execute("DELETE FROM files WHERE dir = ?", (dir,))
+                self.__store(db, files, dirs)
+                fresh.extend(files)
+                rescan.extend(subdir for subdir in subdirs if subdir not in known)
+            db.execute("DELETE FROM roots")
+            db.executemany("INSERT INTO roots VALUES (?)", [(root,) for root in roots])
+        if rescan:
+            files, dirs, elapsed = indexer.scanTrees(rescan)
+            with db:
+                self.__store(db, files, dirs)
+            fresh.extend(files)
+        return len(fresh), len(changed) + len(rescan)
+
+    def update(self, removed, files):
+        """Replaces the entries of single files, as (dev, inode) to remove and new file entries"""
+        db = self.__connect()
+        with db:
+            db.executemany("DELETE FROM files WHERE dev = ? AND ino = ?", removed)
+            self.__store(db, files, [])
+
+    def setSlack(self, slacks):
+        """Records slack sizes checked against the block map, as (dev, inode, slack)"""
+        db = self.__connect()
+        with db:
+            db.executemany("UPDATE files SET slack = ? WHERE dev = ? AND ino = ?",
+                [(slack, dev, ino) for dev, ino, slack in slacks])
+
+    def blocks(self):
+        """Returns {(dev, inode): physical block of the slack} of the files whose block is known"""
+        return {(dev, ino): block for dev, ino, block in self.__connect().execute(
+            "SELECT dev, ino, block FROM files WHERE block IS NOT NULL")}
+
+    def setBlocks(self, blocks):
+        """Records the physical blocks holding the slack of files, as (dev, inode, block).
+        Entries replaced when a file changes forget their block."""
+        db = self.__connect()
+        with db:
+            db.executemany("UPDATE files SET block = ? WHERE dev = ? AND ino = ?",
+                [(block, dev, ino) for dev, ino, block in blocks])
+
+    def close(self):
+        """Closes the index file"""
+        if self.__db is not None:
+            self.__db.close()
+            self.__db = None
+
+# Private methods
+
+    def __connect(self):
+        if self.__db is None:
+            # the daemon runs commands on the threads of its clients, one at a time
+            self.__db = sqlite3.connect(self.path, check_same_thread=False)
+            self.__db.executescript(SCHEMA)
+        return self.__db
+
+    def __store(self, db, files, dirs):
+        db.executemany("INSERT OR REPLACE INTO files (dev, ino, path, dir, mtime, size, slack) VALUES (?, ?, ?, ?, ?, ?, ?)",
+            [(dev, ino, path, os.path.dirname(path), mtime, size, slack)
+                for dev, ino, path, mtime, size, slack in files])
+        db.executemany("INSERT OR REPLACE INTO dirs VALUES (?, ?)", dirs)
@@ -0,0 +1,78 @@
+#!/usr/bin/env python3
+
+import os
+import stat
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+# Entries smaller than this are not worth a fragment (same as the old find/stat path)
+MIN_SLACK = 10
+
+def expectedSlack(st):
+    """Slack of a file computed from its stat, or None if the block map must be checked"""
+    if st.st_size == 0 or st.st_blksize == 0:
+        return 0
+    blocks = -(-st.st_size // st.st_blksize)
+    if st.st_blocks * 512 < blocks * st.st_blksize:
+        # holes, inline data or tail packing: stat can't tell where the last block is
+        return None
+    return (-st.st_size) % st.st_blksize
+
+def fileEntry(path, st):
+    """Index tuple (dev, inode, path, mtime, size, slack) of a regular file"""
+    return (st.st_dev, st.st_ino, path, int(st.st_mtime), st.st_size, expectedSlack(st))
+
+def scanFiles(directory, recursive=True):
+    """Walks a directory with scandir.
+    Returns the file entries found, (path, mtime_ns) of every directory read,
+    and the subdirectories left unread when not recursive.
+    Slack is None for files that need to be checked against the real block map."""
+    found = []
+    dirs = []
+    subdirs = []
+    pending = [directory]
+    while pending:
+        current = pending.pop()
+        try:
+            dirs.append((current, os.stat(current).st_mtime_ns))
+            with os.scandir(current) as entries:
+                for entry in entries:
+                    try:
+                        if entry.is_dir(follow_symlinks=False):
+                            (pending if recursive else subdirs).append(entry.path)
+                            continue
+                        st = entry.stat(follow_symlinks=False)
+                    except OSError:
+                        continue
+                    if stat.S_ISREG(st.st_mode):
+                        found.append(fileEntry(entry.path, st))
+        except OSError:
+            continue
+    return found, dirs, subdirs
+
+def cutoffTime(days, now=None):
+    """Latest mtime accepted for a minimal age in days (as find -mtime +days)"""
+    if str(days) == '0':
+        return None
+    now = now or time.time()
+    return now - (int(days) + 1) * 86400
+
+def scanTrees(roots, workers=None):
+    """Scans directory trees over a process pool, returning (files, dirs, seconds)"""
+    start = time.monotonic()
+    found = []
+    dirs = []
+    subdirs = []
+    for root in roots:
+        if not os.path.isdir(root):
+            continue
+        top_files, top_dirs, top_subdirs = scanFiles(root, recursive=False)
+        found.extend(top_files)
+        dirs.extend(top_dirs)
+        subdirs.extend(top_subdirs)
+    if subdirs:
+        with ProcessPoolExecutor(max_workers=workers) as pool:
+            for sub_files, sub_dirs, _ in pool.map(scanFiles, subdirs, chunksize=4):
+                found.extend(sub_files)
+                dirs.extend(sub_dirs)
+    return found, dirs, time.monotonic() - start
@@ -0,0 +1,80 @@
+#!/usr/bin/env python3
+
+import ctypes
+import os
+
+# Places where reinstall_bmap.sh / make install leave the shared library
+LIBRARY_PATHS = ['libbmap.so', '/usr/local/lib/libbmap.so', '/opt/bmap/libbmap.so']
+
+MLOG_ERROR = 2
+
+class LibBmap():
+    """ctypes binding over the functions exported in bmap-1.0.20/include/bmap.h"""
+    def __init__(self, paths=LIBRARY_PATHS):
+        self.__lib = None
+        for path in paths:
+            try:
+                self.__lib = ctypes.CDLL(path, use_errno=True)
+                break
+            except OSError:
+                continue
+        if self.__lib is None:
+            raise OSError(f"libbmap.so not found in {', '.join(paths)}")
+
+        lib = self.__lib
+        lib.bmap_raw_open.argtypes = [ctypes.c_char_p, ctypes.c_uint]
+        lib.bmap_raw_open.restype = ctypes.c_int
+        lib.bmap_raw_close.argtypes = [ctypes.c_int]
+        lib.bmap_raw_close.restype = None
+        lib.bmap_get_slack_block.argtypes = [ctypes.c_int,
+            ctypes.POINTER(ctypes.c_long),
+            ctypes.POINTER(ctypes.c_long),
+            ctypes.POINTER(ctypes.c_long)]
+        lib.bmap_get_slack_block.restype = ctypes.c_int
+        lib.bmap_map_block.argtypes = [ctypes.c_int, ctypes.c_ulong]
+        lib.bmap_map_block.restype = ctypes.c_int
+        lib.bogowipe.argtypes = [ctypes.c_int, ctypes.c_long, ctypes.c_int,
+            ctypes.c_char_p, ctypes.c_int]
+        lib.bogowipe.restype = ctypes.c_int
+        # libbmap logs every call at info level on stderr, keep only errors
+        lib.mft_log_set.argtypes = [ctypes.c_int]
+        lib.mft_log_set(MLOG_ERROR)
+
+    def raw_open(self, filename, mode=os.O_RDWR):
+        """Opens the raw device holding filename"""
+        fd = self.__lib.bmap_raw_open(os.fsencode(filename), mode)
+        if fd == -1:
+            self.__raise(f"unable to raw open {filename}")
+        return fd
+
+    def raw_close(self, fd):
+        """Closes a raw device opened with raw_open"""
+        self.__lib.bmap_raw_close(fd)
+
+    def get_slack_block(self, fd):
+        """Returns (block, slack bytes, block size) of the last block of an open file"""
+        block = ctypes.c_long(0)
+        slack_bytes = ctypes.c_long(0)
+        block_size = ctypes.c_long(0)
+        if self.__lib.bmap_get_slack_block(fd, ctypes.byref(block),
+                ctypes.byref(slack_bytes), ctypes.byref(block_size)) == -1:
+            self.__raise("unable to get slack block")
+        return block.value, slack_bytes.value, block_size.value
+
+    def map_block(self, fd, block):
+        """Maps a logical block of an open file to its block on the device"""
+        block_pos = self.__lib.bmap_map_block(fd, block)
+        if block_pos == -1:
+            self.__raise(f"unable to map block {block}")
+        return block_pos
+
+    def bogowipe(self, raw_fd, offset, length, block_size):
+        """Wipes length bytes at offset of the raw device"""
+        buffer = ctypes.create_string_buffer(block_size)
+        return self.__lib.bogowipe(raw_fd, offset, length, buffer, block_size)
+
+# Private methods
+
+    def __raise(self, message):
+        errno = ctypes.get_errno()
+        raise OSError(errno, f"{message}: {os.strerror(errno)}")
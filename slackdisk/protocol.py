@@ -0,0 +1,69 @@
+#!/usr/bin/env python3
+
+"""
+Framed protocol between the SlackDisk daemon and its clients, over a Unix socket.
+
+Every frame is a type byte and a big endian 32 bit length, followed by that
+many bytes of payload:
+
+    REQUEST  client -> daemon  JSON {"line": console command line, "cwd": client directory}
+    OUTPUT   daemon -> client  UTF-8 text written by the command, as it is written
+    END      daemon -> client  UTF-8 error message, empty when the command ran
+
+A connection carries any number of requests, one at a time, each answered
+by OUTPUT frames and one END frame. Only the standard library is used here,
+so clients start without loading cmd2 or the crypto libraries.
+"""
+
+import json
+import struct
+
+# Where the daemon listens unless told otherwise (SLACKDISK_SOCKET, serve --socket)
+DEFAULT_SOCKET = '/run/slackdisk.sock'
+
+REQUEST = 1
+OUTPUT = 2
+END = 3
+
+FRAME = struct.Struct('>BI')
+# Payloads larger than this are refused, OUTPUT text is split below it
+MAX_FRAME = 1024 * 1024
+
+def send(sock, kind, payload):
+    """Sends one frame, payload being bytes or str"""
+    if isinstance(payload, str):
+        payload = payload.encode('utf-8')
+    sock.sendall(FRAME.pack(kind, len(payload)) + payload)
+
+def receive(sock):
+    """Receives one frame as (type, payload bytes), None when the peer closed the connection"""
+    header = receiveExactly(sock, FRAME.size)
+    if header is None:
+        return None
+    kind, length = FRAME.unpack(header)
+    if length > MAX_FRAME:
+        raise ValueError(f"frame of {length} bytes is too large")
+    payload = receiveExactly(sock, length)
+    if payload is None:
+        raise ValueError("connection closed in the middle of a frame")
+    return kind, payload
+
+def receiveExactly(sock, size):
+    """size bytes from the socket, None if it is closed before the first one"""
+    data = bytearray()
+    while len(data) < size:
+        piece = sock.recv(size - len(data))
+        if not piece:
+            if data:
+                raise ValueError("connection closed in the middle of a frame")
+            return None
+        data += piece
+    return bytes(data)
+
+def request(line, cwd):
+    return json.dumps({'line': line, 'cwd': cwd})
+
+def parseRequest(payload):
+    """(line, cwd) of a REQUEST payload"""
+    message = json.loads(payload.decode('utf-8'))
+    return message['line'], message.get('cwd')
@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+import asyncio
+import threading
+from collections import deque
+from concurrent.futures import Future, InvalidStateError, ThreadPoolExecutor
+
+DEFAULT_CONCURRENCY = 16
+
+class Job(Future):
+    """Future of a scheduled operation. It is cancelled at once, but only settled once
+    the operation has stopped running (or is known never to start)."""
+    def __init__(self):
+        super().__init__()
+        self.settled = threading.Event()
+
+class Scheduler():
+    """Runs fragment reads and writes on an asyncio loop, at most `concurrency` at a time
+    per lane. Coroutine functions (subprocesses of the command line backend) run on the
+    loop, blocking functions (in-process backends) in executor threads. Every lane (the
+    device a host file sits on) has its own limit and threads, so devices are worked in
+    parallel. The loop lives in its own thread, so callers stay synchronous."""
+    def __init__(self, concurrency=DEFAULT_CONCURRENCY):
+        self.concurrency = concurrency
+        self.__loop = None
+        self.__thread = None
+        # lane -> (semaphore, executor)
+        self.__lanes = {}
+        self.__limit = None
+        self.__lock = threading.Lock()
+
+    def submit(self, function, *args, lane=None):
+        """Schedules function(*args) on a lane, returning a Job (a concurrent.futures.Future)"""
+        job = Job()
+        loop = self.__start()
+        loop.call_soon_threadsafe(self.__spawn, loop, job, function, args, lane)
+        return job
+
+    def map(self, function, items):
+        """Runs function(*item) for every item, yielding the results in order.
+        At most twice the concurrency is scheduled ahead of the consumer. When one
+        fails, or the consumer stops early, everything still pending is cancelled."""
+        pending = deque()
+        try:
+            for item in items:
+                pending.append(self.submit(function, *item))
+                if len(pending) > 2 * self.concurrency:
+                    yield pending.popleft().result()
+            while pending:
+                yield pending.popleft().result()
+        finally:
+            self.cancel(pending)
+
+    def wait(self, futures):
+        """Results of futures in order, cancelling the rest on the first failure"""
+        futures = deque(futures)
+        results = []
+        try:
+            while futures:
+                results.append(futures.popleft().result())
+        finally:
+            self.cancel(futures)
+        return results
+
+    def cancel(self, jobs):
+        """Cancels jobs and waits until none of them is running any more. Operations
+        already running in executor threads can't be stopped, they are waited for."""
+        jobs = list(jobs)
+        for job in jobs:
+            job.cancel()
+        for job in jobs:
+            # close waits for the executor threads, nothing runs once the loop is gone
+            while not job.settled.wait(0.1) and self.__loop is not None:
+                pass
+
+    def close(self):
+        """Stops the loop and the executor threads"""
+        with self.__lock:
+            if self.__loop is None:
+                return
+            self.__loop.call_soon_threadsafe(self.__loop.stop)
+            self.__thread.join()
+            self.__loop.close()
+            self.__loop = None
+            for semaphore, executor in self.__lanes.values():
+                executor.shutdown()
+            self.__lanes = {}
+            self.__limit = None
+
+# Private methods
+
+    def __start(self):
+        with self.__lock:
+            if self.__loop is None:
+                self.__loop = asyncio.new_event_loop()
+                self.__thread = threading.Thread(target=self.__loop.run_forever, daemon=True)
+                self.__thread.start()
+            return self.__loop
+
+    def __spawn(self, loop, job, function, args, lane):
+        """Starts the task of a job on the loop, its outcome going to the job"""
+        if job.cancelled():
+            job.settled.set()
+            return
+        task = loop.create_task(self.__run(function, args, lane))
+
+        def finished(task):
+            try:
+                if task.cancelled():
+                    job.cancel()
+                elif task.exception() is not None:
+                    job.set_exception(task.exception())
+                else:
+                    job.set_result(task.result())
+            except InvalidStateError:
+                # the job was cancelled meanwhile
+                pass
+            job.settled.set()
+        task.add_done_callback(finished)
+        job.add_done_callback(lambda job: job.cancelled() and loop.call_soon_threadsafe(task.cancel))
+
+    async def __run(self, function, args, lane):
+        if self.__limit != self.concurrency:
+            # the concurrency was changed, new operations follow the new limit
+            self.__limit = self.concurrency
+            for semaphore, executor in self.__lanes.values():
+                executor.shutdown(wait=False)
+            self.__lanes = {}
+        if lane not in self.__lanes:
+            self.__lanes[lane] = (asyncio.Semaphore(self.__limit), ThreadPoolExecutor(max_workers=self.__limit))
+        semaphore, executor = self.__lanes[lane]
+        async with semaphore:
+            if asyncio.iscoroutinefunction(function):
+                return await function(*args)
+            work = executor.submit(function, *args)
+            waiting = asyncio.wrap_future(work)
+            try:
+                return await asyncio.shield(waiting)
+            except asyncio.CancelledError:
+                # a running thread can't be stopped, the operation is only over once it returns
+                if not work.cancel():
+                    await asyncio.wait([waiting])
+                raise
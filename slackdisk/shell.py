@@ -1,11 +1,39 @@
+import asyncio
 import subprocess
+from . import stats
 
-def runCmd(cmd):
-    """Run a command and get standard output"""
+@stats.timed('shell.runCmd', bytes_in=lambda cmd, input=None, binary=False: stats.size(input),
+    bytes_out=lambda result: stats.size(result[0]))
+def runCmd(cmd, input=None, binary=False):
+    """Run a command and get standard output, optionally feeding bytes to its standard input.
+    With binary the outputs are returned as raw bytes."""
     cmdArgs = cmd.split(' ')
     out = subprocess.Popen([cmd], 
             shell=True,
+            stdin=subprocess.PIPE if input is not None else None,
             stdout=subprocess.PIPE, 
             stderr=subprocess.PIPE)
-    stdout,stderr = out.communicate()
-    return stdout.decode('utf-8').rstrip(), stderr.decode('utf-8').rstrip() 
\ No newline at end of file
+    stdout,stderr = out.communicate(input)
+    if binary:
+        return stdout, stderr
+    return stdout.decode('utf-8').rstrip(), stderr.decode('utf-8').rstrip() 
+
+@stats.timedAsync('shell.runCmdAsync', bytes_in=lambda cmd, input=None, binary=False: stats.size(input),
+    bytes_out=lambda result: stats.size(result[0]))
+async def runCmdAsync(cmd, input=None, binary=False):
+    """Same as runCmd as an asyncio subprocess, so many can run at once"""
+    out = await asyncio.create_subprocess_shell(cmd,
+            stdin=subprocess.PIPE if input is not None else None,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE)
+    try:
+        stdout, stderr = await out.communicate(input)
+    except asyncio.CancelledError:
+        if out.returncode is None:
+            out.kill()
+            # the write is only over once the process is gone
+            await out.wait()
+        raise
+    if binary:
+        return stdout, stderr
+    return stdout.decode('utf-8').rstrip(), stderr.decode('utf-8').rstrip()
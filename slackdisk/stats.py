@@ -0,0 +1,164 @@
+#!/usr/bin/env python3
+
+"""
+Counters and latencies of the hot paths (process spawns, slack I/O, key
+derivation, compression, encryption, pickling, file tree operations).
+
+Functions are wrapped with timed() or timedStream(); while recording is off
+the wrappers only check one flag before calling through.
+"""
+
+import functools
+import json
+import threading
+import time
+from collections import deque
+
+# Latencies kept per metric for the percentiles
+LATENCY_SAMPLES = 10000
+
+enabled = False
+
+lock = threading.Lock()
+
+class Metric():
+    __slots__ = ('calls', 'bytes_in', 'bytes_out', 'fragments', 'seconds', 'latencies')
+
+    def __init__(self):
+        self.calls = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.fragments = 0
+        self.seconds = 0.0
+        self.latencies = deque(maxlen=LATENCY_SAMPLES)
+
+    def percentile(self, fraction):
+        if not self.latencies:
+            return 0.0
+        ordered = sorted(self.latencies)
+        return ordered[min(len(ordered) - 1, int(fraction * len(ordered)))]
+
+    def summary(self):
+        return {
+            'calls': self.calls,
+            'bytes_in': self.bytes_in,
+            'bytes_out': self.bytes_out,
+            'fragments': self.fragments,
+            'seconds': round(self.seconds, 6),
+            'p50_ms': round(self.percentile(0.5) * 1000, 3),
+            'p99_ms': round(self.percentile(0.99) * 1000, 3),
+        }
+
+metrics = {}
+
+def enable(on=True):
+    """Turns recording on or off"""
+    global enabled
+    enabled = on
+
+def record(name, seconds, bytes_in=0, bytes_out=0, fragments=0):
+    """Adds one call to a metric"""
+    with lock:
+        metric = metrics.get(name)
+        if metric is None:
+            metric = metrics.setdefault(name, Metric())
+        metric.calls = metric.calls + 1
+        metric.bytes_in = metric.bytes_in + bytes_in
+        metric.bytes_out = metric.bytes_out + bytes_out
+        metric.fragments = metric.fragments + fragments
+        metric.seconds = metric.seconds + seconds
+        metric.latencies.append(seconds)
+
+def size(data):
+    """Length of bytes-like or str data, 0 for anything else"""
+    try:
+        return len(data)
+    except TypeError:
+        return 0
+
+def timed(name, bytes_in=None, bytes_out=None, fragments=None):
+    """Decorator recording calls of a function. bytes_in gets the call's arguments,
+    bytes_out and fragments its result, and return the amounts to add."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            start = time.perf_counter()
+            result = function(*args, **kwargs)
+            elapsed = time.perf_counter() - start
+            record(name, elapsed,
+                bytes_in(*args, **kwargs) if bytes_in else 0,
+                bytes_out(result) if bytes_out else 0,
+                fragments(result) if fragments else 0)
+            return result
+        return wrapper
+    return decorate
+
+def timedStream(name):
+    """Decorator recording a generator function as one call once it is exhausted.
+    Only the time spent producing items counts, bytes_out is the size of what it yields."""
+    def decorate(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if not enabled:
+                return function(*args, **kwargs)
+            return measureStream(name, function(*args, **kwargs))
+        return wrapper
+    return decorate
+
+def timedAsync(name, bytes_in=None, bytes_out=None):
+    """Same as timed() for coroutine functions"""
+    def decorate(function):
+        @functools.wraps(function)
+        async def wrapper(*args, **kwargs):
+            if not enabled:
+                return await function(*args, **kwargs)
+            start = time.perf_counter()
+            result = await function(*args, **kwargs)
+            record(name, time.perf_counter() - start,
+                bytes_in(*args, **kwargs) if bytes_in else 0,
+                bytes_out(result) if bytes_out else 0)
+            return result
+        return wrapper
+    return decorate
+
+END = object()
+
+def measureStream(name, items):
+    elapsed = 0.0
+    produced = 0
+    items = iter(items)
+    while True:
+        start = time.perf_counter()
+        item = next(items, END)
+        elapsed = elapsed + time.perf_counter() - start
+        if item is END:
+            break
+        produced = produced + size(item)
+        yield item
+    record(name, elapsed, bytes_out=produced)
+
+def reset():
+    """Forgets everything recorded so far"""
+    metrics.clear()
+
+def snapshot():
+    """{metric: summary} of everything recorded"""
+    with lock:
+        return {name: metrics[name].summary() for name in sorted(metrics)}
+
+def export(path):
+    """Writes the summaries as JSON"""
+    with open(path, 'w') as f:
+        json.dump(snapshot(), f, indent=2)
+
+def report():
+    """Table of the summaries, for the console"""
+    if not metrics:
+        return 'No stats recorded' + ('' if enabled else ' (recording is off, use stats on)')
+    lines = [f"{'metric':<28}{'calls':>8}{'in':>12}{'out':>12}{'frags':>8}{'total s':>10}{'p50 ms':>10}{'p99 ms':>10}"]
+    for name, summary in snapshot().items():
+        lines.append(f"{name:<28}{summary['calls']:>8}{summary['bytes_in']:>12}{summary['bytes_out']:>12}"
+            f"{summary['fragments']:>8}{summary['seconds']:>10.3f}{summary['p50_ms']:>10.3f}{summary['p99_ms']:>10.3f}")
+    return '\n'.join(lines)
@@ -0,0 +1,341 @@
+#!/usr/bin/env python3
+
+"""
+Binary serialization of the file tree, replacing the pickled node table.
+
+    magic 'SDT' | version | datakey | directory section | contents section | chunk section
+
+Integers are LEB128 varints and byte strings are prefixed with their varint
+length. The directory section starts with its entry count and byte length,
+so it can be read (or skipped) without touching the contents. Its entries
+are the nodes in walk order, root first, each prefixed with its length:
+
+    directory: 0 | name | children | files below | bytes of the entries below
+    file:      1 | name | size
+
+The sizes kept with every directory let a reader skip a whole subtree, and
+the contents of the files below it, without parsing them. The contents
+section has one length-prefixed record per file, in the same order:
+
+    inline bytes: 0 | bytes
+    blob:         1 | size | fragment count | (device | inode | length)...
+    chunked:      2 | size | chunk count | digests
+
+Deduplicated contents only list the digests of their chunks, the chunk
+section holds the chunk store, one length-prefixed record per chunk:
+digest | blob record.
+
+The sections are produced and parsed as streams of small pieces.
+"""
+
+from . import blobstore, chunker, stats
+
+MAGIC = b'SDT'
+VERSION = 2
+
+DIR = 0
+FILE = 1
+
+INLINE = 0
+BLOB = 1
+CHUNKED = 2
+
+# Size of the pieces yielded by encode
+PIECE_SIZE = 65536
+
+# varints of one byte, most of them
+SMALL = [bytes([value]) for value in range(0x80)]
+
+def packVarint(value):
+    """LEB128 encoding of a non negative integer"""
+    if value < 0x80:
+        return SMALL[value]
+    out = bytearray()
+    while value > 0x7f:
+        out.append((value & 0x7f) | 0x80)
+        value = value >> 7
+    out.append(value)
+    return bytes(out)
+
+def packVarints(values):
+    """LEB128 encoding of non negative integers"""
+    return b''.join(packVarint(value) for value in values)
+
+def readVarint(data, position):
+    """Decodes the varint at position, returning (value, position after it)"""
+    value = 0
+    shift = 0
+    while True:
+        byte = data[position]
+        position = position + 1
+        value = value | ((byte & 0x7f) << shift)
+        if not byte & 0x80:
+            return value, position
+        shift = shift + 7
+
+def packBytes(data):
+    return packVarint(len(data)) + data
+
+@stats.timedStream('treeformat.encode')
+def encode(entries, datakey, chunks=()):
+    """Serializes the nodes of a tree, yielding pieces of bytes.
+    entries are (kind, name, children, size, contents) in walk order, root first,
+    children being the child count of a directory and contents the bytes, Blob or
+    Chunked of a file. chunks are the (digest, Blob) of the chunk store."""
+    entries = list(entries)
+    yield MAGIC + bytes([VERSION]) + packBytes(datakey)
+    packed = directorySection(entries)
+    yield packVarint(len(entries)) + packVarint(sum(len(entry) for entry in packed))
+    yield from regroup(packed)
+    files = [entry[4] for entry in entries if entry[0] == FILE]
+    yield packVarint(len(files))
+    yield from regroup(packBytes(packContents(contents)) for contents in files)
+    chunks = list(chunks)
+    yield packVarint(len(chunks))
+    yield from regroup(packBytes(digest + packContents(blob)) for digest, blob in chunks)
+
+def directorySection(entries):
+    """Packed directory entries, filling in the sizes of every subtree from the last entry up"""
+    parents = []
+    stack = []
+    for i, (kind, name, children, size, contents) in enumerate(entries):
+        parents.append(stack[-1][0] if stack else None)
+        if stack:
+            stack[-1][1] = stack[-1][1] - 1
+        if kind == DIR:
+            stack.append([i, children])
+        while stack and stack[-1][1] == 0:
+            stack.pop()
+    below = [0] * len(entries)
+    files = [0] * len(entries)
+    packed = [None] * len(entries)
+    for i in range(len(entries) - 1, -1, -1):
+        kind, name, children, size, contents = entries[i]
+        name = name.encode('utf-8')
+        if kind == DIR:
+            body = b''.join((SMALL[DIR], packVarint(len(name)), name,
+                packVarint(children), packVarint(files[i]), packVarint(below[i])))
+        else:
+            body = b''.join((SMALL[FILE], packVarint(len(name)), name, packVarint(size)))
+            files[i] = 1
+        packed[i] = packVarint(len(body)) + body
+        parent = parents[i]
+        if parent is not None:
+            below[parent] = below[parent] + len(packed[i]) + below[i]
+            files[parent] = files[parent] + files[i]
+    return packed
+
+def packContents(contents):
+    if isinstance(contents, blobstore.Blob):
+        fields = [bytes([BLOB]), packVarint(contents.size), packVarint(len(contents.fragments))]
+        fields.extend(packVarints([device, inode, length]) for (device, inode), length in contents.fragments)
+        return b''.join(fields)
+    if isinstance(contents, blobstore.Chunked):
+        return b''.join([bytes([CHUNKED]), packVarint(contents.size), packVarint(len(contents.digests))]
+            + contents.digests)
+    return bytes([INLINE]) + bytes(contents)
+
+def unpackContents(record, position=0):
+    kind = record[position]
+    if kind == INLINE:
+        return record[position + 1:]
+    size, position = readVarint(record, position + 1)
+    if kind == CHUNKED:
+        count, position = readVarint(record, position)
+        digests = [record[start:start + chunker.STRONG_SIZE]
+            for start in range(position, position + count * chunker.STRONG_SIZE, chunker.STRONG_SIZE)]
+        return blobstore.Chunked(size, digests)
+    count, position = readVarint(record, position)
+    fragments = []
+    for i in range(count):
+        device, position = readVarint(record, position)
+        inode, position = readVarint(record, position)
+        length, position = readVarint(record, position)
+        fragments.append(((device, inode), length))
+    return blobstore.Blob(size, fragments)
+
+def regroup(pieces):
+    """Joins small pieces into PIECE_SIZE ones"""
+    buffer = bytearray()
+    for piece in pieces:
+        buffer += piece
+        if len(buffer) >= PIECE_SIZE:
+            yield bytes(buffer)
+            buffer = bytearray()
+    if buffer:
+        yield bytes(buffer)
+
+class Stream():
+    """Reads varints and byte strings from an iterable of bytes, pulling pieces as needed"""
+    def __init__(self, pieces):
+        self.pieces = iter(pieces)
+        self.buffer = b''
+        self.offset = 0
+        self.position = 0
+
+    def peek(self, size):
+        """The next size bytes (fewer at the end), without consuming them"""
+        self.__fill(size)
+        return self.buffer[self.offset:self.offset + size]
+
+    def read(self, size):
+        if len(self.buffer) - self.offset < size and not self.__fill(size):
+            raise ValueError("truncated file tree")
+        data = self.buffer[self.offset:self.offset + size]
+        self.offset = self.offset + size
+        self.position = self.position + size
+        return data
+
+    def record(self):
+        """Reads a length-prefixed byte string"""
+        return self.read(self.varint())
+
+    def skip(self, size):
+        """Discards size bytes without looking at them"""
+        while size > 0:
+            if self.offset == len(self.buffer) and not self.__fill(1):
+                raise ValueError("truncated file tree")
+            step = min(size, len(self.buffer) - self.offset)
+            self.offset = self.offset + step
+            self.position = self.position + step
+            size = size - step
+
+    def varint(self):
+        # a u64 takes at most 10 bytes
+        if len(self.buffer) - self.offset < 10:
+            self.__fill(10)
+        try:
+            value, offset = readVarint(self.buffer, self.offset)
+        except IndexError:
+            raise ValueError("truncated file tree")
+        self.position = self.position + offset - self.offset
+        self.offset = offset
+        return value
+
+    def __iter__(self):
+        """The bytes left, as pieces"""
+        if self.offset < len(self.buffer):
+            yield self.buffer[self.offset:]
+        self.buffer = b''
+        self.offset = 0
+        yield from self.pieces
+
+# Private methods
+
+    def __fill(self, size):
+        """Pulls pieces until size bytes are buffered, False when the pieces run out first"""
+        if len(self.buffer) - self.offset >= size:
+            return True
+        pieces = [self.buffer[self.offset:]]
+        buffered = len(pieces[0])
+        while buffered < size:
+            piece = next(self.pieces, None)
+            if piece is None:
+                break
+            pieces.append(piece)
+            buffered = buffered + len(piece)
+        self.buffer = b''.join(pieces)
+        self.offset = 0
+        return buffered >= size
+
+class TreeReader():
+    """Parses a serialized tree from a Stream: the header when created, then either
+    entries() followed by contents(), or subtree() for the nodes below one path.
+    The directory section is read in one piece, the contents record by record."""
+    def __init__(self, stream):
+        if stream.read(len(MAGIC)) != MAGIC:
+            raise ValueError("not a serialized file tree")
+        version = stream.read(1)[0]
+        if version != VERSION:
+            raise ValueError(f"unknown file tree version {version}")
+        self.stream = stream
+        self.datakey = stream.read(stream.varint())
+        self.count = stream.varint()
+        self.length = stream.varint()
+        self.__section = None
+
+    def entries(self):
+        """Yields (kind, name, children, size) of every node in walk order, root first"""
+        section = self.__directorySection()
+        position = 0
+        for i in range(self.count):
+            kind, name, children, size, files, below, position = self.__entry(section, position)
+            yield kind, name, children, size
+
+    def contents(self):
+        """Yields the contents (bytes, Blob or Chunked) of every file in walk order"""
+        self.__directorySection()
+        for i in range(self.stream.varint()):
+            yield unpackContents(self.stream.record())
+
+    def chunks(self):
+        """Yields the (digest, Blob) of the chunk store, once contents() is exhausted"""
+        for i in range(self.stream.varint()):
+            record = self.stream.record()
+            yield record[:chunker.STRONG_SIZE], unpackContents(record, chunker.STRONG_SIZE)
+
+    def subtree(self, path):
+        """Yields (path, kind, size, contents) of the nodes below a directory, skipping
+        every other subtree and the contents of the files outside of it"""
+        section = self.__directorySection()
+        kind, name, children, size, files, below, position = self.__entry(section, 0)
+        skipped = 0
+        for wanted in [name for name in path.split('/') if name]:
+            for i in range(children):
+                kind, name, count, size, files, below, position = self.__entry(section, position)
+                if name == wanted and kind == DIR:
+                    children = count
+                    break
+                position = position + below
+                skipped = skipped + files
+            else:
+                raise FileNotFoundError(f"{path} not found in the file tree")
+        end = position + below
+        found = []
+        # directories still expecting children: [path, children left]
+        pending = [[path.rstrip('/'), children]]
+        while position < end:
+            while pending[-1][1] == 0:
+                pending.pop()
+            pending[-1][1] = pending[-1][1] - 1
+            prefix = pending[-1][0]
+            kind, name, count, size, files, below, position = self.__entry(section, position)
+            found.append((f'{prefix}/{name}', kind, size))
+            if kind == DIR:
+                pending.append([f'{prefix}/{name}', count])
+        self.stream.varint()
+        for i in range(skipped):
+            self.stream.skip(self.stream.varint())
+        for entry in found:
+            contents = None
+            if entry[1] == FILE:
+                contents = unpackContents(self.stream.record())
+            yield entry + (contents,)
+
+# Private methods
+
+    def __directorySection(self):
+        if self.__section is None:
+            self.__section = self.stream.read(self.length)
+        return self.__section
+
+    def __entry(self, section, position):
+        """(kind, name, children, size, files below, bytes below, next position) of the entry at position"""
+        length, position = readVarint(section, position)
+        end = position + length
+        kind = section[position]
+        length = section[position + 1]
+        if length < 0x80:
+            # most names are shorter than 128 bytes
+            position = position + 2
+        else:
+            length, position = readVarint(section, position + 1)
+        name = section[position:position + length].decode('utf-8')
+        position = position + length
+        if kind == DIR:
+            children, position = readVarint(section, position)
+            files, position = readVarint(section, position)
+            below, position = readVarint(section, position)
+            return kind, name, children, 0, files, below, end
+        size, position = readVarint(section, position)
+        return kind, name, 0, size, 1, 0, end
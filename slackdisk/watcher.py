@@ -0,0 +1,176 @@
+#!/usr/bin/env python3
+
+"""
+Watches the usable directories with inotify so the slack index follows the
+host files as they change, without rescanning.
+
+The watcher thread only collects the paths that changed; Bmap applies them to
+its index on its next operation. Host files holding live fragments are checked
+at once though, since a write to them means their slack is gone.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import threading
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO |
+    IN_CREATE | IN_DELETE | IN_DELETE_SELF | IN_ONLYDIR)
+# events after which the contents of a file, and so its slack, may have changed
+WRITE_MASK = IN_MODIFY | IN_CLOSE_WRITE | IN_MOVED_FROM | IN_MOVED_TO | IN_DELETE
+
+EVENT = struct.Struct('iIII')
+READ_SIZE = 65536
+
+class Inotify():
+    """ctypes binding over the inotify calls of libc"""
+    def __init__(self):
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6', use_errno=True)
+        if not hasattr(libc, 'inotify_init1'):
+            raise OSError("inotify is not available")
+        self.__libc = libc
+        libc.inotify_init1.argtypes = [ctypes.c_int]
+        libc.inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+        libc.inotify_rm_watch.argtypes = [ctypes.c_int, ctypes.c_int]
+        self.fd = libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self.fd == -1:
+            self.__raise("unable to start inotify")
+
+    def addWatch(self, path, mask):
+        """Watches a directory, returning the watch descriptor"""
+        wd = self.__libc.inotify_add_watch(self.fd, os.fsencode(path), mask)
+        if wd == -1:
+            self.__raise(f"unable to watch {path}")
+        return wd
+
+    def removeWatch(self, wd):
+        self.__libc.inotify_rm_watch(self.fd, wd)
+
+    def events(self):
+        """Reads the pending events, as [(watch descriptor, mask, name)]"""
+        try:
+            data = os.read(self.fd, READ_SIZE)
+        except BlockingIOError:
+            return []
+        events = []
+        position = 0
+        while position + EVENT.size <= len(data):
+            wd, mask, cookie, length = EVENT.unpack_from(data, position)
+            position = position + EVENT.size
+            name = data[position:position + length].rstrip(b'\x00')
+            position = position + length
+            events.append((wd, mask, os.fsdecode(name)))
+        return events
+
+    def close(self):
+        os.close(self.fd)
+
+# Private methods
+
+    def __raise(self, message):
+        error = ctypes.get_errno()
+        raise OSError(error, f"{message}: {os.strerror(error)}")
+
+class Watcher():
+    """Background thread watching directory trees.
+    changed(path, written) is called for every file event, written telling if
+    the contents may have changed; overflow() when inotify dropped events."""
+    def __init__(self, roots, changed, overflow):
+        self.roots = roots
+        self.changed = changed
+        self.overflow = overflow
+        self.__dirs = {}
+        self.__inotify = Inotify()
+        self.__stop = os.pipe()
+        self.__thread = None
+
+    def start(self):
+        """Watches every directory below the roots and starts the thread"""
+        for root in self.roots:
+            self.__watchTree(root, False)
+        self.__thread = threading.Thread(target=self.__run, daemon=True)
+        self.__thread.start()
+        return len(self.__dirs)
+
+    def watched(self):
+        """Number of directories watched"""
+        return len(self.__dirs)
+
+    def stop(self):
+        """Stops the thread and releases the inotify instance"""
+        if self.__thread is not None:
+            os.write(self.__stop[1], b'x')
+            self.__thread.join()
+            self.__thread = None
+        self.__inotify.close()
+        os.close(self.__stop[0])
+        os.close(self.__stop[1])
+
+# Private methods
+
+    def __watchTree(self, root, announce):
+        for directory, subdirs, files in os.walk(root):
+            try:
+                self.__dirs[self.__inotify.addWatch(directory, WATCH_MASK)] = directory
+            except OSError as e:
+                if e.errno == errno.ENOSPC:
+                    # out of watches (fs.inotify.max_user_watches), the rest is left to refreshIndex
+                    raise
+                continue
+            if announce:
+                # files moved in with the directory, or created before its watch was added
+                for name in files:
+                    self.changed(os.path.join(directory, name), False)
+
+    def __run(self):
+        while True:
+            ready, unused, unused = select.select([self.__inotify.fd, self.__stop[0]], [], [])
+            if self.__stop[0] in ready:
+                return
+            for wd, mask, name in self.__inotify.events():
+                self.__handle(wd, mask, name)
+
+    def __handle(self, wd, mask, name):
+        if mask & IN_Q_OVERFLOW:
+            self.overflow()
+            return
+        directory = self.__dirs.get(wd)
+        if directory is None:
+            return
+        if mask & (IN_IGNORED | IN_DELETE_SELF):
+            self.__dirs.pop(wd, None)
+            return
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                try:
+                    self.__watchTree(path, True)
+                except OSError:
+                    self.overflow()
+            elif mask & IN_MOVED_FROM:
+                # the files below are gone from their indexed paths
+                for wd, directory in list(self.__dirs.items()):
+                    if directory == path or directory.startswith(path + '/'):
+                        self.__inotify.removeWatch(wd)
+                        del self.__dirs[wd]
+                self.overflow()
+            return
+        self.changed(path, bool(mask & WRITE_MASK))
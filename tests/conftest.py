@@ -0,0 +1,34 @@
+import random
+import shutil
+import subprocess
+
+import pytest
+
+from slackdisk import backend, bmap, indexcache
+
+# Host files in the test image, each with 2 to 4 KiB of slack
+FILES = 400
+
+@pytest.fixture
+def image(tmp_path):
+    """ext4 image made from a directory of host files, nothing is mounted"""
+    if shutil.which('mkfs.ext4') is None:
+        pytest.skip('mkfs.ext4 not available')
+    source = tmp_path / 'source'
+    (source / 'data').mkdir(parents=True)
+    rng = random.Random(1)
+    for i in range(FILES):
+        (source / 'data' / f'f{i}').write_bytes(rng.randbytes(rng.randrange(1, 2048)))
+    path = tmp_path / 'slackdisk.img'
+    subprocess.run(['mkfs.ext4', '-q', '-F', '-b', '4096', '-O', '^has_journal', '-d', str(source), str(path), '16M'],
+        check=True, capture_output=True)
+    return path
+
+@pytest.fixture
+def disk(image, tmp_path):
+    """Bmap over the test image, every host file under /data usable"""
+    disk = bmap.Bmap(backend.ImageBackend(str(image)), indexcache.IndexCache(str(tmp_path / 'index')))
+    disk.usabledirs = '/data'
+    disk.minimaltime = 0
+    yield disk
+    disk.close()
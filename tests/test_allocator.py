@@ -0,0 +1,46 @@
+from slackdisk.allocator import Allocator
+
+def allocator():
+    return Allocator({(1, 10): 100, (1, 11): 300, (1, 12): 1000, (2, 10): 500, (2, 11): 200})
+
+def test_best_fit():
+    free = allocator()
+    assert free.bestFit(150) == (2, 11)
+    assert free.bestFit(150) == (1, 11)
+    assert free.bestFit(2000) is None
+
+def test_allocate_fits_one():
+    free = allocator()
+    assert free.allocate(250) == [((1, 11), 0, 250)]
+    assert free.isUsed((1, 11))
+
+def test_allocate_largest_first():
+    free = allocator()
+    assert free.allocate(1200) == [((1, 12), 0, 1000), ((2, 11), 1000, 200)]
+
+def test_allocate_per_device():
+    free = allocator()
+    assert free.devices() == [1, 2]
+    assert free.allocate(600, device=2) == [((2, 10), 0, 500), ((2, 11), 500, 100)]
+    assert free.devices() == [1]
+    assert free.largest(2) == 0
+    assert free.allocate(10, device=2) is None
+
+def test_not_enough_space_takes_nothing():
+    free = allocator()
+    assert free.allocate(3000) is None
+    assert free.free() == (5, 2100)
+
+def test_release():
+    free = allocator()
+    placed = free.allocate(1200)
+    assert free.free() == (3, 900)
+    free.release(host for host, offset, length in placed)
+    assert free.free() == (5, 2100)
+    assert not free.isUsed((1, 12))
+
+def test_use():
+    free = allocator()
+    free.use([(1, 12), (9, 9)])
+    assert free.largest() == 500
+    assert free.take(1) == (1, 11)
@@ -0,0 +1,53 @@
+import os
+import random
+
+import pytest
+
+from slackdisk import encoder
+from slackdisk.blobstore import BlobStore
+
+INITIAL = '/data/f0'
+
+@pytest.fixture
+def store(disk):
+    return BlobStore(disk, encoder.Encoder(), INITIAL)
+
+@pytest.fixture
+def datakey():
+    return os.urandom(32)
+
+def hosts(store):
+    return set(host for blob in store.chunkBlobs() for host, length in blob.fragments)
+
+def test_write_read(store, datakey):
+    data = random.Random(1).randbytes(150000)
+    contents = store.write(data, datakey)
+    assert contents.size == len(data)
+    assert store.read(contents, datakey) == data
+    store.clear()
+    assert b''.join(store.readStream(contents, datakey)) == data
+
+def test_dedup(store, datakey):
+    data = random.Random(1).randbytes(100000)
+    first = store.write(data, datakey)
+    second = store.write(data, datakey)
+    assert first.digests == second.digests
+    dedup = store.dedup()
+    assert dedup['references'] == 2 * dedup['chunks']
+    assert dedup['ratio'] == 2.0
+
+def test_reused_host_file_not_read_from_cache(store, datakey):
+    old = store.write(b'contents of a', datakey)
+    assert store.read(old, datakey) == b'contents of a'
+    taken = hosts(store)
+    store.release(old)
+    # as a save does, the host files of released chunks are free again
+    store.reserve(store.chunkBlobs())
+    new = store.write(b'contents of b', datakey)
+    assert hosts(store) == taken
+    assert store.read(new, datakey) == b'contents of b'
+
+def test_load_chunks_missing(store, datakey):
+    contents = store.write(b'contents', datakey)
+    with pytest.raises(ValueError):
+        store.loadChunks([], [contents])
@@ -0,0 +1,74 @@
+import random
+import re
+
+INITIAL = '/data/f0'
+
+def payload(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+def rewritten(summary):
+    """(data fragments written, data fragments in the volume) from a save summary"""
+    found = re.search(r'\((\d+) of (\d+) data fragments', summary)
+    return int(found.group(1)), int(found.group(2))
+
+def test_save_load(disk):
+    data = payload(200000)
+    assert disk.save(data, INITIAL).startswith('Saved')
+    assert disk.load(INITIAL) == data
+
+def test_table_spans_host_files(disk):
+    # too many fragments for the table to fit in the slack of the initial file
+    data = payload(700000)
+    disk.save(data, INITIAL)
+    assert b''.join(disk.loadStream(INITIAL)) == data
+
+def test_save_stream(disk):
+    data = payload(300000)
+    disk.save((data[i:i + 1000] for i in range(0, len(data), 1000)), INITIAL)
+    assert disk.load(INITIAL) == data
+
+def test_save_replaces_volume(disk):
+    disk.save(payload(200000), INITIAL)
+    data = payload(100000, seed=2)
+    disk.save(data, INITIAL)
+    assert disk.load(INITIAL) == data
+
+def test_unchanged_save_writes_nothing(disk):
+    data = payload(300000)
+    written, total = rewritten(disk.save(data, INITIAL))
+    assert written == total
+    assert rewritten(disk.save(data, INITIAL)) == (0, total)
+    assert disk.load(INITIAL) == data
+
+def test_insertion_rewrites_around_it(disk):
+    data = payload(400000)
+    written, total = rewritten(disk.save(data, INITIAL))
+    changed = data[:200000] + b'inserted' + data[200000:]
+    written, total = rewritten(disk.save(changed, INITIAL))
+    assert written < total // 4
+    assert disk.load(INITIAL) == changed
+
+def test_not_enough_slack(disk):
+    data = payload(100000)
+    disk.save(data, INITIAL)
+    assert disk.save(payload(5000000, seed=2), INITIAL).startswith('Not enough slack space')
+    assert disk.load(INITIAL) == data
+
+def test_failed_write_keeps_previous_volume(disk, monkeypatch):
+    data = payload(200000)
+    disk.save(data, INITIAL)
+    writeBatch = disk.backend.writeBatch
+
+    def failing(writes):
+        written, failed, total = writeBatch(writes[1:])
+        return written, failed + [writes[0][0]], total
+
+    monkeypatch.setattr(disk.backend, 'writeBatch', failing)
+    assert disk.save(payload(200000, seed=2), INITIAL).startswith('Unable to write slack')
+    monkeypatch.undo()
+    assert disk.load(INITIAL) == data
+    assert disk.verify(INITIAL)[1] == []
+    # the host files taken by the failed save are free again
+    data = payload(600000, seed=3)
+    assert disk.save(data, INITIAL).startswith('Saved')
+    assert disk.load(INITIAL) == data
@@ -0,0 +1,45 @@
+import random
+
+from slackdisk import chunker
+
+def data(size, seed=1):
+    return random.Random(seed).randbytes(size)
+
+def cuts(data):
+    return [offset + length for offset, length in chunker.chunks(data)]
+
+def test_chunks_cover_data():
+    payload = data(500000)
+    pieces = list(chunker.chunks(payload))
+    assert pieces[0][0] == 0
+    assert sum(length for offset, length in pieces) == len(payload)
+    for (offset, length), (next_offset, next_length) in zip(pieces, pieces[1:]):
+        assert offset + length == next_offset
+    assert all(chunker.MIN_SIZE <= length <= chunker.MAX_SIZE for offset, length in pieces[:-1])
+
+def test_boundaries_stable_under_insertion():
+    payload = data(500000)
+    inserted = payload[:100000] + b'inserted bytes' + payload[100000:]
+    before = cuts(payload)
+    after = cuts(inserted)
+    shift = len(b'inserted bytes')
+    # boundaries before the insertion stay, the ones well after it move with the data
+    assert [cut for cut in before if cut < 100000] == [cut for cut in after if cut < 100000]
+    later = [cut for cut in before if cut > 100000 + chunker.MAX_SIZE]
+    assert later
+    assert set(cut + shift for cut in later) <= set(after)
+
+def test_deterministic():
+    payload = data(200000, seed=2)
+    assert cuts(payload) == cuts(bytes(payload))
+
+def test_stream_matches_chunks():
+    payload = data(400000, seed=3)
+    pieces = [payload[i:i + 10000] for i in range(0, len(payload), 10000)]
+    streamed = list(chunker.stream(pieces))
+    assert [(offset, len(chunk)) for offset, chunk in streamed] == list(chunker.chunks(payload))
+    assert b''.join(chunk for offset, chunk in streamed) == payload
+
+def test_empty():
+    assert list(chunker.chunks(b'')) == []
+    assert list(chunker.stream([])) == []
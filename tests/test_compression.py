@@ -0,0 +1,40 @@
+import random
+
+import pytest
+
+from slackdisk import compression
+
+def test_registry():
+    for id, codec in compression.CODECS.items():
+        assert compression.get(id) is codec
+        assert compression.byName(codec.name) is codec
+    assert compression.byName('zip') is None
+    with pytest.raises(ValueError):
+        compression.get(200)
+
+@pytest.mark.parametrize('id', sorted(compression.CODECS))
+def test_roundtrip(id):
+    data = b'some text to compress, ' * 1000
+    codec = compression.get(id)
+    compressor = codec.compressor()
+    packed = compressor.compress(data) + compressor.flush()
+    decompressor = codec.decompressor()
+    # small max_length, the output comes in several pieces
+    unpacked = b''.join(compression.inflate(decompressor, packed, 1024)) + compression.finish(decompressor)
+    assert unpacked == data
+
+def test_probe():
+    assert compression.probe(b'') == compression.STORE
+    assert compression.probe(random.Random(1).randbytes(100000)) == compression.STORE
+    assert compression.probe(b'the same line of text\n' * 5000) == compression.LZMA
+    rng = random.Random(2)
+    mixed = bytes(rng.choice(b'abcdefghijklmnopqrstuvwxyz0123456789') for i in range(100000))
+    assert compression.probe(mixed) == compression.ZLIB_BEST
+
+def test_sample():
+    data = bytes(range(256)) * 1000
+    piece = compression.sample(data, 300)
+    assert len(piece) == 300
+    assert piece[:100] == data[:100]
+    assert piece[-100:] == data[-100:]
+    assert compression.sample(b'short', 300) == b'short'
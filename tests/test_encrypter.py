@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from slackdisk import encrypter
+
+@pytest.fixture
+def session():
+    session = encrypter.Session(key=os.urandom(encrypter.key_bytes), workers=2)
+    yield session
+    session.close()
+
+def test_chunk_roundtrip(session):
+    data = b'secret chunk' * 100
+    encrypted = session.encryptChunk(data)
+    assert len(encrypted) == encrypter.NONCE_SIZE + len(data)
+    assert data not in encrypted
+    assert session.decryptChunk(encrypted) == data
+
+def test_nonces_unique(session):
+    encrypted = [session.encryptChunk(b'chunk %d' % i) for i in range(1000)]
+    nonces = set(chunk[:encrypter.NONCE_SIZE] for chunk in encrypted)
+    assert len(nonces) == len(encrypted)
+
+def test_same_chunk_same_bytes(session):
+    assert session.encryptChunk(b'same data') == session.encryptChunk(b'same data')
+    other = encrypter.Session(key=os.urandom(encrypter.key_bytes))
+    assert other.encryptChunk(b'same data') != session.encryptChunk(b'same data')
+
+def test_chunks_roundtrip_in_order(session):
+    chunks = [os.urandom(size) for size in (1, 1000, encrypter.CHUNK_SIZE, 17, 5000) * 3]
+    encrypted = list(session.encryptChunks(chunks))
+    assert list(session.decryptChunks(encrypted)) == chunks
+    assert session.throughput() > 0
+
+def test_wrong_key(session):
+    encrypted = session.encryptChunk(b'secret chunk')
+    other = encrypter.Session(key=os.urandom(encrypter.key_bytes))
+    assert other.decryptChunk(encrypted) != b'secret chunk'
+
+def test_password_stream():
+    data = b'legacy single stream'
+    assert encrypter.decrypt('password', encrypter.encrypt('password', data)) == data
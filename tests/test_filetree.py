@@ -0,0 +1,97 @@
+import random
+import re
+
+import pytest
+
+pytest.importorskip('cmd2')
+
+from slackdisk import encoder, encrypter
+from slackdisk.blobstore import BlobStore
+from slackdisk.filetree import Filetree
+
+INITIAL = '/data/f0'
+
+@pytest.fixture
+def session():
+    session = encrypter.Session('password')
+    yield session
+    session.close()
+
+def tree(disk):
+    tree = Filetree()
+    tree.store = BlobStore(disk, encoder.Encoder(), INITIAL)
+    return tree
+
+def test_directories():
+    files = Filetree()
+    assert files.mkdir('docs') == ''
+    assert files.mkdir('docs') == 'Directory exists'
+    assert files.mkdir('missing/docs') == 'Invalid path'
+    assert files.cd('docs') == ''
+    assert files.pwd() == '/docs'
+    assert files.mkdir('sub') == ''
+    assert files.cd('..') == ''
+    assert files.rmdir('docs') == 'This directory is not empty'
+    assert files.rmdir('docs/sub') == ''
+    assert files.rmdir('docs') == ''
+    assert files.cd('docs') == "Directory doesn't exist"
+
+def test_files():
+    files = Filetree()
+    files.mkdir('docs')
+    assert files.putStr('hello', '/docs/b.txt') == ''
+    assert files.putStr('again', '/docs/b.txt') == 'File already exists'
+    files.putStr('first', '/docs/a.txt')
+    files.cd('/docs')
+    assert files.catFile('b.txt') == 'hello'
+    assert files.mkdir('a.txt') == 'File exists'
+    assert files.rmFile('a.txt') == ''
+    assert files.catFile('a.txt') == 'File does not exist'
+    assert files.rmdir('b.txt') == 'Directory does not exist'
+
+def test_encode_load_without_store(session):
+    saved = Filetree()
+    saved.mkdir('docs')
+    saved.putStr('hello', '/docs/a.txt')
+    loaded = Filetree()
+    loaded.loadFileTree(b''.join(saved.encodeFiletree(session)), session)
+    assert loaded.catFile('/docs/a.txt') == 'hello'
+
+def rewritten(summary):
+    found = re.search(r'\((\d+) of (\d+) data fragments', summary)
+    return int(found.group(1)), int(found.group(2))
+
+def test_save_load(disk, session, tmp_path):
+    saved = tree(disk)
+    saved.mkdir('docs')
+    saved.putStr('hello', '/docs/a.txt')
+    (tmp_path / 'real').write_bytes(bytes(range(256)) * 1000)
+    saved.putFile(str(tmp_path / 'real'), '/docs/real')
+    disk.save(saved.encodeFiletree(session), INITIAL)
+    loaded = tree(disk)
+    loaded.loadFileTree(disk.loadStream(INITIAL), session)
+    assert loaded.catFile('/docs/a.txt') == 'hello'
+    loaded.getFile('/docs/real', str(tmp_path / 'back'))
+    assert (tmp_path / 'back').read_bytes() == bytes(range(256)) * 1000
+
+def test_unchanged_tree_saves_nothing(disk, session):
+    saved = tree(disk)
+    rng = random.Random(1)
+    # the same contents everywhere, a single chunk, the names make the tree span several
+    for i in range(3000):
+        saved.putStr('contents', f'/{rng.randbytes(16).hex()}')
+    written, total = rewritten(disk.save(saved.encodeFiletree(session), INITIAL))
+    assert total > 4
+    assert written == total
+    assert rewritten(disk.save(saved.encodeFiletree(session), INITIAL)) == (0, total)
+
+def test_removed_file_not_read_back(disk, session, tmp_path):
+    (tmp_path / 'a').write_bytes(b'contents of a')
+    (tmp_path / 'b').write_bytes(b'contents of b')
+    saved = tree(disk)
+    saved.putFile(str(tmp_path / 'a'), '/a')
+    assert saved.catFile('/a') == 'contents of a'
+    saved.rmFile('/a')
+    disk.save(saved.encodeFiletree(session), INITIAL)
+    saved.putFile(str(tmp_path / 'b'), '/b')
+    assert saved.catFile('/b') == 'contents of b'
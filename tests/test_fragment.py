@@ -0,0 +1,65 @@
+import pytest
+
+from slackdisk import fragment
+
+def test_pack_roundtrip():
+    slack = fragment.pack(fragment.DATA, (3, 42), b'payload', sequence=5)
+    assert fragment.isFragment(slack)
+    assert fragment.unpack(slack, 5) == (fragment.DATA, (3, 42), b'payload')
+
+def test_end_of_chain():
+    slack = fragment.pack(fragment.TABLE, None, b'last')
+    assert fragment.unpack(slack) == (fragment.TABLE, None, b'last')
+
+def test_trailing_slack_ignored():
+    slack = fragment.pack(fragment.DATA, (1, 7), b'abc') + b'\0' * 100
+    assert fragment.unpack(slack)[2] == b'abc'
+
+def test_corrupted_payload():
+    slack = bytearray(fragment.pack(fragment.DATA, (1, 7), b'payload'))
+    slack[-1] ^= 0xff
+    with pytest.raises(ValueError, match="checksum"):
+        fragment.unpack(slack)
+
+def test_truncated_payload():
+    slack = fragment.pack(fragment.DATA, (1, 7), b'payload')
+    with pytest.raises(ValueError, match="checksum"):
+        fragment.unpack(slack[:-2])
+
+def test_wrong_sequence():
+    slack = fragment.pack(fragment.DATA, (1, 7), b'payload', sequence=2)
+    with pytest.raises(ValueError, match="sequence"):
+        fragment.unpack(slack, 3)
+
+def test_unknown_version():
+    slack = bytearray(fragment.pack(fragment.DATA, (1, 7), b'payload'))
+    slack[2] = fragment.VERSION + 1
+    with pytest.raises(ValueError, match="version"):
+        fragment.unpack(slack)
+
+def test_no_header():
+    assert not fragment.isFragment(b'12:aGVsbG8=')
+    with pytest.raises(ValueError, match="header"):
+        fragment.unpack(b'12:aGVsbG8=')
+
+def test_check():
+    slack = fragment.pack(fragment.DATA, (1, 7), b'payload', sequence=1)
+    assert fragment.check(slack, fragment.DATA, (1, 7), 7, 1) is None
+    assert "kind" in fragment.check(slack, fragment.TABLE, (1, 7), 7, 1)
+    assert "links" in fragment.check(slack, fragment.DATA, (2, 7), 7, 1)
+    assert "length" in fragment.check(slack, fragment.DATA, (1, 7), 8, 1)
+    assert "sequence" in fragment.check(slack, fragment.DATA, (1, 7), 7, 0)
+
+def test_table_roundtrip():
+    chunks = [('00112233445566aa', 0, 100), ('ffeeddccbbaa9988', 100, 50)]
+    # same inode on two devices
+    entries = [((1, 12), 0, 60), ((2, 12), 60, 40), ((1, 13), 100, 50)]
+    assert fragment.unpackTable(fragment.packTable(chunks, entries)) == (chunks, entries)
+
+def test_chunk_fragments():
+    chunks = [('00112233445566aa', 0, 100), ('ffeeddccbbaa9988', 100, 50)]
+    entries = [((1, 12), 0, 60), ((2, 12), 60, 40), ((1, 13), 100, 50)]
+    assert fragment.chunkFragments(entries, chunks) == {
+        '00112233445566aa': [((1, 12), 0, 60), ((2, 12), 60, 40)],
+        'ffeeddccbbaa9988': [((1, 13), 0, 50)],
+    }
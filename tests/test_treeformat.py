@@ -0,0 +1,69 @@
+import pytest
+
+from slackdisk import treeformat
+from slackdisk.blobstore import Blob, Chunked
+from slackdisk.treeformat import DIR, FILE, Stream, TreeReader
+
+DIGEST = bytes(range(32))
+
+ENTRIES = [
+    (DIR, '', 2, 0, None),
+    (DIR, 'docs', 2, 0, None),
+    (FILE, 'a.txt', 0, 5, b'hello'),
+    (FILE, 'big', 0, 5000, Blob(5000, [((1, 12), 3000), ((2, 12), 2000)])),
+    (FILE, 'dedup', 0, 70000, Chunked(70000, [DIGEST, DIGEST])),
+]
+CHUNKS = [(DIGEST, Blob(35000, [((1, 40), 35000)]))]
+
+def reader(entries=ENTRIES, chunks=CHUNKS):
+    return TreeReader(Stream(treeformat.encode(entries, b'key', chunks)))
+
+def plain(contents):
+    if isinstance(contents, Blob):
+        return ('blob', contents.size, contents.fragments)
+    if isinstance(contents, Chunked):
+        return ('chunked', contents.size, contents.digests)
+    return contents
+
+def test_varints():
+    values = [0, 1, 127, 128, 300, 2 ** 63]
+    data = treeformat.packVarints(values)
+    position = 0
+    for value in values:
+        found, position = treeformat.readVarint(data, position)
+        assert found == value
+    assert position == len(data)
+
+def test_roundtrip():
+    tree = reader()
+    assert tree.datakey == b'key'
+    assert list(tree.entries()) == [entry[:4] for entry in ENTRIES]
+    assert [plain(contents) for contents in tree.contents()] == [plain(entry[4]) for entry in ENTRIES if entry[0] == FILE]
+    assert [(digest, plain(blob)) for digest, blob in tree.chunks()] == [(digest, plain(blob)) for digest, blob in CHUNKS]
+
+def test_subtree():
+    found = list(reader().subtree('/docs'))
+    assert [entry[:3] for entry in found] == [('/docs/a.txt', FILE, 5), ('/docs/big', FILE, 5000)]
+    assert found[0][3] == b'hello'
+    assert plain(found[1][3]) == plain(ENTRIES[3][4])
+
+def test_subtree_missing():
+    with pytest.raises(FileNotFoundError):
+        list(reader().subtree('/nothing'))
+
+def test_small_pieces():
+    data = b''.join(treeformat.encode(ENTRIES, b'key', CHUNKS))
+    tree = TreeReader(Stream(data[i:i + 3] for i in range(0, len(data), 3)))
+    assert list(tree.entries()) == [entry[:4] for entry in ENTRIES]
+
+def test_not_a_tree():
+    with pytest.raises(ValueError):
+        TreeReader(Stream([b'\x80\x03pickled']))
+
+def test_truncated():
+    data = b''.join(treeformat.encode(ENTRIES, b'key', CHUNKS))
+    tree = TreeReader(Stream([data[:-10]]))
+    list(tree.entries())
+    list(tree.contents())
+    with pytest.raises(ValueError, match="truncated"):
+        list(tree.chunks())